@@ -1,28 +1,75 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException, Request, Depends, Query
+from fastapi.exceptions import RequestValidationError
 from fastapi.responses import JSONResponse
-from pydantic import BaseModel, Field, computed_field
-from typing import Literal, Annotated
-import pickle
-import pandas as pd
+from starlette.concurrency import run_in_threadpool
+from pydantic import BaseModel, ConfigDict, Field, TypeAdapter, ValidationError, computed_field
+from typing import Literal, Annotated, Optional
+import csv
+import io
+import json
+import os
+from contextlib import nullcontext
+from micro_batcher import MicroBatcher
+from prediction_cache import PredictionCache
+from model_registry import ModelRegistry
+from model_startup import ModelStartup, default_model_path
+from city_tiers import CityTiers
+from functools import cached_property
 
-#import the ml model
-with open ('model.pkl','rb') as f:
-    model = pickle.load(f)
+#model.pkl and insurance.csv live next to this file
+MODEL_DIR = os.path.dirname(os.path.abspath(__file__))
+
+#telemetry.py is shared with the patient apps in the repository root (run with PYTHONPATH=..);
+#deployed on its own the service runs without /metrics, stage timings and the profiler
+try:
+    from telemetry import Telemetry, TelemetryMiddleware, telemetry_router
+except ImportError:
+    Telemetry = None
+
+#the six derived features the model is trained on
+FEATURE_COLUMNS = ['bmi', 'age_group', 'lifestyle_risk', 'city_tier', 'income_lpa', 'occupation']
+
+#cache of predictions keyed on those features
+#PREDICTION_CACHE_SIZE=0 turns it off, the *_DIGITS settings round bmi/income before lookup and inference
+def optional_env(name, cast):
+    value = os.environ.get(name)
+    return cast(value) if value else None
+
+prediction_cache = PredictionCache(
+    FEATURE_COLUMNS,
+    max_size=int(os.environ.get('PREDICTION_CACHE_SIZE', 10000)),
+    ttl_seconds=optional_env('PREDICTION_CACHE_TTL', float),
+    bmi_digits=optional_env('PREDICTION_CACHE_BMI_DIGITS', int),
+    income_digits=optional_env('PREDICTION_CACHE_INCOME_DIGITS', int)
+)
 
 app = FastAPI()
 
-tier_1_cities = ["Mumbai", "Delhi", "Bangalore", "Chennai", "Kolkata", "Hyderabad", "Pune"]
-tier_2_cities = [
-    "Jaipur", "Chandigarh", "Indore", "Lucknow", "Patna", "Ranchi", "Visakhapatnam", "Coimbatore",
-    "Bhopal", "Nagpur", "Vadodara", "Surat", "Rajkot", "Jodhpur", "Raipur", "Amritsar", "Varanasi",
-    "Agra", "Dehradun", "Mysore", "Jabalpur", "Guwahati", "Thiruvananthapuram", "Ludhiana", "Nashik",
-    "Allahabad", "Udaipur", "Aurangabad", "Hubli", "Belgaum", "Salem", "Vijayawada", "Tiruchirappalli",
-    "Bhavnagar", "Gwalior", "Dhanbad", "Bareilly", "Aligarh", "Gaya", "Kozhikode", "Warangal",
-    "Kolhapur", "Bilaspur", "Jalandhar", "Noida", "Guntur", "Asansol", "Siliguri"
-]
+#stands in for Telemetry when telemetry.py is not importable
+class NoTelemetry:
+    def stage(self, name):
+        return nullcontext()
+
+    def gauges(self, prefix, stats):
+        pass
+
+#per-route latency, errors and stage timings on /metrics, and a sampling profiler under /debug/profiler
+if Telemetry is not None:
+    telemetry = Telemetry()
+    app.add_middleware(TelemetryMiddleware, telemetry=telemetry)
+    app.include_router(telemetry_router(telemetry))
+else:
+    telemetry = NoTelemetry()
+telemetry.gauges('prediction_cache', prediction_cache.stats)
+
+#city -> tier lookup, loaded from cities.json (or CITY_TIERS_FILE) so tiers can change without a code change
+city_tiers = CityTiers.from_file(os.environ.get('CITY_TIERS_FILE', os.path.join(MODEL_DIR, 'cities.json')))
 
 #pydantic model for input data validation
+#inputs are frozen so the derived features can be computed once per instance and cached
 class UserInput(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     age: Annotated[int, Field(..., gt=0, lt=120, description="Age of the user")]
     weight: Annotated[float, Field(..., gt=0, description="Weight of the user in kg")]
     height: Annotated[float, Field(..., gt=0, description="Height of the user in cm")]
@@ -33,12 +80,12 @@ class UserInput(BaseModel):
        'business_owner', 'unemployed', 'private_job'], Field(..., description='Occupation of the user')]   
 
     @computed_field
-    @property
+    @cached_property
     def bmi(self) -> float:
         return self.weight/(self.height)**2
 
     @computed_field
-    @property
+    @cached_property
     def lifestyle_risk(self) -> str:
         if self.smoker and self.bmi > 30:
             return "High"
@@ -48,39 +95,315 @@ class UserInput(BaseModel):
             return "Low" 
         
     @computed_field
-    @property
+    @cached_property
     def age_group(self) -> str:
         if self.age < 25:
             return "Young"
         elif self.age < 45:
-            return "Adult'"
+            return "Adult"
         elif self.age < 60:
             return "Middle_aged"
         return "Senior"
 
     @computed_field
-    @property
+    @cached_property
     def city_tier(self) -> int:
-        if self.city in tier_1_cities:
-            return 1
-        elif self.city in tier_2_cities:
-            return 2
-        else:
-            return 3
-        
-@app.post('/predict')
-def predict_premium(data:UserInput):
-    input_df = pd.DataFrame([{
-        'bmi': data.bmi,
-        'age_group': data.age_group,
-        'lifestyle_risk': data.lifestyle_risk,
-        'city_tier': data.city_tier,
-        'income_lpa': data.income_lpa,
-        'occupation': data.occupation
-    }])
-
-    prediction = model.predict(input_df)[0]
-    return JSONResponse(status_code=200, content={'predicted_category': prediction})
+        return city_tiers.tier(self.city)
         
+#validator for a whole batch of users, built once
+user_list_adapter = TypeAdapter(list[UserInput])
+
+#read the raw request body, so inputs can be validated straight from the JSON bytes
+async def raw_body(request: Request) -> bytes:
+    return await request.body()
+
+#validate JSON bytes, errors look the same as FastAPI's own body validation
+def validate_body(validate_json, body):
+    try:
+        with telemetry.stage('validate'):
+            return validate_json(body)
+    except ValidationError as e:
+        raise RequestValidationError([{**error, 'loc': ('body', *error['loc'])} for error in e.errors(include_url=False)])
+
+#request body docs for the routes that validate raw JSON themselves
+def json_body(schema):
+    return {'requestBody': {'required': True, 'content': {'application/json': {'schema': schema}}}}
+
+#derived model features for one user (rounded for the cache if configured)
+def user_features(user):
+    return prediction_cache.normalize({
+        'bmi': user.bmi,
+        'age_group': user.age_group,
+        'lifestyle_risk': user.lifestyle_risk,
+        'city_tier': user.city_tier,
+        'income_lpa': user.income_lpa,
+        'occupation': user.occupation
+    })
+
+#build one columnar input frame for the model from any number of feature rows
+#pandas is only imported once something runs the scikit-learn pipeline, not at startup
+def build_features(rows):
+    import pandas as pd
+    return pd.DataFrame({column: [row[column] for row in rows] for column in FEATURE_COLUMNS})
+
+#feature rows for the applicants in insurance.csv, used to check and warm up a model
+def sample_feature_rows(path=os.path.join(MODEL_DIR, 'insurance.csv'), limit=None):
+    with open(path) as f:
+        rows = list(csv.DictReader(f))[:limit]
+    return [user_features(user) for user in user_list_adapter.validate_python(rows)]
+
+#versioned models: loaded, checked and warmed up in the background, then swapped in atomically
+#models are compiled to a NumPy runtime that skips pandas unless MODEL_RUNTIME=sklearn,
+#and cached predictions are dropped every time the active model changes
+registry = ModelRegistry(
+    build_features,
+    sample_feature_rows,
+    compiled=os.environ.get('MODEL_RUNTIME', 'compiled') == 'compiled',
+    on_swap=prediction_cache.invalidate
+)
+
+#MODEL_PATH (relative to this directory), else model.joblib from `python model_runtime.py --export model.joblib`, else model.pkl
+def model_path():
+    return default_model_path(MODEL_DIR, os.environ.get('MODEL_PATH'))
+
+#the model is loaded, compiled and warmed up on a background thread once the app starts, and /ready
+#turns 200 when that is done; MODEL_PRELOAD=1 loads it at import instead, so a pre-forking server
+#(gunicorn --preload) loads it once and its workers share it
+startup = ModelStartup(lambda: registry.activate(registry.load(model_path())))
+if os.environ.get('MODEL_PRELOAD') == '1':
+    startup.run()
+
+@app.on_event('startup')
+def start_model():
+    startup.start()
+
+#predictions never wait for the model, callers are told to retry while it loads
+def require_model():
+    if registry.active is None:
+        #served without the startup event (e.g. a test client without its lifespan), so start loading now;
+        #loading in the request would stall the event loop
+        startup.start()
+        if startup.state == 'failed':
+            raise HTTPException(status_code=503, detail=f"Model failed to load: {startup.error}")
+        if registry.active is None:
+            raise HTTPException(status_code=503, detail="Model is still loading", headers={'Retry-After': '1'})
+
+#predict feature rows with one model call, only the active model's results are cached
+#with details=True results are predict_details dicts (probabilities, plus contributions if asked for) instead of labels
+def predict_rows(rows, version=None, details=False, contributions=False):
+    version = version or registry.active
+    generation = prediction_cache.generation
+    with telemetry.stage('inference'):
+        if details:
+            results = version.predict_details(rows, contributions)
+            predictions = [result['predicted_category'] for result in results]
+        else:
+            results = predictions = version.predict(rows)
+    if version is not registry.active:
+        return results
+    for row, prediction in zip(rows, predictions):
+        prediction_cache.put(prediction_cache.key(row), prediction, generation)
+    registry.shadow_predict(rows, predictions)
+    return results
+
+#rows queued by /predict carry the model version they were routed to and the details they want
+#(None, 'probabilities' or 'contributions'); each version's rows still share one model call
+def predict_routed(items):
+    predictions = [None] * len(items)
+    by_version = {}
+    for i, (version, row, details) in enumerate(items):
+        by_version.setdefault(version, []).append(i)
+    for version, indexes in by_version.items():
+        wanted = {items[i][2] for i in indexes}
+        details = wanted != {None}
+        results = predict_rows([items[i][1] for i in indexes], version, details, 'contributions' in wanted)
+        for i, result in zip(indexes, results):
+            #rows that only asked for a label get just the label
+            predictions[i] = result['predicted_category'] if details and items[i][2] is None else result
+    return predictions
+
+#the parts of a predict_details result a request asked for
+def detail_fields(result, probabilities, contributions):
+    content = {'predicted_category': result['predicted_category']}
+    if probabilities:
+        content['probabilities'] = result['probabilities']
+    if contributions:
+        content['contributions'] = result['contributions']
+    return content
+
+#answer what we can from the cache and send only the misses to the model
+def predict_cached(rows):
+    predictions = [prediction_cache.get(prediction_cache.key(row)) for row in rows]
+    misses = [i for i, prediction in enumerate(predictions) if prediction is None]
+    if misses:
+        for i, prediction in zip(misses, predict_rows([rows[i] for i in misses])):
+            predictions[i] = prediction
+    return predictions
+
+#concurrent /predict calls are coalesced into one model call
+#PREDICT_MAX_BATCH_SIZE=1 turns micro-batching off
+batcher = MicroBatcher(
+    predict_routed,
+    max_batch_size=int(os.environ.get('PREDICT_MAX_BATCH_SIZE', 32)),
+    max_wait_ms=float(os.environ.get('PREDICT_MAX_WAIT_MS', 5))
+)
+
+@app.on_event('shutdown')
+async def stop_batcher():
+    await batcher.stop()
+
+#optional extras of the predict endpoints
+PROBABILITIES = Query(False, description="Also return the probability of every premium category")
+CONTRIBUTIONS = Query(False, description="Also return how much each feature raised or lowered the predicted category's probability")
+
+@app.post('/predict', openapi_extra=json_body(UserInput.model_json_schema()))
+async def predict_premium(body: bytes = Depends(raw_body), probabilities: bool = PROBABILITIES, contributions: bool = CONTRIBUTIONS):
+    data = validate_body(UserInput.model_validate_json, body)
+    require_model()
+    with telemetry.stage('feature_build'):
+        features = user_features(data)
+    version = registry.route()
+    #probabilities and contributions come from the same model call as the label, cached labels cannot provide them
+    details = 'contributions' if contributions else 'probabilities' if probabilities else None
+    prediction = None
+    if version is registry.active and details is None:
+        prediction = prediction_cache.get(prediction_cache.key(features))
+    if prediction is None:
+        try:
+            prediction = await batcher.submit((version, features, details))
+        except ValueError as e:
+            #e.g. a feature value the model never saw during training, answered like /predict/batch does
+            raise HTTPException(status_code=422, detail=str(e))
+    with telemetry.stage('serialize'):
+        content = {'predicted_category': prediction} if details is None else detail_fields(prediction, probabilities, contributions)
+        return JSONResponse(status_code=200, content=content)
+
+@app.post('/predict/batch', openapi_extra=json_body({'type': 'array', 'items': UserInput.model_json_schema()}))
+def predict_premium_batch(body: bytes = Depends(raw_body), probabilities: bool = PROBABILITIES, contributions: bool = CONTRIBUTIONS):
+    return predict_users(validate_body(user_list_adapter.validate_json, body), probabilities, contributions)
+
+#predict a validated list of users, answers in input order
+#probabilities/contributions are returned as lists parallel to predicted_categories
+def predict_users(data, probabilities=False, contributions=False):
+    if not data:
+        content = {'predicted_categories': []}
+        content.update({key: [] for key, wanted in (('probabilities', probabilities), ('contributions', contributions)) if wanted})
+        return JSONResponse(status_code=200, content=content)
+    require_model()
+
+    #one model call for the whole batch (cache misses only), predictions come back in input order
+    with telemetry.stage('feature_build'):
+        rows = [user_features(user) for user in data]
+    try:
+        if probabilities or contributions:
+            #details for every row, vectorized in the one call
+            results = predict_rows(rows, details=True, contributions=contributions)
+        else:
+            predictions = predict_cached(rows)
+    except ValueError as e:
+        #e.g. a feature value the model never saw during training
+        raise HTTPException(status_code=422, detail=str(e))
+    with telemetry.stage('serialize'):
+        if probabilities or contributions:
+            content = {'predicted_categories': [result['predicted_category'] for result in results]}
+            if probabilities:
+                content['probabilities'] = [result['probabilities'] for result in results]
+            if contributions:
+                content['contributions'] = [result['contributions'] for result in results]
+        else:
+            content = {'predicted_categories': predictions}
+        return JSONResponse(status_code=200, content=content)
+
+@app.post('/predict/batch/file', openapi_extra={'requestBody': {'required': True, 'content': {
+    'text/csv': {'schema': {'type': 'string'}},
+    'application/x-ndjson': {'schema': {'type': 'string'}}}}})
+async def predict_premium_file(request: Request, probabilities: bool = PROBABILITIES, contributions: bool = CONTRIBUTIONS):
+    #accepts a CSV with the same columns as insurance.csv, or one JSON object per line
+    content_type = request.headers.get('content-type', '')
+    if not any(kind in content_type for kind in ('csv', 'ndjson', 'jsonl')):
+        raise HTTPException(status_code=415, detail="Content-Type must be text/csv or application/x-ndjson")
+    body = await request.body()
+    #parsing, validation and inference of the whole upload run off the event loop
+    return await run_in_threadpool(predict_upload, body, content_type, probabilities, contributions)
+
+#rows of a CSV or NDJSON upload, ValueError if it is not UTF-8 or does not parse
+def parse_upload(body, content_type):
+    text = body.decode()
+    if 'csv' in content_type:
+        try:
+            return list(csv.DictReader(io.StringIO(text)))
+        except csv.Error as e:
+            raise ValueError(str(e))
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+def predict_upload(body, content_type, probabilities, contributions):
+    try:
+        rows = parse_upload(body, content_type)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f'Body could not be parsed: {e}')
+
+    try:
+        with telemetry.stage('validate'):
+            users = user_list_adapter.validate_python(rows)
+    except ValidationError as e:
+        raise HTTPException(status_code=422, detail=json.loads(e.json()))
+
+    return predict_users(users, probabilities, contributions)
+
+#readiness probe: 200 once the model is loaded and warmed up, 503 before that or if loading failed
+@app.get('/ready')
+def ready():
+    content = {**startup.stats(), 'model': registry.active.stats() if registry.active is not None else None}
+    return JSONResponse(status_code=200 if startup.ready else 503, content=content)
+
+@app.get('/cache/stats')
+def cache_stats():
+    return prediction_cache.stats()
+
+#request body for loading a candidate model
+class ModelLoadRequest(BaseModel):
+    path: Annotated[str, Field('model.pkl', description="Model file, relative to the app directory")]
+    version: Annotated[Optional[str], Field(None, description="Version label, generated if omitted")]
+    canary_fraction: Annotated[float, Field(0.0, ge=0, le=1, description="Share of /predict traffic routed to the candidate")]
+    shadow: Annotated[bool, Field(False, description="Also score active traffic with the candidate and compare")]
+
+#only model files inside the app directory can be loaded
+def resolve_model_path(path):
+    full_path = os.path.realpath(os.path.join(MODEL_DIR, path))
+    if os.path.commonpath([full_path, MODEL_DIR]) != MODEL_DIR or not os.path.isfile(full_path):
+        raise HTTPException(status_code=400, detail="Model file not found in the app directory")
+    return full_path
+
+@app.get('/models')
+def list_models():
+    return registry.stats()
+
+@app.post('/models/load')
+def load_candidate_model(request: ModelLoadRequest):
+    try:
+        registry.load_candidate(resolve_model_path(request.path), request.version,
+                                canary_fraction=request.canary_fraction, shadow=request.shadow)
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return JSONResponse(status_code=202, content={'message': 'loading candidate model'})
+
+@app.post('/models/promote')
+def promote_model():
+    try:
+        promoted = registry.promote()
+    except LookupError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return {'message': 'model promoted', 'version': promoted.version}
 
+@app.post('/models/discard')
+def discard_model():
+    discarded = registry.discard()
+    if discarded is None:
+        raise HTTPException(status_code=409, detail="No candidate model to discard")
+    return {'message': 'candidate discarded', 'version': discarded.version}
 
+@app.post('/model/reload')
+def reload_model():
+    #load the model file again and swap it in straight away, this also clears the prediction cache
+    registry.activate(registry.load(model_path()))
+    return {'message': 'model reloaded', 'version': registry.active.version}
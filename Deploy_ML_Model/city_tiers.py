@@ -0,0 +1,45 @@
+import json
+from types import MappingProxyType
+
+
+def normalize_city(name):
+    #case and whitespace never change the city: "  new   DELHI " -> "new delhi"
+    return ' '.join(name.split()).casefold()
+
+
+class CityTiers:
+    """Frozen hash index from normalized city name (or alias) to city tier.
+
+    Lookups are a single dict probe, whatever the number of cities. The table
+    is loaded from a JSON file so tiers and aliases can change without a code
+    change::
+
+        {"default_tier": 3,
+         "tiers": {"1": ["Mumbai", ...], "2": ["Jaipur", ...]},
+         "aliases": {"Bengaluru": "Bangalore", ...}}
+    """
+
+    def __init__(self, tiers, aliases=None, default_tier=3):
+        index = {}
+        for tier, cities in tiers.items():
+            for city in cities:
+                index[normalize_city(city)] = int(tier)
+        for alias, city in (aliases or {}).items():
+            key = normalize_city(city)
+            if key not in index:
+                raise ValueError(f'Alias {alias!r} points to unknown city {city!r}')
+            index[normalize_city(alias)] = index[key]
+        self.default_tier = default_tier
+        self._index = MappingProxyType(index)
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path) as f:
+            data = json.load(f)
+        return cls(data['tiers'], data.get('aliases'), data.get('default_tier', 3))
+
+    def tier(self, city):
+        return self._index.get(normalize_city(city), self.default_tier)
+
+    def __len__(self):
+        return len(self._index)
@@ -0,0 +1,93 @@
+import asyncio
+
+
+class MicroBatcher:
+    """Coalesce concurrent single-row predictions into one vectorized model call.
+
+    Each ``submit`` puts its row on an asyncio queue and waits. A background
+    task takes rows off the queue until it has ``max_batch_size`` of them or
+    ``max_wait_ms`` has passed since the first one arrived, then runs
+    ``predict_batch`` once for the whole batch in a worker thread and hands
+    every caller the result for its own row.
+
+    ``predict_batch`` takes a list of rows and returns a list of results in
+    the same order. If a batch fails, its rows are retried one by one so a
+    single bad row only fails its own request.
+    """
+
+    def __init__(self, predict_batch, max_batch_size=32, max_wait_ms=5.0):
+        self.predict_batch = predict_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._queue = None
+        self._task = None
+        self._loop = None
+
+    def start(self):
+        #the queue and task belong to the running event loop, so create them lazily
+        #(and again if the app is now served from a different loop)
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._loop is not loop:
+            self._loop = loop
+            self._queue = asyncio.Queue()
+            self._task = loop.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def submit(self, row):
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((row, future))
+        return await future
+
+    async def _collect(self):
+        #block for the first row, then keep collecting until the batch is full or the wait is over
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.get()]
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            if not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+            rows = [row for row, _ in batch]
+            try:
+                results = await loop.run_in_executor(None, self.predict_batch, rows)
+            except Exception:
+                results = None
+
+            if results is not None:
+                for (_, future), result in zip(batch, results):
+                    if not future.done():
+                        future.set_result(result)
+                continue
+
+            #isolate the failing row(s)
+            for row, future in batch:
+                try:
+                    result = (await loop.run_in_executor(None, self.predict_batch, [row]))[0]
+                except Exception as e:
+                    if not future.done():
+                        future.set_exception(e)
+                else:
+                    if not future.done():
+                        future.set_result(result)
@@ -0,0 +1,267 @@
+import pickle
+import random
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from model_runtime import CompiledModel, compile_model, load_export
+
+#the compiled runtime wins for request-sized batches, scikit-learn's Cython loops win for bulk scoring
+COMPILED_MAX_ROWS = 1024
+
+
+class ModelVersion:
+    """One loaded model: the pipeline, its compiled runtime and its latency metrics.
+
+    An exported model passes ``load_model`` instead of ``model``; the pipeline
+    is then only unpickled the first time ``model`` is read.
+    """
+
+    def __init__(self, version, path, model, runtime, build_frame, load_model=None):
+        self.version = version
+        self.path = path
+        self._model = model
+        self._load_model = load_model
+        self.runtime = runtime
+        self._explainer = runtime
+        self.build_frame = build_frame
+        self.loaded_at = time.time()
+        self._lock = threading.Lock()
+        self._model_lock = threading.Lock()
+        self._latencies = deque(maxlen=1000)
+        self.calls = 0
+        self.rows = 0
+        self.errors = 0
+
+    @property
+    def model(self):
+        if self._model is None:
+            with self._model_lock:
+                if self._model is None:
+                    self._model = self._load_model()
+        return self._model
+
+    @property
+    def pipeline_loaded(self):
+        return self._model is not None
+
+    @property
+    def explainer(self):
+        #the compiled runtime, or (with MODEL_RUNTIME=sklearn) a compiled copy made on first use, only for contributions
+        if self._explainer is None:
+            model = self.model
+            with self._model_lock:
+                if self._explainer is None:
+                    self._explainer = CompiledModel(model)
+        return self._explainer
+
+    def predict(self, rows):
+        with self._measure(rows):
+            if self.runtime is not None and len(rows) <= COMPILED_MAX_ROWS:
+                return self.runtime.predict(rows)
+            return self.model.predict(self.build_frame(rows)).tolist()
+
+    def predict_details(self, rows, contributions=False):
+        """Predict ``rows`` with class probabilities and, optionally, per-feature contributions.
+
+        Everything comes from one model call per batch. Each result is a dict
+        with ``predicted_category`` and ``probabilities`` (class -> probability),
+        plus ``contributions`` when asked for: the ``baseline`` probability of
+        the predicted class and what each model feature added to or took away
+        from it, which sum to that class's probability.
+        """
+        with self._measure(rows):
+            if contributions or (self.runtime is not None and len(rows) <= COMPILED_MAX_ROWS):
+                explainer = self.explainer
+                proba, credit = explainer.explain(rows, contributions)
+                classes = explainer.classes
+            else:
+                model = self.model
+                proba, credit = model.predict_proba(self.build_frame(rows)), None
+                classes = model.classes_
+            best = np.argmax(proba, axis=1)
+            labels = classes.take(best).tolist()
+            names = classes.tolist()
+            results = []
+            for i, (label, k) in enumerate(zip(labels, best.tolist())):
+                result = {'predicted_category': label, 'probabilities': dict(zip(names, proba[i].tolist()))}
+                if contributions:
+                    result['contributions'] = {'baseline': float(explainer.bias[k]),
+                                               'features': dict(zip(explainer.inputs, credit[i, :, k].tolist()))}
+                results.append(result)
+            return results
+
+    @contextmanager
+    def _measure(self, rows):
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            with self._lock:
+                self.errors += 1
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.calls += 1
+                self.rows += len(rows)
+                self._latencies.append(elapsed)
+
+    def stats(self):
+        with self._lock:
+            latencies = sorted(self._latencies)
+        percentile = lambda p: latencies[min(int(p * len(latencies)), len(latencies) - 1)] * 1000 if latencies else None
+        return {
+            'version': self.version,
+            'path': self.path,
+            'loaded_at': self.loaded_at,
+            'runtime': 'compiled' if self.runtime is not None else 'sklearn',
+            'pipeline_loaded': self.pipeline_loaded,
+            'calls': self.calls,
+            'rows': self.rows,
+            'errors': self.errors,
+            'latency_ms': {'p50': percentile(0.5), 'p95': percentile(0.95), 'p99': percentile(0.99)}
+        }
+
+
+class ModelRegistry:
+    """Versioned models with background loading, atomic swaps and canary/shadow routing.
+
+    ``load`` unpickles a model, compiles it, checks and warms it up on
+    ``sample_rows()``, all before anyone can route to it. A ``.joblib``
+    file written by ``model_runtime.export_model`` is loaded already compiled
+    and memory-mapped instead, without importing scikit-learn or pandas
+    until a request needs the pipeline itself. A loaded model
+    becomes the candidate; ``promote`` swaps it in as the active model with a
+    single reference assignment, so in-flight requests finish on whichever
+    version they started with. While a candidate exists, ``canary_fraction``
+    of requests are routed to it, and with ``shadow`` on it also scores a copy
+    of the active model's traffic off the request path so the two can be
+    compared. ``on_swap`` is called whenever the active model changes.
+    """
+
+    def __init__(self, build_frame, sample_rows, compiled=True, on_swap=None, warmup_rows=32):
+        self.build_frame = build_frame
+        self.sample_rows = sample_rows
+        self.compiled = compiled
+        self.on_swap = on_swap
+        self.warmup_rows = warmup_rows
+        self.active = None
+        self.candidate = None
+        self.canary_fraction = 0.0
+        self.shadow = False
+        self.loading = None
+        self.load_error = None
+        self.shadow_compared = 0
+        self.shadow_agreed = 0
+        self._lock = threading.Lock()
+        self._versions = 0
+        self._shadow_pool = ThreadPoolExecutor(max_workers=1)
+
+    def load(self, path, version=None):
+        with self._lock:
+            self._versions += 1
+            version = version or f'v{self._versions}'
+        rows = self.sample_rows()
+        if path.endswith('.joblib'):
+            #checked against the pipeline when it was exported
+            compiled, load_model = load_export(path)
+            runtime = compiled if self.compiled else None
+            loaded = ModelVersion(version, path, None, runtime, self.build_frame, load_model=load_model)
+        else:
+            with open(path, 'rb') as f:
+                model = pickle.load(f)
+            runtime = compile_model(model, rows, self.build_frame) if self.compiled else None
+            loaded = ModelVersion(version, path, model, runtime, self.build_frame)
+
+        #warm-up: run a few real rows through both inference paths (the pipeline's only if it is loaded or needed)
+        for row in rows[:self.warmup_rows]:
+            try:
+                loaded.predict([row])
+            except ValueError:
+                pass
+        if loaded.runtime is None or loaded.pipeline_loaded:
+            try:
+                loaded.model.predict(self.build_frame(rows[:self.warmup_rows]))
+            except ValueError:
+                pass
+        return loaded
+
+    def activate(self, loaded):
+        self.active = loaded
+        if self.on_swap is not None:
+            self.on_swap()
+
+    def load_candidate(self, path, version=None, canary_fraction=0.0, shadow=False):
+        """Load a candidate on a background thread; returns immediately."""
+        def run():
+            try:
+                candidate = self.load(path, version)
+            except Exception as e:
+                self.load_error = f'{type(e).__name__}: {e}'
+            else:
+                self.load_error = None
+                self.shadow_compared = self.shadow_agreed = 0
+                self.canary_fraction = canary_fraction
+                self.shadow = shadow
+                self.candidate = candidate
+            finally:
+                self.loading = None
+
+        with self._lock:
+            if self.loading is not None:
+                raise RuntimeError(f'Already loading {self.loading}')
+            self.loading = path
+        threading.Thread(target=run, daemon=True).start()
+
+    def promote(self):
+        candidate = self.candidate
+        if candidate is None:
+            raise LookupError('No candidate model to promote')
+        self.candidate = None
+        self.canary_fraction = 0.0
+        self.shadow = False
+        self.activate(candidate)
+        return candidate
+
+    def discard(self):
+        candidate, self.candidate = self.candidate, None
+        self.canary_fraction = 0.0
+        self.shadow = False
+        return candidate
+
+    def route(self):
+        #pick the version that serves this request
+        candidate = self.candidate
+        if candidate is not None and self.canary_fraction and random.random() < self.canary_fraction:
+            return candidate
+        return self.active
+
+    def shadow_predict(self, rows, predictions):
+        #score the same rows with the candidate off the request path and compare
+        candidate = self.candidate
+        if candidate is None or not self.shadow:
+            return
+
+        def run():
+            try:
+                shadow_predictions = candidate.predict(rows)
+            except Exception:
+                return
+            self.shadow_compared += len(rows)
+            self.shadow_agreed += sum(a == b for a, b in zip(predictions, shadow_predictions))
+
+        self._shadow_pool.submit(run)
+
+    def stats(self):
+        return {
+            'active': self.active.stats() if self.active is not None else None,
+            'candidate': self.candidate.stats() if self.candidate is not None else None,
+            'canary_fraction': self.canary_fraction,
+            'shadow': self.shadow,
+            'shadow_agreement': self.shadow_agreed / self.shadow_compared if self.shadow_compared else None,
+            'loading': self.loading,
+            'load_error': self.load_error
+        }
@@ -0,0 +1,281 @@
+import argparse
+import os
+import pickle
+import threading
+import numpy as np
+
+#bumped when the layout of an exported model changes
+EXPORT_FORMAT = 1
+
+
+class CompiledModel:
+    """Direct NumPy inference for the insurance premium Pipeline.
+
+    The fitted ColumnTransformer(OneHotEncoder + passthrough) and the
+    RandomForestClassifier are compiled once into plain arrays:
+
+    * every one-hot category gets a precomputed column index, so a feature
+      row is encoded straight into a float32 array without building a
+      DataFrame;
+    * all trees are concatenated into one node table, with leaves pointing
+      at themselves, so every tree is walked for every row at once in
+      ``max_depth`` vectorized steps.
+
+    The arithmetic mirrors scikit-learn (float32 features, per-tree leaf
+    probabilities summed in estimator order, then averaged), so ``predict``
+    returns exactly what ``pipeline.predict`` returns. ``verify`` checks that
+    on real data before the compiled path is trusted.
+
+    ``explain`` also returns per-feature contributions, collected during the
+    same walk: each split moves a row from a node to a child, and the change
+    in class probabilities between the two is credited to the input column
+    the split feature was encoded from. Averaged over the trees, ``bias``
+    (the root probabilities) plus a row's contributions add up to its
+    predicted probabilities.
+    """
+
+    def __init__(self, pipeline):
+        preprocessor = pipeline.named_steps['preprocessor']
+        forest = pipeline.named_steps['classifier']
+        if getattr(forest, 'n_outputs_', 1) != 1:
+            raise NotImplementedError('Only single-output forests can be compiled')
+
+        #feature layout after the ColumnTransformer
+        self.categorical = []  #(column, {category: feature index}, position in the encoder)
+        self.numeric = []      #(column, feature index)
+        n_features = 0
+        for name, transformer, columns in preprocessor.transformers_:
+            if name == 'remainder':
+                if transformer != 'drop':
+                    raise NotImplementedError('Only remainder="drop" is supported')
+                continue
+            #fitted ColumnTransformers may store passthrough as an identity FunctionTransformer
+            is_identity = type(transformer).__name__ == 'FunctionTransformer' and transformer.func is None
+            if transformer == 'passthrough' or is_identity:
+                for column in columns:
+                    self.numeric.append((column, n_features))
+                    n_features += 1
+            elif type(transformer).__name__ == 'OneHotEncoder':
+                if transformer.drop is not None or transformer.handle_unknown != 'error':
+                    raise NotImplementedError('Only OneHotEncoder(drop=None, handle_unknown="error") is supported')
+                for position, (column, categories) in enumerate(zip(columns, transformer.categories_)):
+                    index = {category: n_features + i for i, category in enumerate(categories.tolist())}
+                    self.categorical.append((column, index, position))
+                    n_features += len(categories)
+            else:
+                raise NotImplementedError(f'Unsupported transformer {transformer!r}')
+        if n_features != forest.n_features_in_:
+            raise NotImplementedError('Encoded feature count does not match the forest')
+        self.n_features = n_features
+
+        #one node table for the whole forest
+        left, right, feature, threshold, proba, roots = [], [], [], [], [], []
+        offset = 0
+        max_depth = 0
+        for estimator in forest.estimators_:
+            tree = estimator.tree_
+            nodes = np.arange(tree.node_count)
+            is_leaf = tree.children_left == -1
+            left.append(np.where(is_leaf, nodes, tree.children_left) + offset)
+            right.append(np.where(is_leaf, nodes, tree.children_right) + offset)
+            feature.append(np.where(is_leaf, 0, tree.feature))
+            threshold.append(np.where(is_leaf, np.inf, tree.threshold))
+            #same normalisation as DecisionTreeClassifier.predict_proba
+            value = tree.value[:, 0, :].astype(np.float64)
+            normalizer = value.sum(axis=1)[:, np.newaxis]
+            normalizer[normalizer == 0.0] = 1.0
+            proba.append(value / normalizer)
+            roots.append(offset)
+            offset += tree.node_count
+            max_depth = max(max_depth, tree.max_depth)
+        self.left = np.concatenate(left)
+        self.right = np.concatenate(right)
+        self.feature = np.concatenate(feature)
+        self.threshold = np.concatenate(threshold)
+        self.proba = np.concatenate(proba)
+        self.roots = np.asarray(roots, dtype=np.intp)
+        self.max_depth = max_depth
+        self.classes = forest.classes_
+        self.n_trees = len(forest.estimators_)
+        self._derive()
+
+        #preallocated single-row input, one per thread
+        self._local = threading.local()
+
+    def _derive(self):
+        #tables for explain, rebuilt on unpickling so models exported before they existed still explain
+        self.inputs = list(dict.fromkeys([column for column, _, _ in self.categorical] + [column for column, _ in self.numeric]))
+        #encoded feature -> input column, as a (features x inputs) 0/1 matrix
+        self.input_matrix = np.zeros((self.n_features, len(self.inputs)))
+        for column, index, _ in self.categorical:
+            self.input_matrix[list(index.values()), self.inputs.index(column)] = 1.0
+        for column, j in self.numeric:
+            self.input_matrix[j, self.inputs.index(column)] = 1.0
+        self.bias = self.proba[self.roots].mean(axis=0)
+
+    #pickled (and exported) without the per-thread buffers
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state['_local']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._derive()
+        self._local = threading.local()
+
+    def encode(self, rows):
+        if len(rows) == 1:
+            X = getattr(self._local, 'row', None)
+            if X is None:
+                X = self._local.row = np.zeros((1, self.n_features), dtype=np.float32)
+            else:
+                X.fill(0)
+        else:
+            X = np.zeros((len(rows), self.n_features), dtype=np.float32)
+        for i, row in enumerate(rows):
+            for column, index, position in self.categorical:
+                j = index.get(row[column])
+                if j is None:
+                    raise ValueError(f'Found unknown categories [{row[column]!r}] in column {position} during transform')
+                X[i, j] = 1.0
+            for column, j in self.numeric:
+                X[i, j] = row[column]
+        return X
+
+    def leaves(self, X, contributions=False):
+        #walk every tree for every row at the same time
+        #with contributions, also sum each step's change in class probabilities per (row, encoded feature)
+        n_rows, n_classes = X.shape[0], len(self.classes)
+        node = np.broadcast_to(self.roots, (n_rows, self.n_trees)).copy()
+        rows = np.arange(n_rows)[:, np.newaxis]
+        steps = []
+        for _ in range(self.max_depth):
+            feature = self.feature[node]
+            go_left = X[rows, feature] <= self.threshold[node]
+            child = np.where(go_left, self.left[node], self.right[node])
+            if contributions:
+                #leaves point at themselves, so finished trees add nothing
+                moved = child != node
+                steps.append(((rows * self.n_features + feature)[moved], self.proba[child[moved]] - self.proba[node[moved]]))
+            node = child
+        if not contributions:
+            return node
+        #one bincount over every (row, feature, class) cell
+        index = np.concatenate([index for index, _ in steps]) if steps else np.zeros(0, dtype=np.intp)
+        delta = np.concatenate([delta for _, delta in steps]) if steps else np.zeros((0, n_classes))
+        cells = (index[:, np.newaxis] * n_classes + np.arange(n_classes)).ravel()
+        credit = np.bincount(cells, weights=delta.ravel(), minlength=n_rows * self.n_features * n_classes)
+        return node, credit.reshape(n_rows, self.n_features, n_classes) / self.n_trees
+
+    def _proba(self, leaves):
+        proba = np.zeros((leaves.shape[0], len(self.classes)))
+        for t in range(self.n_trees):
+            proba += self.proba[leaves[:, t]]
+        proba /= self.n_trees
+        return proba
+
+    def predict_proba(self, rows):
+        return self._proba(self.leaves(self.encode(rows)))
+
+    def explain(self, rows, contributions=True):
+        """Class probabilities of ``rows``, plus per-input-column contributions from the same walk.
+
+        Returns ``(proba, contributions)``: arrays of shape (rows, classes)
+        and (rows, inputs, classes), with ``inputs`` ordered like
+        ``self.inputs``. Contributions are None unless asked for.
+        """
+        X = self.encode(rows)
+        if not contributions:
+            return self._proba(self.leaves(X)), None
+        leaves, credit = self.leaves(X, contributions=True)
+        return self._proba(leaves), np.einsum('rfc,fi->ric', credit, self.input_matrix)
+
+    def predict(self, rows):
+        return self.classes.take(np.argmax(self.predict_proba(rows), axis=1)).tolist()
+
+
+def verify(pipeline, compiled, rows, build_frame):
+    """Check that ``compiled`` and ``pipeline`` agree on every row.
+
+    Rows the pipeline cannot encode must be rejected by the compiled model
+    too. Returns the number of rows compared and raises AssertionError on
+    the first disagreement.
+    """
+    encodable = []
+    for row in rows:
+        try:
+            compiled.encode([row])
+        except ValueError:
+            try:
+                pipeline.predict(build_frame([row]))
+            except ValueError:
+                continue
+            raise AssertionError(f'Compiled model rejected a row the pipeline accepts: {row}')
+        encodable.append(row)
+    if not encodable:
+        return 0
+    expected = pipeline.predict(build_frame(encodable)).tolist()
+    actual = compiled.predict(encodable)
+    for row, a, b in zip(encodable, actual, expected):
+        if a != b:
+            raise AssertionError(f'Compiled model predicted {a!r}, pipeline predicted {b!r} for {row}')
+    return len(encodable)
+
+
+def compile_model(pipeline, rows=None, build_frame=None):
+    """Compile ``pipeline`` and verify it on ``rows``; return None if either step fails."""
+    try:
+        compiled = CompiledModel(pipeline)
+        if rows:
+            verify(pipeline, compiled, rows, build_frame)
+    except (NotImplementedError, AssertionError, AttributeError, KeyError):
+        return None
+    return compiled
+
+
+def export_model(pipeline, compiled, path):
+    """Write a model for fast loading: the compiled arrays plus the pickled pipeline.
+
+    The arrays are stored uncompressed by joblib, so ``load_export`` can map
+    them into memory instead of reading them. The pipeline is kept as pickle
+    bytes and only unpickled (importing scikit-learn) when something asks
+    for it.
+    """
+    import joblib
+    joblib.dump({'format': EXPORT_FORMAT, 'compiled': compiled, 'pipeline': pickle.dumps(pipeline)}, path)
+
+
+def load_export(path):
+    """Load an ``export_model`` file; returns the CompiledModel and a function unpickling the pipeline.
+
+    The node tables are read-only memory maps of the file, so every process
+    serving the model shares one copy through the page cache (forked
+    workers included) instead of each holding its own.
+    """
+    import joblib
+    export = joblib.load(path, mmap_mode='r')
+    if export.get('format') != EXPORT_FORMAT:
+        raise ValueError(f'{path} is not an exported model of format {EXPORT_FORMAT}')
+    pipeline = export['pipeline']
+    return export['compiled'], lambda: pickle.loads(pipeline)
+
+
+if __name__ == '__main__':
+    #equivalence check over the whole of insurance.csv, and optionally export the model
+    #python model_runtime.py --export model.joblib
+    parser = argparse.ArgumentParser(description='Check the compiled runtime against a pickled model and export it')
+    parser.add_argument('--model', default='model.pkl', help='pickled pipeline, relative to the app directory')
+    parser.add_argument('--export', help='file to export the model to for fast, memory-mapped loading, relative to the app directory')
+    args = parser.parse_args()
+    import app
+    #the module, not __main__, so the exported CompiledModel unpickles anywhere
+    import model_runtime
+    with open(os.path.join(app.MODEL_DIR, args.model), 'rb') as f:
+        model = pickle.load(f)
+    rows = app.sample_feature_rows()
+    compiled = model_runtime.CompiledModel(model)
+    print(f'{verify(model, compiled, rows, app.build_features)} of {len(rows)} rows match model.predict')
+    if args.export:
+        model_runtime.export_model(model, compiled, os.path.join(app.MODEL_DIR, args.export))
+        print(f'Exported {args.model} to {args.export}')
@@ -0,0 +1,70 @@
+import os
+import threading
+import time
+
+
+def default_model_path(model_dir, configured=None):
+    """The model file to serve, independent of the working directory.
+
+    ``configured`` (MODEL_PATH) wins, with relative paths taken relative to
+    ``model_dir``. Otherwise an exported ``model.joblib`` is used while it is
+    at least as new as ``model.pkl``, and ``model.pkl`` after that.
+    """
+    if configured:
+        return os.path.join(model_dir, configured)
+    pickled = os.path.join(model_dir, 'model.pkl')
+    exported = os.path.join(model_dir, 'model.joblib')
+    if os.path.isfile(exported) and (not os.path.isfile(pickled) or os.path.getmtime(exported) >= os.path.getmtime(pickled)):
+        return exported
+    return pickled
+
+
+class ModelStartup:
+    """Loads the model off the request path and reports readiness.
+
+    ``start`` runs ``load`` (load, compile, warm up and activate) on a
+    background thread, so the server accepts connections straight away and
+    readiness probes can tell when predictions are actually served. ``run``
+    does the same in the calling thread, e.g. at import time so a pre-forking
+    server shares the loaded model with its workers. Either one only ever
+    loads once.
+    """
+
+    def __init__(self, load):
+        self.load = load
+        self.state = 'pending'
+        self.error = None
+        self.load_seconds = None
+        self._lock = threading.Lock()
+
+    @property
+    def ready(self):
+        return self.state == 'ready'
+
+    def _claim(self):
+        with self._lock:
+            if self.state != 'pending':
+                return False
+            self.state = 'loading'
+            return True
+
+    def run(self):
+        if not self._claim():
+            return
+        start = time.perf_counter()
+        try:
+            self.load()
+        except Exception as e:
+            self.error = f'{type(e).__name__}: {e}'
+            self.state = 'failed'
+        else:
+            self.state = 'ready'
+        finally:
+            self.load_seconds = time.perf_counter() - start
+
+    def start(self):
+        if self.state == 'pending':
+            threading.Thread(target=self.run, name='model-startup', daemon=True).start()
+
+    def stats(self):
+        return {'status': self.state, 'load_seconds': self.load_seconds, 'error': self.error}
@@ -0,0 +1,88 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class PredictionCache:
+    """LRU/TTL cache of model predictions keyed on the derived feature vector.
+
+    Many raw inputs collapse to the same six model features, so the cache key
+    is the feature tuple rather than the request. ``bmi_digits`` and
+    ``income_digits`` optionally round those two features. ``normalize``
+    applies the rounding, and the rounded features are what the model is fed,
+    so a cached value is always exactly what the model returns for its key.
+    ``max_size=0`` turns the cache off.
+    """
+
+    def __init__(self, columns, max_size=10000, ttl_seconds=None, bmi_digits=None, income_digits=None):
+        self.columns = columns
+        self.max_size = max_size
+        self.ttl = ttl_seconds
+        self.bmi_digits = bmi_digits
+        self.income_digits = income_digits
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        #bumped on invalidate, so predictions made with an old model are not cached
+        self.generation = 0
+
+    def normalize(self, features):
+        if self.bmi_digits is not None:
+            features['bmi'] = round(features['bmi'], self.bmi_digits)
+        if self.income_digits is not None:
+            features['income_lpa'] = round(features['income_lpa'], self.income_digits)
+        return features
+
+    def key(self, features):
+        return tuple(features[column] for column in self.columns)
+
+    def get(self, key):
+        if not self.max_size:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at is None or expires_at > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value, generation=None):
+        if not self.max_size:
+            return
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self):
+        #called whenever the model changes, old predictions no longer apply
+        with self._lock:
+            self._entries.clear()
+            self.invalidations += 1
+            self.generation += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations
+            }
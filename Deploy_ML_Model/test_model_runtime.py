@@ -0,0 +1,73 @@
+#the compiled runtime must reproduce the pickled pipeline on insurance.csv
+#python -m pytest Deploy_ML_Model
+import os
+import pickle
+import warnings
+import numpy as np
+import pytest
+import app
+import model_runtime
+
+
+@pytest.fixture(scope='module')
+def pipeline():
+    with warnings.catch_warnings():
+        #model.pkl may have been fitted with another scikit-learn version
+        warnings.simplefilter('ignore')
+        with open(os.path.join(app.MODEL_DIR, 'model.pkl'), 'rb') as f:
+            return pickle.load(f)
+
+
+#(rows the pipeline accepts, rows it rejects) among the applicants in insurance.csv
+@pytest.fixture(scope='module')
+def rows(pipeline):
+    accepted, rejected = [], []
+    for row in app.sample_feature_rows():
+        try:
+            pipeline.predict(app.build_features([row]))
+        except ValueError:
+            rejected.append(row)
+        else:
+            accepted.append(row)
+    assert accepted
+    return accepted, rejected
+
+
+#compiled straight from the pipeline, and the same model after an export round trip
+@pytest.fixture(scope='module', params=['compiled', 'exported'])
+def compiled(request, pipeline, tmp_path_factory):
+    compiled = model_runtime.CompiledModel(pipeline)
+    if request.param == 'exported':
+        path = str(tmp_path_factory.mktemp('export') / 'model.joblib')
+        model_runtime.export_model(pipeline, compiled, path)
+        compiled, _ = model_runtime.load_export(path)
+    return compiled
+
+
+def test_predictions_match_pipeline(pipeline, rows, compiled):
+    accepted, _ = rows
+    assert compiled.predict(accepted) == pipeline.predict(app.build_features(accepted)).tolist()
+    #single rows take the preallocated per-thread buffer
+    assert [compiled.predict([row])[0] for row in accepted] == compiled.predict(accepted)
+
+
+def test_probabilities_match_pipeline(pipeline, rows, compiled):
+    accepted, _ = rows
+    expected = pipeline.predict_proba(app.build_features(accepted))
+    assert list(compiled.classes) == list(pipeline.classes_)
+    np.testing.assert_array_equal(compiled.predict_proba(accepted), expected)
+
+
+def test_rejects_rows_the_pipeline_rejects(rows, compiled):
+    _, rejected = rows
+    for row in rejected:
+        with pytest.raises(ValueError):
+            compiled.predict([row])
+
+
+def test_contributions_add_up_to_probabilities(rows, compiled):
+    accepted, _ = rows
+    proba, contributions = compiled.explain(accepted)
+    np.testing.assert_array_equal(proba, compiled.predict_proba(accepted))
+    assert contributions.shape == (len(accepted), len(compiled.inputs), len(compiled.classes))
+    np.testing.assert_allclose(compiled.bias + contributions.sum(axis=1), proba, rtol=0, atol=1e-12)
@@ -1,164 +1,265 @@
-from fastapi import  FastAPI, Path, HTTPException, Query
-from fastapi.responses import JSONResponse
-from pydantic import BaseModel, Field, computed_field
-from typing import  Annotated, Literal, Optional
-import json
-
-app = FastAPI()
-
-
-class Patient(BaseModel):
-    id: Annotated[str, Field(..., description= 'ID of the patient',  examples=['P001'])]
-    name : Annotated[str, Field(..., description="name of the patient")]
-    city : Annotated[str, Field(..., description="city of the patient")]
-    age : Annotated[int, Field(..., gt=0,lt=120, description='Age of the patient')]
-    gender : Annotated[Literal['male','female','others'],Field(...,description="Gender of the patient")]
-    height : Annotated[float,Field(...,gt=0, description="Height of the patient mtrs")]
-    weight : Annotated[float, Field(...,gt=0, description="Weight of the patient in kg")]
-
-    @computed_field
-    @property
-    def bmi(self) ->float:
-        bmi = round(self.weight/(self.height**2),2)
-        return bmi
-    
-    @computed_field
-    @property
-    def verdict(self) -> str:
-        if self.bmi < 18.5:
-            return 'Underweight'
-        elif self.bmi <25:
-            return "Normal"
-        elif self.bmi < 30:
-            return "Normal"
-        else:
-            return 'Obese'
-
-
-class PatientUpdate(BaseModel):
-    name: Annotated[Optional[str], Field(default=None)]
-    city: Annotated[Optional[str], Field(default=None)]
-    age: Annotated[Optional[int], Field(default=None, gt=0)]
-    gender: Annotated[Optional[Literal['male', 'female']], Field(default=None)]
-    height: Annotated[Optional[float], Field(default=None, gt=0)]
-    weight: Annotated[Optional[float], Field(default=None, gt=0)]
-
-
-
-
-
-app = FastAPI()
-#utility function 
-#1. load data from json file
-def load_data():
-    with open('patients.json') as f:
-        data = json.load(f)
-    return data
-
-#2. save data to json file
-def save_data(data):
-    with open('patients.json','w') as f:
-        json.dump(data, f)
+from fastapi import  FastAPI, Path, HTTPException, Query, Header, Request, Depends
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import StreamingResponse
+from pydantic import ValidationError
+from typing import  List, Literal, Optional
+import os
+from patient_import import import_patients, parse_rows, recompute_derived, row_format
+from json_codec import FastJSONResponse
+from patient_index import decode_cursor
+from patient_models import Patient, PatientUpdate, apply_patient_update
+from patient_store import open_store, PreconditionFailed, ReadOnlyStore
+from response_cache import CachedReads, ResponseCache, encode_object, stream_json_object, stream_ndjson
+from store_executor import StoreExecutor, StoreOverloaded
+from telemetry import Telemetry, TelemetryMiddleware, telemetry_router
+
+#responses are encoded with orjson when it is installed
+app = FastAPI(default_response_class=FastJSONResponse)
+
+#per-route latency, errors and stage timings on /metrics, and a sampling profiler under /debug/profiler
+telemetry = Telemetry()
+app.add_middleware(TelemetryMiddleware, telemetry=telemetry)
+app.include_router(telemetry_router(telemetry))
+
+#patients.json by default, PATIENT_STORE=sqlite:///patients.db for the SQLite backend
+#or PATIENT_STORE=columns:///patients.cols for a read-only columnar snapshot (python columnar_store.py patients.json patients.cols)
+#PATIENT_STORE_SHARED=1 when several workers serve the same JSON store (uvicorn --workers N, gunicorn -w N)
+store = open_store(os.environ.get('PATIENT_STORE', 'patients.json'), shared=os.environ.get('PATIENT_STORE_SHARED') == '1')
+
+#every store call runs on this bounded pool, so handlers never block the event loop
+#STORE_THREADS workers, and past STORE_QUEUE_LIMIT running + waiting calls requests get a 503
+executor = StoreExecutor(max_workers=int(os.environ.get('STORE_THREADS', '8')),
+                         max_pending=int(os.environ.get('STORE_QUEUE_LIMIT', '64')))
+
+#encoded bodies of read endpoints, each valid for as long as its ETag is
+response_cache = ResponseCache(max_bytes=int(os.environ.get('RESPONSE_CACHE_BYTES', str(64 * 2**20))))
+telemetry.gauges('store_executor', executor.stats)
+telemetry.gauges('response_cache', response_cache.stats)
+#ETags, 304s and cached bodies of the read endpoints, shared with the other patient app
+reads = CachedReads(store, executor, response_cache, telemetry)
+
+@app.on_event('shutdown')
+def close_store():
+    executor.shutdown()
+    store.close()
+
+@app.exception_handler(StoreOverloaded)
+async def store_overloaded(request: Request, exc: StoreOverloaded):
+    return FastJSONResponse(status_code=503, content={'detail': 'Server is busy, try again shortly'}, headers={'Retry-After': '1'})
+
+#a columnar snapshot (PATIENT_STORE=columns:///...) only serves reads
+@app.exception_handler(ReadOnlyStore)
+async def store_read_only(request: Request, exc: ReadOnlyStore):
+    return FastJSONResponse(status_code=405, content={'detail': 'The patient store is read-only'}, headers={'Allow': 'GET, HEAD'})
+
+#utility function
+#split an If-Match header into the list of ETags it contains
+def parse_if_match(header):
+    if header is None:
+        return None
+    return [tag.strip() for tag in header.split(',')]
+
+#read the raw request body, so models can validate straight from the JSON bytes
+async def raw_body(request: Request) -> bytes:
+    return await request.body()
+
+#validate JSON bytes against a model, errors look the same as FastAPI's own body validation
+def validate_body(model, body):
+    try:
+        with telemetry.stage('validate'):
+            return model.model_validate_json(body)
+    except ValidationError as e:
+        raise RequestValidationError([{**error, 'loc': ('body', *error['loc'])} for error in e.errors(include_url=False)])
+
+#request body docs for the routes that validate raw JSON themselves
+def json_body(model):
+    return {'requestBody': {'required': True, 'content': {'application/json': {'schema': model.model_json_schema()}}}}
 
 #API endpoints
 @app.get("/")
-def hello():
+async def hello():
     return {'message' : 'Patient Management System API'}
 
 @app.get('/about')
-def about():
+async def about():
     return {'message' :'A fully functional API to manage patient records'}
 
 @app.get('/view')
-def view():
-    data = load_data()
-    return data
+async def view(request: Request, limit: Optional[int] = Query(None, ge=1, description="Maximum number of patients to return"),
+         cursor: Optional[str] = Query(None, description="Patient ID from the X-Next-Cursor header of the previous page"),
+         stream: Optional[Literal['json', 'ndjson']] = Query(None, description="Stream every patient as one JSON object or as NDJSON lines")):
+    #stream straight from the store, one chunk at a time
+    if stream == 'ndjson':
+        return StreamingResponse(stream_ndjson(executor.iterate(store.iter_pages(encoded=True))), media_type='application/x-ndjson')
+    if stream == 'json':
+        return StreamingResponse(stream_json_object(executor.iterate(store.iter_pages(encoded=True))), media_type='application/json')
+
+    def read_patients():
+        if limit is None and cursor is None:
+            with telemetry.stage('storage_read'):
+                patients = store.all()
+            return reads.encode_json(patients)
+        with telemetry.stage('storage_read'):
+            pairs, next_cursor = store.encoded_page(limit or 100, after=cursor)
+        with telemetry.stage('serialize'):
+            return encode_object(pairs), ({'X-Next-Cursor': next_cursor} if next_cursor is not None else {})
+    return await reads.cached_read(request, read_patients)
 
 @app.get('/patient/{patient_id}')
-def view_patient(patient_id: str = Path(..., description="The ID of the patient to retrieve", example="P001")):
-    data = load_data()
-    if patient_id in data:
-        return data[patient_id]
+async def view_patient(request: Request, patient_id: str = Path(..., description="The ID of the patient to retrieve", example="P001")):
+    #one patient's ETag only changes when that patient does, so other writes keep it cached
+    def read_patient():
+        with telemetry.stage('storage_read'):
+            data = store.encoded(patient_id)
+        return (data, {}) if data is not None else None
+    response = await reads.cached_read(request, read_patient, etag=lambda key: store.etag(patient_id))
+    if response is not None:
+        return response
     raise HTTPException(status_code=404, detail="Patient not found")   
 
 @app.get('/sort')
-def sort_patints(sort_by: str = Query(...,description=" Sort on the basis of height, weight or BMI"), order:  str = Query('asc', description="Sort order: asc or desc")):
+async def sort_patints(request: Request,
+                 sort_by: str = Query(...,description=" Sort on the basis of height, weight or BMI"), order:  str = Query('asc', description="Sort order: asc or desc"),
+                 limit: Optional[int] = Query(None, ge=1, description="Maximum number of patients to return"),
+                 offset: int = Query(0, ge=0, description="Number of patients to skip"),
+                 cursor: Optional[str] = Query(None, description="Cursor from the X-Next-Cursor header of the previous page")):
     valid_fields = ['height', 'weight', 'bmi']
     if sort_by not in valid_fields:
         raise HTTPException(status_code=400, detail=f"Invalid sort_by value. Must be one of {valid_fields}")
     if order not in ['asc', 'desc']:
         raise HTTPException(status_code=400, detail="Invalid order value. Must be 'asc' or 'desc'")
-    data = load_data()
-    sort_order = True if order == 'desc' else False
-    sorted_data = sorted(data.values(), key = lambda x: x.get(sort_by, 0), reverse= sort_order)
-    return sorted_data
-
-@app.post('/create')
-def create_patient(patient: Patient):
-
-    #load exiting data
-    data = load_data()
-
-    #check if the patient already exists
-    if patient.id in data:
+    try:
+        after = decode_cursor(cursor) if cursor is not None else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor value")
+    #walk the sorted index instead of sorting every patient
+    def read_sorted():
+        with telemetry.stage('storage_read'):
+            page = store.sorted_page(sort_by, descending=(order == 'desc'), offset=offset, limit=limit, after=after)
+        return reads.encode_json(*page)
+    return await reads.cached_read(request, read_sorted)
+
+@app.get('/patients/search')
+async def search_patients(request: Request,
+                    city: Optional[str] = Query(None, description="Only patients from this city"),
+                    gender: Optional[Literal['male', 'female', 'others']] = Query(None, description="Only patients of this gender"),
+                    verdict: Optional[str] = Query(None, description="Only patients with this BMI verdict, e.g. Obese"),
+                    min_age: Optional[int] = Query(None, ge=0), max_age: Optional[int] = Query(None, ge=0),
+                    min_bmi: Optional[float] = Query(None, ge=0), max_bmi: Optional[float] = Query(None, ge=0),
+                    min_height: Optional[float] = Query(None, ge=0), max_height: Optional[float] = Query(None, ge=0),
+                    min_weight: Optional[float] = Query(None, ge=0), max_weight: Optional[float] = Query(None, ge=0),
+                    sort_by: Literal['id', 'age', 'height', 'weight', 'bmi'] = Query('id', description="Field to order the results by"),
+                    order: Literal['asc', 'desc'] = Query('asc', description="Sort order: asc or desc"),
+                    limit: int = Query(100, ge=1, le=1000, description="Maximum number of patients to return"),
+                    offset: int = Query(0, ge=0, description="Number of patients to skip"),
+                    cursor: Optional[str] = Query(None, description="Cursor from the X-Next-Cursor header of the previous page")):
+    equals = {field: value for field, value in (('city', city), ('gender', gender), ('verdict', verdict)) if value is not None}
+    ranges = {field: bounds for field, bounds in (('age', (min_age, max_age)), ('bmi', (min_bmi, max_bmi)),
+                                                   ('height', (min_height, max_height)), ('weight', (min_weight, max_weight)))
+              if bounds != (None, None)}
+    try:
+        after = decode_cursor(cursor, length=1 if sort_by == 'id' else 2) if cursor is not None else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor value")
+    #the store answers from its indexes, only the matching page is read
+    def read_results():
+        with telemetry.stage('storage_read'):
+            results, next_cursor = store.search(equals, ranges, sort_by, descending=(order == 'desc'), offset=offset, limit=limit, after=after)
+        return reads.encode_json([{'id': patient_id, **record} for patient_id, record in results], next_cursor)
+    return await reads.cached_read(request, read_results)
+
+@app.get('/patients/stats')
+async def patient_stats(request: Request, group_by: Optional[List[Literal['city', 'gender', 'verdict', 'age', 'height', 'weight', 'bmi']]] = Query(
+        None, description="Fields to group by; numeric fields are grouped in histogram buckets")):
+    #counts, mean/std/min/max and histograms, kept up to date by the store as patients change
+    def read_stats():
+        with telemetry.stage('storage_read'):
+            stats = store.stats(group_by)
+        return reads.encode_json(stats)
+    return await reads.cached_read(request, read_stats)
+
+@app.post('/create', openapi_extra=json_body(Patient))
+async def create_patient(body: bytes = Depends(raw_body)):
+
+    #validate straight from the request bytes
+    patient = validate_body(Patient, body)
+
+    #add new patient to the store (fails if the patient already exists)
+    try:
+        record = await executor.run(telemetry.timed('storage_write', store.create), patient.id, patient.model_dump(exclude={'id'}))
+    except KeyError:
         raise HTTPException(status_code=400, detail="Patient with this ID already exists")
 
-    #add new patient to DB
-    data[patient.id] = patient.model_dump(exclude={'id'})
-
-    #save the data in json
-    save_data(data) 
-
     #return the created patient
-    return JSONResponse(status_code=201, content={"message": "Patient created successfully", "patient": data[patient.id]})
-
-@app.put('/edit/{patinet_id}')
-def update_patient(patient_id: str, patient_update: PatientUpdate):
-    
-    #load existing data
-    data = load_data()
-
-    #check if the patient exists
-    if patient_id not in data:
+    return FastJSONResponse(status_code=201, content={"message": "Patient created successfully", "patient": record},
+                        headers={'ETag': await executor.run(store.etag, patient.id)})
+
+@app.put('/edit/{patient_id}', openapi_extra=json_body(PatientUpdate))
+async def update_patient(patient_id: str, body: bytes = Depends(raw_body),
+                   if_match: Optional[str] = Header(default=None, description="Only update if the patient still has this ETag")):
+
+    #only the fields sent are validated, PatientUpdate has the same constraints as Patient
+    updated_patient_info = validate_body(PatientUpdate, body).model_dump(exclude_unset=True)
+    null_fields = [key for key, value in updated_patient_info.items() if value is None]
+    if null_fields:
+        raise RequestValidationError([{'type': 'value_error', 'loc': ('body', key), 'msg': 'Field may not be null', 'input': None}
+                                      for key in null_fields])
+
+    #runs while only this patient is locked, so edits to other patients go on in parallel
+    #bmi and verdict are re-derived only if height or weight changed
+    def apply_update(existing_patient_info):
+        return apply_patient_update(existing_patient_info, updated_patient_info)
+
+    #save the updated patient
+    try:
+        await executor.run(telemetry.timed('storage_write', store.modify), patient_id, apply_update, if_match=parse_if_match(if_match))
+    except KeyError:
         raise HTTPException(status_code=404, detail="Patient not found")
+    except PreconditionFailed:
+        raise HTTPException(status_code=412, detail="Patient was modified by another request")
 
-    #update patient details
-    existing_patient_info = data[patient_id]
-    
-    updated_patient_info = patient_update.model_dump(exclude_unset=True)
-
-    for key, value in updated_patient_info.items():
-        existing_patient_info[key] = value
-
-    #existing_patient_info -> pydantic object -> updated bmi+ verdict -> pydantic object ->dict
-    existing_patient_info['id'] = patient_id
-    patient_pydantic_obj = Patient(**existing_patient_info)  
-
-    #-> pydantic object ->dict
-    existing_patient_info = patient_pydantic_obj.model_dump(exclude='id')
-
-    #add this dict to data
-    data[patient_id] = existing_patient_info
-
-
-    #save the updated data
-    save_data(data)
-
-    return JSONResponse(status_code=200, content={'messgae':"patient updated successfully"}) 
+    return FastJSONResponse(status_code=200, content={'messgae':"patient updated successfully"},
+                        headers={'ETag': await executor.run(store.etag, patient_id)})
 
 @app.delete('/delete/{patient_id}')
-def delete_patient(patient_id: str):
-    #load data
-    data= load_data()
-
-    #check if patient id exist or not
-
-    if patient_id not in data:
+async def delete_patient(patient_id: str,
+                   if_match: Optional[str] = Header(default=None, description="Only delete if the patient still has this ETag")):
+    #delete the patient, the store tells us if the id does not exist
+    try:
+        await executor.run(telemetry.timed('storage_write', store.delete), patient_id, if_match=parse_if_match(if_match))
+    except KeyError:
         raise HTTPException(status_code=404, detail='Patient not found!')
-    
-    del data[patient_id]
-
-    save_data(data)
-
-    return JSONResponse(status_code=200, content={'message' : 'patient deleted'})
-
+    except PreconditionFailed:
+        raise HTTPException(status_code=412, detail='Patient was modified by another request')
+
+    return FastJSONResponse(status_code=200, content={'message' : 'patient deleted'})
+
+
+@app.post('/import', status_code=201, openapi_extra={'requestBody': {'required': True, 'content': {
+    'text/csv': {'schema': {'type': 'string'}},
+    'application/x-ndjson': {'schema': {'type': 'string'}}}}})
+async def bulk_import(request: Request, overwrite: bool = Query(False, description="Replace patients that already exist")):
+    #CSV (id,name,city,age,gender,height,weight) or NDJSON, written in one transaction
+    content_type = request.headers.get('content-type', '')
+    if row_format(content_type) is None:
+        raise HTTPException(status_code=415, detail="Body must be CSV (text/csv) or NDJSON (application/x-ndjson)")
+    body = await request.body()
+    try:
+        rows = await executor.run(telemetry.timed('parse', parse_rows), body, content_type)
+    except ValueError as e:
+        #not UTF-8, or a malformed CSV/NDJSON line
+        raise HTTPException(status_code=400, detail=f'Body could not be parsed: {e}')
+
+    try:
+        imported = await executor.run(telemetry.timed('storage_write', import_patients), store, rows, overwrite)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=e.args[0])
+    except KeyError as e:
+        raise HTTPException(status_code=409, detail={'message': 'Patients already exist', 'ids': e.args[0][:20]})
+
+    return {'message': 'Patients imported successfully', 'imported': imported}
+
+@app.post('/maintenance/recompute')
+async def recompute_patients():
+    #bring stored bmi/verdict values back in line with the current Patient logic
+    return {'message': 'Derived fields recomputed', 'updated': await executor.run(telemetry.timed('storage_write', recompute_derived), store)}
@@ -0,0 +1,401 @@
+"""Throughput, latency percentiles and peak RSS per endpoint for the three apps.
+
+Every endpoint of main.py, PutDelete.py and Deploy_ML_Model/app.py is driven
+for ``--duration`` seconds (or ``--requests`` requests), either in-process
+through the ASGI transport of httpx or against a local uvicorn server. The
+patient apps run on synthetic stores of each ``--sizes`` entry; the ML app is
+sent synthetic applicants sampled from the per-column distributions of
+insurance.csv. Each (app, mode, size) runs in a fresh process, so peak RSS
+is that process's high-water mark while the endpoint ran: the worker process
+in-process (app and client together), the uvicorn processes otherwise.
+With ``--workers N`` uvicorn runs N workers on one shared patient store
+(PATIENT_STORE_SHARED=1) and peak RSS is summed over all of them.
+
+Results are written as JSON; ``--baseline`` compares them with an earlier
+run, lists the endpoints whose throughput or p99 got worse and exits with
+status 1 if there are any.
+
+Run from the repository root:
+
+    python benchmarks/bench_api.py --sizes 1000,100000 --output bench.json
+    python benchmarks/bench_api.py --apps ml --modes uvicorn --baseline bench.json
+    python benchmarks/bench_api.py --apps PutDelete --modes uvicorn --workers 4
+"""
+import argparse
+import asyncio
+import csv
+import importlib
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ML_DIR = os.path.join(ROOT, 'Deploy_ML_Model')
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from json_codec import dumps
+from load_patient_api import CITIES, free_port, make_patients, percentile
+
+#app name -> (directory it is imported from, module)
+APPS = {'main': (ROOT, 'main'), 'PutDelete': (ROOT, 'PutDelete'), 'ml': (ML_DIR, 'app')}
+#app name -> URL that answers 200 once the app can serve (the ML app loads its model in the background)
+READY_URLS = {'main': '/openapi.json', 'PutDelete': '/openapi.json', 'ml': '/ready'}
+
+
+class ApplicantSampler:
+    """Synthetic /predict inputs drawn column by column from insurance.csv.
+
+    Numeric columns are normal with the column's mean and standard deviation,
+    clipped to the observed range; categorical columns follow the observed
+    frequencies. Columns are sampled independently of each other, and
+    samples ``accept`` turns down are drawn again.
+    """
+
+    NUMERIC = {'age': int, 'weight': float, 'height': float, 'income_lpa': float}
+    CATEGORICAL = ('smoker', 'city', 'occupation')
+
+    def __init__(self, path=os.path.join(ML_DIR, 'insurance.csv'), accept=None):
+        self.accept = accept
+        with open(path, newline='') as f:
+            rows = list(csv.DictReader(f))
+        self.numeric = {}
+        for column in self.NUMERIC:
+            values = [float(row[column]) for row in rows]
+            self.numeric[column] = (statistics.fmean(values), statistics.pstdev(values), min(values), max(values))
+        self.categorical = {column: Counter(row[column] for row in rows) for column in self.CATEGORICAL}
+
+    def sample(self, rng):
+        while True:
+            applicant = self._draw(rng)
+            if self.accept is None or self.accept(applicant):
+                return applicant
+
+    def _draw(self, rng):
+        applicant = {}
+        for column, cast in self.NUMERIC.items():
+            mean, std, low, high = self.numeric[column]
+            value = min(max(rng.gauss(mean, std), low), high)
+            applicant[column] = round(value) if cast is int else round(value, 2)
+        for column, counts in self.categorical.items():
+            applicant[column] = rng.choices(list(counts), weights=list(counts.values()))[0]
+        applicant['smoker'] = applicant['smoker'] == 'True'
+        return applicant
+
+
+#model.pkl was trained without the 'Low' lifestyle risk (non-smoker, bmi <= 27) and rejects it
+def scorable(applicant):
+    return applicant['smoker'] or applicant['weight'] / applicant['height'] ** 2 > 27
+
+
+#(name, method, url(rng, ctx), body(rng, ctx) or None), an endpoint is done early when url returns None
+#ctx holds the store size, the ids created so far and the applicant sampler
+def random_id(rng, ctx):
+    return f'P{rng.randrange(ctx["patients"]):07d}'
+
+def new_patient(rng, ctx):
+    ctx['created'].append(f'B{len(ctx["created"]) + ctx["deleted"]:07d}')
+    patient = make_patients(1, seed=rng.random())['P0000000']
+    return {'id': ctx['created'][-1], **{key: patient[key] for key in ('name', 'city', 'age', 'gender', 'height', 'weight')}}
+
+def delete_url(rng, ctx):
+    #delete what /create added, so the store size stays the same; stops once it is all gone
+    if not ctx['created']:
+        return None
+    ctx['deleted'] += 1
+    return f'/delete/{ctx["created"].pop()}'
+
+READ_ENDPOINTS = [
+    ('GET /about', 'GET', lambda rng, ctx: '/about', None),
+    ('GET /patient/{id}', 'GET', lambda rng, ctx: f'/patient/{random_id(rng, ctx)}', None),
+    ('GET /view?limit=100', 'GET', lambda rng, ctx: '/view?limit=100', None),
+    ('GET /view?limit=1000&cursor={id}', 'GET', lambda rng, ctx: f'/view?limit=1000&cursor={random_id(rng, ctx)}', None),
+    ('GET /view', 'GET', lambda rng, ctx: '/view', None),
+    ('GET /view?stream=ndjson', 'GET', lambda rng, ctx: '/view?stream=ndjson', None),
+    ('GET /sort?sort_by=bmi&limit=100', 'GET', lambda rng, ctx: '/sort?sort_by=bmi&order=desc&limit=100', None),
+    ('GET /patients/search?city&age', 'GET',
+     lambda rng, ctx: f'/patients/search?city={rng.choice(CITIES)}&min_age=30&max_age=40&limit=100', None),
+    ('GET /patients/stats', 'GET', lambda rng, ctx: '/patients/stats', None),
+    ('GET /patients/stats?group_by=city', 'GET', lambda rng, ctx: '/patients/stats?group_by=city', None),
+    ('GET /patients/stats?group_by=age', 'GET', lambda rng, ctx: '/patients/stats?group_by=age', None),
+]
+
+WRITE_ENDPOINTS = [
+    ('POST /create', 'POST', lambda rng, ctx: '/create', new_patient),
+    ('PUT /edit/{id}', 'PUT', lambda rng, ctx: f'/edit/{random_id(rng, ctx)}',
+     lambda rng, ctx: {'weight': round(rng.uniform(40, 120), 1)}),
+    ('DELETE /delete/{id}', 'DELETE', delete_url, None),
+]
+
+ML_ENDPOINTS = [
+    ('POST /predict', 'POST', lambda rng, ctx: '/predict', lambda rng, ctx: ctx['applicants'].sample(rng)),
+    ('POST /predict/batch (100)', 'POST', lambda rng, ctx: '/predict/batch',
+     lambda rng, ctx: [ctx['applicants'].sample(rng) for _ in range(100)]),
+    ('POST /predict (details)', 'POST', lambda rng, ctx: '/predict?probabilities=true&contributions=true',
+     lambda rng, ctx: ctx['applicants'].sample(rng)),
+    ('POST /predict/batch (100, details)', 'POST', lambda rng, ctx: '/predict/batch?probabilities=true&contributions=true',
+     lambda rng, ctx: [ctx['applicants'].sample(rng) for _ in range(100)]),
+    ('GET /models', 'GET', lambda rng, ctx: '/models', None),
+]
+
+ENDPOINTS = {'main': READ_ENDPOINTS, 'PutDelete': READ_ENDPOINTS + WRITE_ENDPOINTS, 'ml': ML_ENDPOINTS}
+
+
+#a process and its descendants, e.g. uvicorn and its --workers
+def process_tree(pid):
+    pids = [pid]
+    for parent in pids:
+        try:
+            for task in os.listdir(f'/proc/{parent}/task'):
+                with open(f'/proc/{parent}/task/{task}/children') as f:
+                    pids += [int(child) for child in f.read().split()]
+        except OSError:
+            pass
+    return pids
+
+#peak RSS (VmHWM) of a process tree in MB, and resetting it (Linux only, None/no-op elsewhere)
+def peak_rss_mb(pid):
+    total = None
+    for tree_pid in process_tree(pid):
+        try:
+            with open(f'/proc/{tree_pid}/status') as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        total = (total or 0) + int(line.split()[1]) / 1024
+        except OSError:
+            pass
+    return total
+
+def reset_peak_rss(pid):
+    for tree_pid in process_tree(pid):
+        try:
+            with open(f'/proc/{tree_pid}/clear_refs', 'w') as f:
+                f.write('5')
+        except OSError:
+            pass
+
+
+async def run_endpoint(http, endpoint, ctx, args, concurrency, pid):
+    name, method, url, body = endpoint
+    rng = random.Random(args.seed)
+    latencies, statuses = [], Counter()
+    reset_peak_rss(pid)
+    stop_at = time.monotonic() + args.duration
+    budget = [args.requests]
+
+    async def client():
+        while time.monotonic() < stop_at and budget[0] > 0:
+            budget[0] -= 1
+            target = url(rng, ctx)
+            if target is None:
+                return
+            content = dumps(body(rng, ctx)) if body is not None else None
+            start = time.perf_counter()
+            try:
+                response = await http.request(method, target, content=content,
+                                              headers={'content-type': 'application/json'} if content else None)
+                await response.aread()
+                statuses[response.status_code] += 1
+            except httpx.HTTPError as e:
+                statuses[type(e).__name__] += 1
+                continue
+            latencies.append(time.perf_counter() - start)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    total = sum(statuses.values())
+    errors = sum(count for status, count in statuses.items() if not isinstance(status, int) or status >= 400)
+    return {'requests': total, 'errors': errors, 'statuses': {str(status): count for status, count in statuses.items()},
+            'requests_per_s': total / elapsed, 'p50_ms': percentile(latencies, 0.5),
+            'p95_ms': percentile(latencies, 0.95), 'p99_ms': percentile(latencies, 0.99),
+            'peak_rss_mb': peak_rss_mb(pid)}
+
+
+async def run_endpoints(http, app_name, patients, args, concurrency, pid):
+    ctx = {'patients': patients, 'created': [], 'deleted': 0, 'applicants': ApplicantSampler(accept=scorable)}
+    report = {}
+    for endpoint in ENDPOINTS[app_name]:
+        report[endpoint[0]] = stats = await run_endpoint(http, endpoint, ctx, args, concurrency, pid)
+        print(f"  {endpoint[0]:<36} {stats['requests_per_s']:>9.1f} req/s   p50 {stats['p50_ms'] or 0:>8.2f} ms   "
+              f"p95 {stats['p95_ms'] or 0:>8.2f} ms   p99 {stats['p99_ms'] or 0:>8.2f} ms   "
+              f"rss {stats['peak_rss_mb'] or 0:>7.0f} MB   errors {stats['errors']}", file=sys.stderr)
+    return report
+
+
+def app_env(args, store_path, workers=1):
+    env = {**os.environ, 'RESPONSE_CACHE_BYTES': str(args.response_cache_bytes)} \
+        if args.response_cache_bytes is not None else dict(os.environ)
+    if store_path is not None:
+        env['PATIENT_STORE'] = store_path
+    if workers > 1:
+        env['PATIENT_STORE_SHARED'] = '1'
+    #the ML app picks up telemetry.py from the repository root when it is importable
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, (ROOT, env.get('PYTHONPATH'))))
+    return env
+
+
+#in-process: this script re-runs itself as a worker that imports the app and calls it through httpx.ASGITransport
+async def in_process_worker(args):
+    app_dir, module_name = APPS[args.worker]
+    sys.path.insert(0, app_dir)
+    started = time.perf_counter()
+    app = importlib.import_module(module_name).app
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app, raise_app_exceptions=False)
+        async with httpx.AsyncClient(transport=transport, base_url='http://bench', timeout=None) as http:
+            while (await http.get(READY_URLS[args.worker])).status_code != 200:
+                await asyncio.sleep(0.01)
+            startup = {'startup_s': time.perf_counter() - started, 'rss_after_startup_mb': peak_rss_mb(os.getpid())}
+            endpoints = await run_endpoints(http, args.worker, args.worker_patients, args, args.in_process_concurrency,
+                                            os.getpid())
+    return {**startup, 'endpoints': endpoints}
+
+def run_in_process(app_name, patients, store_path, args, argv):
+    command = [sys.executable, os.path.abspath(__file__), *argv, '--worker', app_name,
+               '--worker-patients', str(patients or 0)]
+    result = subprocess.run(command, env=app_env(args, store_path), stdout=subprocess.PIPE, check=True)
+    return json.loads(result.stdout)
+
+
+def run_uvicorn(app_name, patients, store_path, args):
+    app_dir, module_name = APPS[app_name]
+    port = free_port()
+    started = time.perf_counter()
+    server = subprocess.Popen([sys.executable, '-m', 'uvicorn', f'{module_name}:app', '--app-dir', app_dir,
+                               '--port', str(port), '--workers', str(args.workers), '--log-level', 'warning'],
+                              cwd=app_dir, env=app_env(args, store_path, args.workers))
+    try:
+        base_url = f'http://127.0.0.1:{port}'
+        for _ in range(3000):
+            try:
+                if httpx.get(base_url + READY_URLS[app_name], timeout=1).status_code == 200:
+                    break
+                time.sleep(0.01)
+            except httpx.HTTPError:
+                if server.poll() is not None:
+                    raise RuntimeError(f'uvicorn exited with {server.returncode}')
+                time.sleep(0.1)
+        startup = {'startup_s': time.perf_counter() - started, 'rss_after_startup_mb': peak_rss_mb(server.pid)}
+
+        async def load():
+            limits = httpx.Limits(max_connections=args.concurrency)
+            async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=300) as http:
+                return await run_endpoints(http, app_name, patients, args, args.concurrency, server.pid)
+
+        return {**startup, 'endpoints': asyncio.run(load())}
+    finally:
+        server.terminate()
+        server.wait()
+
+
+#a fresh copy of the dataset for every run, writes of one run must not leak into the next
+def prepare_store(dataset, workdir, backend):
+    if backend == 'sqlite':
+        from sqlite_store import migrate
+        db_path = os.path.join(workdir, 'patients.db')
+        migrate(dataset, db_path)
+        return f'sqlite:///{db_path}'
+    path = os.path.join(workdir, 'patients.json')
+    shutil.copy(dataset, path)
+    return path
+
+
+def compare(results, baseline, tolerance):
+    old = {(run['app'], run['mode'], run['patients'], run.get('workers', 1), name): stats
+           for run in baseline['runs'] for name, stats in run['endpoints'].items()}
+    regressions = []
+    for run in results['runs']:
+        for name, stats in run['endpoints'].items():
+            before = old.get((run['app'], run['mode'], run['patients'], run['workers'], name))
+            if before is None or not before['requests_per_s'] or not before['p99_ms'] or not stats['p99_ms']:
+                continue
+            throughput = stats['requests_per_s'] / before['requests_per_s']
+            p99 = stats['p99_ms'] / before['p99_ms']
+            if throughput < 1 - tolerance or p99 > 1 + tolerance:
+                regressions.append(f"{run['app']} {run['mode']} {run['patients']} {name}: "
+                                   f"throughput x{throughput:.2f}, p99 x{p99:.2f}")
+    print(f'{len(regressions)} regressions beyond {tolerance:.0%} against the baseline')
+    for line in regressions:
+        print('  ' + line)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--apps', default='main,PutDelete,ml', help='comma separated: main, PutDelete, ml')
+    parser.add_argument('--modes', default='in-process,uvicorn', help='comma separated: in-process, uvicorn')
+    parser.add_argument('--sizes', default='1000,100000,1000000', help='patients in the store, comma separated')
+    parser.add_argument('--backend', default='json', choices=['json', 'sqlite'])
+    parser.add_argument('--duration', type=float, default=5, help='seconds per endpoint')
+    parser.add_argument('--requests', type=int, default=100000, help='maximum requests per endpoint')
+    parser.add_argument('--concurrency', type=int, default=16, help='concurrent clients against uvicorn')
+    parser.add_argument('--workers', type=int, default=1, help='uvicorn worker processes, sharing the patient store')
+    parser.add_argument('--in-process-concurrency', type=int, default=1, help='concurrent clients in-process')
+    parser.add_argument('--response-cache-bytes', type=int, help='RESPONSE_CACHE_BYTES for the patient apps, 0 turns it off')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    parser.add_argument('--baseline', help='results JSON of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='relative change that counts as a regression')
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    parser.add_argument('--worker-patients', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(asyncio.run(in_process_worker(args))))
+        return
+
+    #options the in-process workers need, passed on unchanged
+    argv = ['--duration', str(args.duration), '--requests', str(args.requests), '--seed', str(args.seed),
+            '--in-process-concurrency', str(args.in_process_concurrency)]
+    apps = args.apps.split(',')
+    modes = args.modes.split(',')
+    sizes = [int(size) for size in args.sizes.split(',')]
+    commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+    results = {'meta': {'commit': commit or None, 'python': platform.python_version(), 'platform': platform.platform(),
+                        'cpus': os.cpu_count(), 'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                        'options': {key: value for key, value in vars(args).items() if not key.startswith('worker')}},
+               'runs': []}
+
+    with tempfile.TemporaryDirectory() as datadir:
+        datasets = {}
+        for app_name in apps:
+            for patients in (sizes if app_name != 'ml' else [None]):
+                if patients is not None and patients not in datasets:
+                    datasets[patients] = os.path.join(datadir, f'patients-{patients}.json')
+                    with open(datasets[patients], 'wb') as f:
+                        f.write(dumps(make_patients(patients, seed=args.seed)))
+                for mode in modes:
+                    print(f"{app_name} {mode}" + (f" {patients} patients" if patients else ''), file=sys.stderr)
+                    with tempfile.TemporaryDirectory() as workdir:
+                        store_path = prepare_store(datasets[patients], workdir, args.backend) if patients else None
+                        if mode == 'in-process':
+                            run = run_in_process(app_name, patients, store_path, args, argv)
+                        else:
+                            run = run_uvicorn(app_name, patients, store_path, args)
+                    workers = args.workers if mode == 'uvicorn' else 1
+                    results['runs'].append({'app': app_name, 'mode': mode, 'patients': patients, 'workers': workers, **run})
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        #non-zero exit, so a CI job running against a baseline fails on a regression
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
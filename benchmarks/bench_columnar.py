@@ -0,0 +1,95 @@
+"""Startup time, memory and read latency of the JSON store vs a columnar snapshot.
+
+Writes N synthetic patients as patients.json and as a columnar snapshot in a
+temporary directory, then opens each in a fresh process and times the reads
+main.py serves.
+
+Run from the repository root:
+
+    python benchmarks/bench_columnar.py --patients 1000000
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from json_codec import dumps
+from load_patient_api import make_patients
+
+READS = {
+    'get': lambda store: store.get('P0000042'),
+    'page 100': lambda store: store.page(100, 'P0000500'),
+    'sorted page 100': lambda store: store.sorted_page('bmi', descending=True, limit=100),
+    'search city+age': lambda store: store.search({'city': 'Pune'}, {'age': (30, 40)}, 'weight', limit=100),
+    'search bmi range': lambda store: store.search({}, {'bmi': (20, 20.5)}, limit=100),
+}
+
+
+def rss_mb():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+
+
+def worker(uri):
+    #one backend in a fresh process, so import and page cache state do not leak between them
+    from patient_store import open_store
+    before = rss_mb()
+    start = time.perf_counter()
+    store = open_store(uri, read_only=True)
+    result = {'open_s': time.perf_counter() - start, 'rss_mb': rss_mb() - before}
+    for name, read in READS.items():
+        result[name] = min(timeit.repeat(lambda: read(store), number=5, repeat=3)) / 5
+    start = time.perf_counter()
+    store.stats()
+    result['first stats'] = time.perf_counter() - start
+    result['rss_after_reads_mb'] = rss_mb() - before
+    store.close()
+    print(json.dumps(result))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--patients', type=int, default=100000)
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.worker:
+        return worker(args.worker)
+
+    from columnar_store import write_snapshot
+    with tempfile.TemporaryDirectory() as tmp:
+        patients = make_patients(args.patients)
+        json_path, columns_path = os.path.join(tmp, 'patients.json'), os.path.join(tmp, 'patients.cols')
+        with open(json_path, 'wb') as f:
+            f.write(dumps(patients))
+        start = time.perf_counter()
+        write_snapshot(patients, columns_path)
+        print(f'{args.patients} patients, conversion {time.perf_counter() - start:.1f} s, '
+              f'patients.json {os.path.getsize(json_path) / 2**20:.1f} MB, '
+              f'columnar {os.path.getsize(columns_path) / 2**20:.1f} MB')
+        del patients
+
+        results = {}
+        for label, uri in (('json', json_path), ('columnar', f'columns:///{columns_path}')):
+            output = subprocess.run([sys.executable, os.path.abspath(__file__), '--worker', uri],
+                                    check=True, capture_output=True, text=True).stdout
+            results[label] = json.loads(output.splitlines()[-1])
+
+    json_result, columnar_result = results['json'], results['columnar']
+    print(f"{'open':<18} json {json_result['open_s'] * 1000:>10.1f} ms   columnar {columnar_result['open_s'] * 1000:>10.1f} ms")
+    print(f"{'rss after open':<18} json {json_result['rss_mb']:>10.1f} MB   columnar {columnar_result['rss_mb']:>10.1f} MB")
+    for name in (*READS, 'first stats'):
+        print(f"{name:<18} json {json_result[name] * 1000:>10.3f} ms   columnar {columnar_result[name] * 1000:>10.3f} ms")
+    print(f"{'rss after reads':<18} json {json_result['rss_after_reads_mb']:>10.1f} MB   "
+          f"columnar {columnar_result['rss_after_reads_mb']:>10.1f} MB")
+
+
+if __name__ == '__main__':
+    main()
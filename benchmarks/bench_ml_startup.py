@@ -0,0 +1,139 @@
+"""Cold start time and per-worker memory of the prediction service, pickled vs exported model.
+
+For model.pkl and an exported model.joblib (written to a temporary
+directory with model_runtime.export_model):
+
+- cold start: a fresh process imports Deploy_ML_Model/app.py and loads,
+  compiles and warms up the model, timed per step, best of --repeat runs;
+- workers: uvicorn --workers N serving the app, time until /ready answers
+  200 and the RSS and PSS (resident memory with shared pages split between
+  the processes sharing them) of every worker. Linux only.
+
+Run from the repository root:
+
+    python benchmarks/bench_ml_startup.py --workers 4
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ML_DIR = os.path.join(ROOT, 'Deploy_ML_Model')
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_api import process_tree
+from load_patient_api import free_port
+
+#run in a fresh interpreter, prints one JSON line
+COLD_START = '''
+import json, sys, time
+start = time.perf_counter()
+sys.path.insert(0, {ml_dir!r})
+import app
+imported = time.perf_counter()
+app.startup.run()
+ready = time.perf_counter()
+with open('/proc/self/status') as f:
+    rss = next(int(line.split()[1]) / 1024 for line in f if line.startswith('VmRSS:'))
+print(json.dumps({{'import_s': imported - start, 'load_s': ready - imported, 'total_s': ready - start, 'rss_mb': rss,
+                  'status': app.startup.state, 'pandas_imported': 'pandas' in sys.modules,
+                  'sklearn_imported': 'sklearn' in sys.modules}}))
+'''
+
+
+def memory_mb(pid):
+    #(RSS, PSS) in MB from smaps_rollup
+    values = {}
+    with open(f'/proc/{pid}/smaps_rollup') as f:
+        for line in f:
+            key, _, rest = line.partition(':')
+            if key in ('Rss', 'Pss'):
+                values[key] = int(rest.split()[0]) / 1024
+    return values.get('Rss'), values.get('Pss')
+
+
+#uvicorn --workers also starts multiprocessing's resource tracker, which is not a worker
+def is_resource_tracker(pid):
+    try:
+        with open(f'/proc/{pid}/cmdline', 'rb') as f:
+            return b'resource_tracker' in f.read()
+    except OSError:
+        return False
+
+
+def cold_start(model_path, repeat):
+    runs = []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, '-W', 'ignore', '-c', COLD_START.format(ml_dir=ML_DIR)],
+                                env={**os.environ, 'MODEL_PATH': model_path}, check=True,
+                                capture_output=True, text=True).stdout
+        runs.append(json.loads(output.splitlines()[-1]))
+    return min(runs, key=lambda run: run['total_s'])
+
+
+def serve(model_path, workers):
+    port = free_port()
+    started = time.perf_counter()
+    server = subprocess.Popen([sys.executable, '-W', 'ignore', '-m', 'uvicorn', 'app:app', '--app-dir', ML_DIR,
+                               '--port', str(port), '--workers', str(workers), '--log-level', 'warning'],
+                              cwd=ML_DIR, env={**os.environ, 'MODEL_PATH': model_path})
+    try:
+        ready_s = None
+        while time.perf_counter() - started < 120:
+            try:
+                if httpx.get(f'http://127.0.0.1:{port}/ready', timeout=1).status_code == 200:
+                    ready_s = time.perf_counter() - started
+                    break
+            except httpx.HTTPError:
+                if server.poll() is not None:
+                    raise RuntimeError(f'uvicorn exited with {server.returncode}')
+            time.sleep(0.01)
+        #every worker loads on its own; give the others time to finish before measuring
+        time.sleep(2)
+        worker_pids = [pid for pid in process_tree(server.pid) if pid != server.pid and not is_resource_tracker(pid)]
+        if workers == 1:
+            worker_pids = [server.pid]
+        memory = [memory_mb(pid) for pid in worker_pids]
+        memory = [(rss, pss) for rss, pss in memory if rss]
+        return {'ready_s': ready_s, 'workers': len(memory),
+                'rss_mb': [round(rss, 1) for rss, _ in memory], 'pss_mb': [round(pss, 1) for _, pss in memory]}
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        exported = os.path.join(tmp, 'model.joblib')
+        subprocess.run([sys.executable, '-W', 'ignore', os.path.join(ML_DIR, 'model_runtime.py'), '--export', exported],
+                       cwd=ML_DIR, check=True, capture_output=True)
+        results = {}
+        for label, model_path in (('pickle', os.path.join(ML_DIR, 'model.pkl')), ('joblib', exported)):
+            results[label] = {'cold_start': cold_start(model_path, args.repeat), 'serve': serve(model_path, args.workers)}
+
+    for label, result in results.items():
+        cold, served = result['cold_start'], result['serve']
+        print(f"{label:<7} import {cold['import_s']:.2f} s   load+warm-up {cold['load_s']:.2f} s   "
+              f"rss {cold['rss_mb']:.0f} MB   pandas {'yes' if cold['pandas_imported'] else 'no'}   "
+              f"sklearn {'yes' if cold['sklearn_imported'] else 'no'}")
+        print(f"{'':<7} uvicorn x{served['workers']}: /ready after {served['ready_s']:.2f} s   "
+              f"per-worker rss {served['rss_mb']} MB   pss {served['pss_mb']} MB")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+"""Encode/decode cost of the standard library json vs json_codec (orjson when installed).
+
+Covers a /view page of patients, the same page joined from cached record
+bytes, and writing and reading a patients.json snapshot.
+
+Run from the repository root:
+
+    python benchmarks/bench_serialization.py --patients 100000
+"""
+import argparse
+import json
+import os
+import sys
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import json_codec
+from load_patient_api import make_patients
+
+
+def bench(name, before, after, number):
+    results = {}
+    for label, fn in (('before', before), ('after', after)):
+        seconds = min(timeit.repeat(fn, number=number, repeat=3)) / number
+        results[label] = seconds
+    print(f"{name:<22} before {results['before'] * 1000:>9.3f} ms   after {results['after'] * 1000:>9.3f} ms   "
+          f"x{results['before'] / results['after']:.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--patients', type=int, default=100000)
+    parser.add_argument('--page', type=int, default=1000)
+    args = parser.parse_args()
+    print(f"json_codec backend: {'orjson' if json_codec.orjson is not None else 'json (orjson not installed)'}")
+
+    patients = make_patients(args.patients)
+    page = dict(list(patients.items())[:args.page])
+    encoded = {patient_id: json_codec.dumps(record) for patient_id, record in page.items()}
+
+    #what JSONResponse did for a page, vs orjson, vs joining cached record bytes
+    bench('page encode', lambda: json.dumps(page, ensure_ascii=False, separators=(',', ':')).encode(),
+          lambda: json_codec.dumps(page), number=200)
+    bench('page from cached bytes', lambda: json.dumps(page, ensure_ascii=False, separators=(',', ':')).encode(),
+          lambda: b'{' + b','.join(json_codec.dumps(patient_id) + b':' + data for patient_id, data in encoded.items()) + b'}',
+          number=200)
+
+    snapshot = json.dumps(patients).encode()
+    bench('snapshot write', lambda: json.dumps(patients).encode(), lambda: json_codec.dumps(patients), number=3)
+    bench('snapshot read', lambda: json.loads(snapshot), lambda: json_codec.loads(snapshot), number=3)
+    print(f"snapshot size          before {len(snapshot) / 2**20:>9.1f} MB   after {len(json_codec.dumps(patients)) / 2**20:>9.1f} MB")
+
+
+if __name__ == '__main__':
+    main()
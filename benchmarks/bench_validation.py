@@ -0,0 +1,66 @@
+"""Validations/sec for the old and the lean validation paths.
+
+Run from the repository root:
+
+    python benchmarks/bench_validation.py
+"""
+import json
+import os
+import sys
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'Deploy_ML_Model'))
+
+from patient_models import Patient, PatientUpdate, apply_patient_update
+
+PATIENT = {'id': 'P001', 'name': 'Honey', 'city': 'Guwahati', 'age': 28, 'gender': 'female', 'height': 1.65, 'weight': 90.0}
+UPDATE = {'weight': 85.5}
+USER = {'age': 30, 'weight': 90, 'height': 1.75, 'income_lpa': 10, 'smoker': False, 'city': 'Mumbai', 'occupation': 'private_job'}
+
+
+def bench(name, before, after, number=20000):
+    results = {}
+    for label, fn in (('before', before), ('after', after)):
+        seconds = min(timeit.repeat(fn, number=number, repeat=3))
+        results[label] = number / seconds
+    print(f"{name:<14} before {results['before']:>10,.0f}/s   after {results['after']:>10,.0f}/s   "
+          f"x{results['after'] / results['before']:.2f}")
+
+
+def main():
+    patient_bytes = json.dumps(PATIENT).encode()
+    update_bytes = json.dumps(UPDATE).encode()
+    stored = Patient(**PATIENT).model_dump(exclude={'id'})
+
+    #create: dict from json.loads -> model -> dump, vs validate from bytes -> dump
+    bench('Patient',
+          lambda: Patient(**json.loads(patient_bytes)).model_dump(exclude={'id'}),
+          lambda: Patient.model_validate_json(patient_bytes).model_dump(exclude={'id'}))
+
+    #edit: update model + full re-validation of the merged patient, vs changed fields only
+    def edit_before():
+        changes = PatientUpdate(**json.loads(update_bytes)).model_dump(exclude_unset=True)
+        merged = {**stored, **changes, 'id': 'P001'}
+        return Patient(**merged).model_dump(exclude='id')
+
+    def edit_after():
+        changes = PatientUpdate.model_validate_json(update_bytes).model_dump(exclude_unset=True)
+        return apply_patient_update(stored, changes)
+
+    bench('PatientUpdate', edit_before, edit_after)
+
+    try:
+        from app import UserInput
+    except ImportError as e:
+        print(f'UserInput skipped ({e})')
+        return
+    user_bytes = json.dumps(USER).encode()
+    bench('UserInput',
+          lambda: UserInput(**json.loads(user_bytes)),
+          lambda: UserInput.model_validate_json(user_bytes))
+
+
+if __name__ == '__main__':
+    main()
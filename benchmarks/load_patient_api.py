@@ -0,0 +1,164 @@
+"""Concurrent load test for the patient API served by uvicorn.
+
+Heavy clients keep the store busy while light clients call ``/about``;
+the point is how the cheap route holds up while the store is saturated,
+and how many requests are shed with 503. The default heavy load is edits,
+which wait for the write-ahead log's fsync; ``--heavy "GET /view?limit=1000"``
+loads the read path instead. ``{id}`` in the heavy route is replaced with a
+random patient id, and PUT/POST requests send a random weight as the body.
+
+Run from the repository root:
+
+    python benchmarks/load_patient_api.py --patients 100000 --duration 10
+    python benchmarks/load_patient_api.py --compare HEAD~1   #same load against an older commit
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CITIES = ['Delhi', 'Mumbai', 'Pune', 'Kolkata', 'Chennai', 'Guwahati', 'Jaipur', 'Lucknow', 'Indore', 'Bhopal']
+
+
+def make_patients(n, seed=0):
+    rng = random.Random(seed)
+    patients = {}
+    for i in range(n):
+        height = round(rng.uniform(1.4, 2.0), 2)
+        weight = round(rng.uniform(40, 120), 1)
+        bmi = round(weight / height ** 2, 2)
+        verdict = 'Underweight' if bmi < 18.5 else 'Normal' if bmi < 25 else 'Overweight' if bmi < 30 else 'Obese'
+        patients[f'P{i:07d}'] = {'name': f'Patient {i}', 'city': rng.choice(CITIES), 'age': rng.randint(1, 99),
+                                 'gender': rng.choice(['male', 'female', 'others']), 'height': height,
+                                 'weight': weight, 'bmi': bmi, 'verdict': verdict}
+    return patients
+
+
+def copy_tree(ref, target):
+    #the working tree, or the tree at a git ref
+    if ref is None:
+        for name in os.listdir(ROOT):
+            if name.endswith('.py'):
+                shutil.copy(os.path.join(ROOT, name), target)
+    else:
+        archive = subprocess.run(['git', 'archive', ref], cwd=ROOT, check=True, capture_output=True).stdout
+        subprocess.run(['tar', '-x', '-C', target], input=archive, check=True)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(p * len(values)), len(values) - 1)] * 1000 if values else None
+
+
+async def client(http, route, n_patients, stop_at, latencies, statuses):
+    method, path = route.split(' ', 1) if ' ' in route else ('GET', route)
+    rng = random.Random()
+    while time.monotonic() < stop_at:
+        url = path.replace('{id}', f'P{rng.randrange(n_patients):07d}')
+        body = {'weight': round(rng.uniform(40, 120), 1)} if method in ('PUT', 'POST') else None
+        start = time.perf_counter()
+        try:
+            response = await http.request(method, url, json=body)
+            await response.aread()
+            statuses[response.status_code] += 1
+        except httpx.HTTPError as e:
+            statuses[type(e).__name__] += 1
+            continue
+        latencies.append(time.perf_counter() - start)
+
+
+async def run_load(base_url, heavy_route, heavy_clients, light_clients, duration, n_patients):
+    limits = httpx.Limits(max_connections=heavy_clients + light_clients)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60) as http:
+        stop_at = time.monotonic() + duration
+        results = {}
+        tasks = []
+        for route, clients in ((heavy_route, heavy_clients), ('GET /about', light_clients)):
+            latencies, statuses = [], Counter()
+            results[route] = (latencies, statuses)
+            tasks += [client(http, route, n_patients, stop_at, latencies, statuses) for _ in range(clients)]
+        await asyncio.gather(*tasks)
+    report = {}
+    for route, (latencies, statuses) in results.items():
+        report[route] = {'requests_per_s': sum(statuses.values()) / duration,
+                        'statuses': {str(status): count for status, count in statuses.items()},
+                        'p50_ms': percentile(latencies, 0.5), 'p95_ms': percentile(latencies, 0.95),
+                        'p99_ms': percentile(latencies, 0.99)}
+    return report
+
+
+def serve_and_load(label, ref, args, dataset):
+    with tempfile.TemporaryDirectory() as workdir:
+        copy_tree(ref, workdir)
+        shutil.copy(dataset, os.path.join(workdir, 'patients.json'))
+        port = free_port()
+        env = {**os.environ, 'STORE_THREADS': str(args.store_threads), 'STORE_QUEUE_LIMIT': str(args.queue_limit)}
+        env.pop('PATIENT_STORE', None)
+        server = subprocess.Popen([sys.executable, '-m', 'uvicorn', f'{args.app}:app', '--port', str(port),
+                                   '--log-level', 'warning'], cwd=workdir, env=env)
+        try:
+            base_url = f'http://127.0.0.1:{port}'
+            for _ in range(600):
+                try:
+                    httpx.get(base_url + '/about', timeout=1)
+                    break
+                except httpx.HTTPError:
+                    time.sleep(0.1)
+            report = asyncio.run(run_load(base_url, args.heavy, args.heavy_clients, args.light_clients,
+                                        args.duration, args.patients))
+        finally:
+            server.terminate()
+            server.wait()
+    print(label)
+    for route, stats in report.items():
+        print(f"  {route:<32} {stats['requests_per_s']:>8.1f} req/s   p50 {stats['p50_ms'] or 0:>8.1f} ms   "
+              f"p95 {stats['p95_ms'] or 0:>8.1f} ms   p99 {stats['p99_ms'] or 0:>8.1f} ms   {stats['statuses']}")
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--app', default='PutDelete', choices=['main', 'PutDelete'])
+    parser.add_argument('--patients', type=int, default=100000)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--heavy', default='PUT /edit/{id}', help='"METHOD /path" the heavy clients call')
+    parser.add_argument('--heavy-clients', type=int, default=64)
+    parser.add_argument('--light-clients', type=int, default=4)
+    parser.add_argument('--store-threads', type=int, default=8)
+    parser.add_argument('--queue-limit', type=int, default=32)
+    parser.add_argument('--compare', metavar='REF', help='also run the same load against this git ref')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as datadir:
+        dataset = os.path.join(datadir, 'patients.json')
+        with open(dataset, 'w') as f:
+            json.dump(make_patients(args.patients), f)
+        results = {}
+        if args.compare:
+            results[args.compare] = serve_and_load(args.compare, args.compare, args, dataset)
+        results['working tree'] = serve_and_load('working tree', None, args, dataset)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
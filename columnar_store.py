@@ -0,0 +1,451 @@
+import argparse
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+from bisect import bisect_left, bisect_right
+import numpy as np
+from json_codec import dumps, loads
+from patient_index import encode_cursor
+from patient_stats import GROUP_FIELDS, INTEGER_FIELDS, NUMERIC_FIELDS, PatientStats, scan
+from patient_store import BasePatientStore, PatientStore, ReadOnlyStore, matches
+
+#file magic (format version in the last byte) and the length of the JSON header that follows it
+MAGIC = b'PATCOLS\x01'
+PREAMBLE = struct.Struct('<8sQ')
+#sections start on 64-byte boundaries, so every column is aligned for NumPy
+ALIGN = 64
+
+
+def _aligned(offset):
+    return -(-offset // ALIGN) * ALIGN
+
+#can the numeric column hold this value exactly as it was written (int for age, float for the rest)?
+def _exact(field, value):
+    return type(value) is (int if field in INTEGER_FIELDS else float)
+
+#numbers (not bools) go into the numeric columns; anything else there counts as missing
+def _number(value):
+    return type(value) in (int, float)
+
+#smallest unsigned dtype holding every category code plus the all-ones code for an absent field
+def _code_dtype(categories):
+    for dtype in ('<u1', '<u2', '<u4'):
+        if len(categories) < np.iinfo(dtype).max:
+            return dtype
+    raise ValueError('too many categories')
+
+
+def write_snapshot(patients, path):
+    """Write ``{patient_id: record}`` as a columnar snapshot, replacing ``path`` atomically.
+
+    Layout: the magic, a JSON header describing the sections, then the
+    sections themselves.
+
+    - ids: sorted, fixed-width UTF-8, so a lookup is one binary search
+    - age, height, weight, bmi: float64 columns, NaN when missing
+    - city, gender, verdict: codes into a category list, all ones when absent
+    - order_<field>: row numbers sorted by (value, id), missing values as 0
+      like the JSON store's sorted indexes
+    - rest: every other field (the name, anything unknown) as one small JSON
+      object per record, behind an offsets array. A column value that does
+      not fit its column exactly (an int weight, a bool age, a non-string
+      city) is kept here too, so records convert back unchanged.
+    """
+    ids = sorted(patients)
+    records = [patients[patient_id] for patient_id in ids]
+    count = len(ids)
+    encoded_ids = [patient_id.encode() for patient_id in ids]
+    if any(patient_id.endswith(b'\0') for patient_id in encoded_ids):
+        raise ValueError('patient ids cannot end in a NUL character')
+    width = max(map(len, encoded_ids), default=1)
+    #key order of the records as written, used when materializing them
+    fields = list(dict.fromkeys(field for record in records for field in record))
+
+    rest = [{} for _ in range(count)]
+    sections = {'ids': np.array(encoded_ids, dtype=f'S{width}') if count else np.zeros(0, dtype='S1')}
+    categorical = {}
+    for field in NUMERIC_FIELDS:
+        column = np.full(count, math.nan)
+        for row, record in enumerate(records):
+            if field in record:
+                value = record[field]
+                if _number(value):
+                    column[row] = value
+                if not _exact(field, value):
+                    rest[row][field] = value
+        sections[field] = column
+        sections[f'order_{field}'] = np.lexsort((np.arange(count), np.where(np.isnan(column), 0.0, column))).astype('<u4')
+    for field in GROUP_FIELDS:
+        codes = {}
+        for record in records:
+            value = record.get(field)
+            if value is None or type(value) is str:
+                codes.setdefault(value, len(codes))
+        categories = list(codes)
+        dtype = _code_dtype(categories)
+        absent = np.iinfo(dtype).max
+        column = np.full(count, absent, dtype=dtype)
+        for row, record in enumerate(records):
+            if field in record:
+                value = record[field]
+                if value is None or type(value) is str:
+                    column[row] = codes[value]
+                else:
+                    rest[row][field] = value
+        sections[field] = column
+        categorical[field] = categories
+    for row, record in enumerate(records):
+        for field, value in record.items():
+            if field not in NUMERIC_FIELDS and field not in GROUP_FIELDS:
+                rest[row][field] = value
+    blobs = [dumps(extra) if extra else b'' for extra in rest]
+    sections['rest_offsets'] = np.concatenate(([0], np.cumsum([len(blob) for blob in blobs], dtype=np.uint64))).astype('<u8')
+    sections['rest'] = np.frombuffer(b''.join(blobs), dtype=np.uint8)
+
+    layout, offset = {}, 0
+    for name, array in sections.items():
+        offset = _aligned(offset)
+        layout[name] = {'offset': offset, 'dtype': array.dtype.str, 'count': len(array)}
+        offset += array.nbytes
+    header = dumps({'count': count, 'epoch': os.urandom(4).hex(), 'fields': fields,
+                    'categories': categorical, 'sections': layout})
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(PREAMBLE.pack(MAGIC, len(header)) + header)
+        start = _aligned(f.tell())
+        for name, array in sections.items():
+            f.write(b'\0' * (start + layout[name]['offset'] - f.tell()))
+            f.write(array.tobytes())
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return count
+
+
+class ColumnarSnapshot:
+    """A columnar patient snapshot (see ``write_snapshot``) opened with mmap.
+
+    Opening reads only the header; every column is a NumPy view straight
+    onto the mapped file, so nothing is parsed or copied up front and forked
+    workers share the pages. Records are only built, from their row, when
+    one is asked for.
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, size = PREAMBLE.unpack_from(self._map)
+        if magic != MAGIC:
+            raise ValueError(f'{path} is not a columnar patient snapshot')
+        header = loads(self._map[PREAMBLE.size:PREAMBLE.size + size])
+        self._start = _aligned(PREAMBLE.size + size)
+        self._layout = header['sections']
+        self.count = header['count']
+        self.epoch = header['epoch']
+        self.fields = header['fields']
+        self.ids = self._view('ids')
+        self.numeric = {field: self._view(field) for field in NUMERIC_FIELDS}
+        self.orders = {field: self._view(f'order_{field}') for field in NUMERIC_FIELDS}
+        #(codes, categories, code of an absent field) per categorical field
+        self.categorical = {}
+        for field in GROUP_FIELDS:
+            codes = self._view(field)
+            self.categorical[field] = (codes, header['categories'][field], np.iinfo(codes.dtype).max)
+        self._rest_offsets = self._view('rest_offsets')
+        self._rest = self._start + self._layout['rest']['offset']
+        self._columns = None
+
+    def _view(self, name):
+        section = self._layout[name]
+        return np.frombuffer(self._map, dtype=section['dtype'], count=section['count'], offset=self._start + section['offset'])
+
+    def __len__(self):
+        return self.count
+
+    def row(self, patient_id):
+        """Row of a patient, or None."""
+        key = patient_id.encode()
+        if key.endswith(b'\0') or len(key) > self.ids.dtype.itemsize:
+            return None
+        row = int(np.searchsorted(self.ids, key))
+        return row if row < self.count and self.ids[row] == key else None
+
+    def rows_after(self, patient_id):
+        #first row whose id sorts after patient_id
+        return int(np.searchsorted(self.ids, patient_id.encode(), side='right'))
+
+    def rows_before(self, patient_id):
+        #first row whose id does not sort before patient_id
+        return int(np.searchsorted(self.ids, patient_id.encode(), side='left'))
+
+    def patient_id(self, row):
+        return self.ids[row].decode()
+
+    def record(self, row):
+        """The record of one row, built from its columns and its JSON remainder."""
+        start, stop = int(self._rest_offsets[row]), int(self._rest_offsets[row + 1])
+        rest = loads(self._map[self._rest + start:self._rest + stop]) if stop > start else {}
+        record = {}
+        for field in self.fields:
+            if field in rest:
+                record[field] = rest[field]
+            elif field in self.numeric:
+                value = self.numeric[field][row]
+                if not math.isnan(value):
+                    record[field] = int(value) if field in INTEGER_FIELDS else float(value)
+            elif field in self.categorical:
+                codes, categories, absent = self.categorical[field]
+                code = codes[row]
+                if code != absent:
+                    record[field] = categories[code]
+        return record
+
+    def sort_key(self, field, row):
+        #(value, id) key of a row in the order of order_<field>, missing values as 0
+        value = self.numeric[field][row]
+        value = 0 if math.isnan(value) else int(value) if field in INTEGER_FIELDS and value.is_integer() else float(value)
+        return (value, self.patient_id(row))
+
+    def columns(self):
+        """The columns in patient_stats.build_columns' shape, for ``scan`` and PatientStats."""
+        if self._columns is None:
+            columns = dict(self.numeric)
+            for field, (codes, categories, absent) in self.categorical.items():
+                categories = list(categories)
+                missing = codes == absent
+                if missing.any() and None not in categories:
+                    categories.append(None)
+                codes = codes.astype(np.int64)
+                if None in categories:
+                    codes[missing] = categories.index(None)
+                columns[field] = (codes, categories)
+            self._columns = columns
+        return self._columns
+
+    def to_dict(self):
+        return {self.patient_id(row): self.record(row) for row in range(self.count)}
+
+    def close(self):
+        try:
+            self._map.close()
+        except BufferError:
+            #columns handed out are still in use; the mapping goes when they do
+            pass
+
+
+class ColumnarPatientStore(BasePatientStore):
+    """Read-only patient store served from a columnar snapshot (``write_snapshot``).
+
+    Startup maps the file instead of parsing JSON, and memory holds only the
+    pages that were touched, shared between worker processes. Lookups by id
+    are a binary search over the id column, sorted reads walk the stored
+    row orders, searches and group-bys are NumPy passes over the columns,
+    and only the records returned are materialized.
+
+    Writes raise ReadOnlyStore; edit patients.json and convert it again
+    instead. A replaced snapshot file is picked up within ``check_interval``
+    seconds, with a new version.
+    """
+
+    def __init__(self, path='patients.cols', check_interval=1.0, lock_stripes=64):
+        super().__init__(lock_stripes)
+        self.path = path
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._last_check = 0.0
+        self._open()
+
+    def _open(self):
+        self._mtime = os.stat(self.path).st_mtime_ns
+        self._snapshot = ColumnarSnapshot(self.path)
+        self._stats = None
+
+    def _current(self):
+        now = time.monotonic()
+        if now - self._last_check >= self.check_interval:
+            self._last_check = now
+            try:
+                mtime = os.stat(self.path).st_mtime_ns
+            except FileNotFoundError:
+                mtime = self._mtime
+            if mtime != self._mtime:
+                with self._lock:
+                    if os.stat(self.path).st_mtime_ns != self._mtime:
+                        #requests still reading the old snapshot keep its mapping alive
+                        self._open()
+        return self._snapshot
+
+    #read API
+    @property
+    def version(self):
+        #a snapshot never changes, a new one gets a new epoch
+        return f'{self._current().epoch}-0'
+
+    def all(self):
+        return self._current().to_dict()
+
+    def get(self, patient_id):
+        snapshot = self._current()
+        row = snapshot.row(patient_id)
+        return snapshot.record(row) if row is not None else None
+
+    def __contains__(self, patient_id):
+        return self._current().row(patient_id) is not None
+
+    def __len__(self):
+        return len(self._current())
+
+    def page(self, limit, after=None):
+        snapshot = self._current()
+        start = snapshot.rows_after(after) if after is not None else 0
+        rows = range(start, min(start + limit, snapshot.count))
+        records = {snapshot.patient_id(row): snapshot.record(row) for row in rows}
+        next_cursor = snapshot.patient_id(rows[-1]) if len(rows) == limit else None
+        return records, next_cursor
+
+    def _ordered(self, snapshot, sort_by, descending, after):
+        #rows in result order, starting just past the `after` key
+        if sort_by == 'id':
+            if not descending:
+                start = snapshot.rows_after(after[0]) if after is not None else 0
+                return np.arange(start, snapshot.count)
+            end = snapshot.rows_before(after[0]) if after is not None else snapshot.count
+            return np.arange(end - 1, -1, -1)
+        order = snapshot.orders[sort_by]
+        if after is None:
+            return order[::-1] if descending else order
+        key = lambda i: snapshot.sort_key(sort_by, order[i])
+        if not descending:
+            return order[bisect_right(range(len(order)), tuple(after), key=key):]
+        return order[:bisect_left(range(len(order)), tuple(after), key=key)][::-1]
+
+    def sorted_page(self, field, descending=False, offset=0, limit=None, after=None):
+        snapshot = self._current()
+        rows = self._ordered(snapshot, field, descending, after)
+        rows = rows[offset:offset + limit if limit is not None else None]
+        records = [snapshot.record(row) for row in rows]
+        next_cursor = encode_cursor(snapshot.sort_key(field, rows[-1])) if limit is not None and len(rows) == limit else None
+        return records, next_cursor
+
+    def _mask(self, snapshot, equals, ranges):
+        #rows passing every filter; column filters are vectorized, other fields are checked record by record
+        mask = np.ones(snapshot.count, dtype=bool)
+        for field, value in equals.items():
+            if field in snapshot.categorical:
+                codes, categories, absent = snapshot.categorical[field]
+                found = codes == categories.index(value) if value in categories else np.zeros(snapshot.count, dtype=bool)
+                if value is None:
+                    found |= codes == absent
+                mask &= found
+            else:
+                mask &= np.fromiter((matches(snapshot.record(row), {field: value}, {}) for row in range(snapshot.count)),
+                                    dtype=bool, count=snapshot.count)
+        for field, (low, high) in ranges.items():
+            if field in snapshot.numeric:
+                #NaN compares false, so patients without the field never match
+                values = snapshot.numeric[field]
+                found = ~np.isnan(values)
+                if low is not None:
+                    found &= values >= low
+                if high is not None:
+                    found &= values <= high
+                mask &= found
+            else:
+                mask &= np.fromiter((matches(snapshot.record(row), {}, {field: (low, high)}) for row in range(snapshot.count)),
+                                    dtype=bool, count=snapshot.count)
+        return mask
+
+    def search(self, equals=None, ranges=None, sort_by='id', descending=False, offset=0, limit=100, after=None):
+        snapshot = self._current()
+        rows = self._ordered(snapshot, sort_by, descending, after)
+        if equals or ranges:
+            rows = rows[self._mask(snapshot, equals or {}, ranges or {})[rows]]
+        rows = rows[offset:offset + limit if limit is not None else None]
+        results = [(snapshot.patient_id(row), snapshot.record(row)) for row in rows]
+        next_cursor = None
+        if limit is not None and len(rows) == limit:
+            last = rows[-1]
+            next_cursor = encode_cursor([snapshot.patient_id(last)] if sort_by == 'id' else snapshot.sort_key(sort_by, last))
+        return results, next_cursor
+
+    def stats(self, group_by=None):
+        snapshot = self._current()
+        if group_by and not (len(group_by) == 1 and group_by[0] in GROUP_FIELDS):
+            return {'group_by': list(group_by), 'groups': scan(snapshot.columns(), group_by)}
+        with self._lock:
+            #the population stats of a snapshot never change, so they are computed once
+            if self._stats is None or self._stats[0] is not snapshot:
+                stats = PatientStats()
+                stats.rebuild_columns(snapshot.columns())
+                self._stats = (snapshot, stats)
+            stats = self._stats[1]
+        if not group_by:
+            return stats.summary()
+        return {'group_by': list(group_by), 'groups': stats.group_summary(group_by[0])}
+
+    #write API
+    def create(self, patient_id, record):
+        raise ReadOnlyStore(self.path)
+
+    def bulk_put(self, records, overwrite=True, expected=None):
+        raise ReadOnlyStore(self.path)
+
+    def update(self, patient_id, record):
+        raise ReadOnlyStore(self.path)
+
+    def delete(self, patient_id, if_match=None):
+        raise ReadOnlyStore(self.path)
+
+    def modify(self, patient_id, change, if_match=None):
+        raise ReadOnlyStore(self.path)
+
+    def close(self):
+        self._snapshot.close()
+
+
+def to_columns(json_path, columns_path):
+    """Write a JSON store (snapshot plus its log) as a columnar snapshot."""
+    source = PatientStore(json_path, read_only=True)
+    try:
+        return write_snapshot(source.all(), columns_path)
+    finally:
+        source.close()
+
+
+def to_json(columns_path, json_path):
+    """Write a columnar snapshot back out as a patients.json snapshot."""
+    log_path = json_path + '.log'
+    if os.path.exists(log_path) and os.path.getsize(log_path):
+        #the JSON store would replay that log on top of the new snapshot
+        raise ValueError(f'{log_path} has unapplied writes; start and stop the JSON store to fold it in first')
+    snapshot = ColumnarSnapshot(columns_path)
+    try:
+        patients = snapshot.to_dict()
+    finally:
+        snapshot.close()
+    tmp_path = json_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(dumps(patients))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, json_path)
+    return len(patients)
+
+
+def is_snapshot(path):
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+if __name__ == '__main__':
+    #python columnar_store.py patients.json patients.cols, or the other way round
+    parser = argparse.ArgumentParser(description='Convert patients between a JSON store and a columnar snapshot')
+    parser.add_argument('source', help='patients.json to convert, or a columnar snapshot to convert back')
+    parser.add_argument('target', help='file to write')
+    args = parser.parse_args()
+    convert = to_json if is_snapshot(args.source) else to_columns
+    print(f'Converted {convert(args.source, args.target)} patients into {args.target}')
@@ -0,0 +1,39 @@
+import json
+from pydantic import BaseModel
+from starlette.responses import JSONResponse
+
+#orjson when it is installed, the standard library otherwise; both produce compact UTF-8 JSON bytes
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+#Pydantic models nested in a payload are written out as their dump
+def _default(obj):
+    if isinstance(obj, BaseModel):
+        return obj.model_dump()
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
+
+
+if orjson is not None:
+    def dumps(obj, sort_keys=False):
+        #non-string keys (None, numbers) are written as strings, like json.dumps does
+        option = orjson.OPT_NON_STR_KEYS | (orjson.OPT_SORT_KEYS if sort_keys else 0)
+        return orjson.dumps(obj, default=_default, option=option)
+
+    loads = orjson.loads
+else:
+    def dumps(obj, sort_keys=False):
+        return json.dumps(obj, default=_default, sort_keys=sort_keys, ensure_ascii=False, separators=(',', ':')).encode()
+
+    loads = json.loads
+
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse encoded in one pass with ``dumps``; Pydantic models are encoded by pydantic-core directly."""
+
+    def render(self, content):
+        if isinstance(content, BaseModel):
+            return content.model_dump_json().encode()
+        return dumps(content)
@@ -1,43 +1,148 @@
-from fastapi import FastAPI, Path,HTTPException, Query
-import json
+from fastapi import FastAPI, Path,HTTPException, Query, Request
+from fastapi.responses import StreamingResponse
+from typing import List, Literal, Optional
+import os
+from json_codec import FastJSONResponse
+from patient_index import decode_cursor
+from patient_store import open_store
+from response_cache import CachedReads, ResponseCache, encode_object, stream_json_object, stream_ndjson
+from store_executor import StoreExecutor, StoreOverloaded
+from telemetry import Telemetry, TelemetryMiddleware, telemetry_router
 
-app = FastAPI()
+#responses are encoded with orjson when it is installed
+app = FastAPI(default_response_class=FastJSONResponse)
 
-def load_data():
-    with open('patients.json') as f:
-        data = json.load(f)
-    return data
+#per-route latency, errors and stage timings on /metrics, and a sampling profiler under /debug/profiler
+telemetry = Telemetry()
+app.add_middleware(TelemetryMiddleware, telemetry=telemetry)
+app.include_router(telemetry_router(telemetry))
+
+#patients.json by default, PATIENT_STORE=sqlite:///patients.db for the SQLite backend
+#or PATIENT_STORE=columns:///patients.cols for a read-only columnar snapshot (python columnar_store.py patients.json patients.cols)
+#PATIENT_STORE_SHARED=1 when several workers serve the same JSON store (uvicorn --workers N, gunicorn -w N)
+#this app only reads, so it never compacts the JSON store's log under PutDelete.py, which owns it
+store = open_store(os.environ.get('PATIENT_STORE', 'patients.json'), shared=os.environ.get('PATIENT_STORE_SHARED') == '1',
+                   read_only=True)
+
+#every store call runs on this bounded pool, so handlers never block the event loop
+#STORE_THREADS workers, and past STORE_QUEUE_LIMIT running + waiting calls requests get a 503
+executor = StoreExecutor(max_workers=int(os.environ.get('STORE_THREADS', '8')),
+                         max_pending=int(os.environ.get('STORE_QUEUE_LIMIT', '64')))
+
+#encoded bodies of read endpoints, each valid for as long as its ETag is
+response_cache = ResponseCache(max_bytes=int(os.environ.get('RESPONSE_CACHE_BYTES', str(64 * 2**20))))
+telemetry.gauges('store_executor', executor.stats)
+telemetry.gauges('response_cache', response_cache.stats)
+#ETags, 304s and cached bodies of the read endpoints, shared with the other patient app
+reads = CachedReads(store, executor, response_cache, telemetry)
+
+@app.on_event('shutdown')
+def close_store():
+    executor.shutdown()
+    store.close()
+
+@app.exception_handler(StoreOverloaded)
+async def store_overloaded(request: Request, exc: StoreOverloaded):
+    return FastJSONResponse(status_code=503, content={'detail': 'Server is busy, try again shortly'}, headers={'Retry-After': '1'})
 
 @app.get("/")
-def hello():
+async def hello():
     return {'message' : 'Patient Management System API'}
 
 @app.get('/about')
-def about():
+async def about():
     return {'message' :'A fully functional API to manage patient records'}
 
 @app.get('/view')
-def view():
-    data = load_data()
-    return data
+async def view(request: Request, limit: Optional[int] = Query(None, ge=1, description="Maximum number of patients to return"),
+         cursor: Optional[str] = Query(None, description="Patient ID from the X-Next-Cursor header of the previous page"),
+         stream: Optional[Literal['json', 'ndjson']] = Query(None, description="Stream every patient as one JSON object or as NDJSON lines")):
+    #stream straight from the store, one chunk at a time
+    if stream == 'ndjson':
+        return StreamingResponse(stream_ndjson(executor.iterate(store.iter_pages(encoded=True))), media_type='application/x-ndjson')
+    if stream == 'json':
+        return StreamingResponse(stream_json_object(executor.iterate(store.iter_pages(encoded=True))), media_type='application/json')
+
+    def read_patients():
+        if limit is None and cursor is None:
+            with telemetry.stage('storage_read'):
+                patients = store.all()
+            return reads.encode_json(patients)
+        with telemetry.stage('storage_read'):
+            pairs, next_cursor = store.encoded_page(limit or 100, after=cursor)
+        with telemetry.stage('serialize'):
+            return encode_object(pairs), ({'X-Next-Cursor': next_cursor} if next_cursor is not None else {})
+    return await reads.cached_read(request, read_patients)
 
 @app.get('/patient/{patient_id}')
-def view_patient(patient_id: str = Path(..., description="The ID of the patient to retrieve", example="P001")):
-    data = load_data()
-    if patient_id in data:
-        return data[patient_id]
+async def view_patient(request: Request, patient_id: str = Path(..., description="The ID of the patient to retrieve", example="P001")):
+    #one patient's ETag only changes when that patient does, so other writes keep it cached
+    def read_patient():
+        with telemetry.stage('storage_read'):
+            data = store.encoded(patient_id)
+        return (data, {}) if data is not None else None
+    response = await reads.cached_read(request, read_patient, etag=lambda key: store.etag(patient_id))
+    if response is not None:
+        return response
     raise HTTPException(status_code=404, detail="Patient not found")   
 
 @app.get('/sort')
-def sort_patints(sort_by: str = Query(...,description=" Sort on the basis of height, weight or BMI"), order:  str = Query('asc', description="Sort order: asc or desc")):
+async def sort_patints(request: Request,
+                 sort_by: str = Query(...,description=" Sort on the basis of height, weight or BMI"), order:  str = Query('asc', description="Sort order: asc or desc"),
+                 limit: Optional[int] = Query(None, ge=1, description="Maximum number of patients to return"),
+                 offset: int = Query(0, ge=0, description="Number of patients to skip"),
+                 cursor: Optional[str] = Query(None, description="Cursor from the X-Next-Cursor header of the previous page")):
     valid_fields = ['height', 'weight', 'bmi']
     if sort_by not in valid_fields:
         raise HTTPException(status_code=400, detail=f"Invalid sort_by value. Must be one of {valid_fields}")
     if order not in ['asc', 'desc']:
         raise HTTPException(status_code=400, detail="Invalid order value. Must be 'asc' or 'desc'")
-    data = load_data()
-    sort_order = True if order == 'desc' else False
-    sorted_data = sorted(data.values(), key = lambda x: x.get(sort_by, 0), reverse= sort_order)
-    return sorted_data
+    try:
+        after = decode_cursor(cursor) if cursor is not None else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor value")
+    #walk the sorted index instead of sorting every patient
+    def read_sorted():
+        with telemetry.stage('storage_read'):
+            page = store.sorted_page(sort_by, descending=(order == 'desc'), offset=offset, limit=limit, after=after)
+        return reads.encode_json(*page)
+    return await reads.cached_read(request, read_sorted)
 
+@app.get('/patients/search')
+async def search_patients(request: Request,
+                    city: Optional[str] = Query(None, description="Only patients from this city"),
+                    gender: Optional[Literal['male', 'female', 'others']] = Query(None, description="Only patients of this gender"),
+                    verdict: Optional[str] = Query(None, description="Only patients with this BMI verdict, e.g. Obese"),
+                    min_age: Optional[int] = Query(None, ge=0), max_age: Optional[int] = Query(None, ge=0),
+                    min_bmi: Optional[float] = Query(None, ge=0), max_bmi: Optional[float] = Query(None, ge=0),
+                    min_height: Optional[float] = Query(None, ge=0), max_height: Optional[float] = Query(None, ge=0),
+                    min_weight: Optional[float] = Query(None, ge=0), max_weight: Optional[float] = Query(None, ge=0),
+                    sort_by: Literal['id', 'age', 'height', 'weight', 'bmi'] = Query('id', description="Field to order the results by"),
+                    order: Literal['asc', 'desc'] = Query('asc', description="Sort order: asc or desc"),
+                    limit: int = Query(100, ge=1, le=1000, description="Maximum number of patients to return"),
+                    offset: int = Query(0, ge=0, description="Number of patients to skip"),
+                    cursor: Optional[str] = Query(None, description="Cursor from the X-Next-Cursor header of the previous page")):
+    equals = {field: value for field, value in (('city', city), ('gender', gender), ('verdict', verdict)) if value is not None}
+    ranges = {field: bounds for field, bounds in (('age', (min_age, max_age)), ('bmi', (min_bmi, max_bmi)),
+                                                   ('height', (min_height, max_height)), ('weight', (min_weight, max_weight)))
+              if bounds != (None, None)}
+    try:
+        after = decode_cursor(cursor, length=1 if sort_by == 'id' else 2) if cursor is not None else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor value")
+    #the store answers from its indexes, only the matching page is read
+    def read_results():
+        with telemetry.stage('storage_read'):
+            results, next_cursor = store.search(equals, ranges, sort_by, descending=(order == 'desc'), offset=offset, limit=limit, after=after)
+        return reads.encode_json([{'id': patient_id, **record} for patient_id, record in results], next_cursor)
+    return await reads.cached_read(request, read_results)
 
+@app.get('/patients/stats')
+async def patient_stats(request: Request, group_by: Optional[List[Literal['city', 'gender', 'verdict', 'age', 'height', 'weight', 'bmi']]] = Query(
+        None, description="Fields to group by; numeric fields are grouped in histogram buckets")):
+    #counts, mean/std/min/max and histograms, kept up to date by the store as patients change
+    def read_stats():
+        with telemetry.stage('storage_read'):
+            stats = store.stats(group_by)
+        return reads.encode_json(stats)
+    return await reads.cached_read(request, read_stats)
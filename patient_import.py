@@ -0,0 +1,135 @@
+import argparse
+import csv
+import io
+import numpy as np
+from pydantic import TypeAdapter, ValidationError
+from json_codec import loads
+from patient_models import Patient, VERDICTS
+
+#validator for a list of patients, built once
+patient_list_adapter = TypeAdapter(list[Patient])
+
+#lookup tables for the vectorized verdict
+VERDICT_BOUNDS = np.array([upper for upper, _ in VERDICTS])
+VERDICT_LABELS = np.array([verdict for _, verdict in VERDICTS] + ['Obese'])
+
+
+def derive_fields(height, weight):
+    """BMI and verdict for whole columns at once, same results as Patient.bmi/Patient.verdict."""
+    bmi = np.round(weight / height ** 2, 2)
+    verdict = VERDICT_LABELS[np.searchsorted(VERDICT_BOUNDS, bmi, side='right')]
+    return bmi, verdict
+
+
+#'csv' or 'ndjson' for the content types an import accepts, None for anything else
+def row_format(content_type):
+    if 'csv' in content_type:
+        return 'csv'
+    if 'ndjson' in content_type or 'jsonl' in content_type:
+        return 'ndjson'
+    return None
+
+
+def parse_rows(data, content_type):
+    #CSV with a header row, or one JSON object per line, as text or UTF-8 bytes
+    #raises ValueError for an unsupported content type and for bodies that do not decode or parse
+    row_type = row_format(content_type)
+    if row_type is None:
+        raise ValueError('Content type must be CSV or NDJSON')
+    text = data.decode() if isinstance(data, bytes) else data
+    if row_type == 'csv':
+        try:
+            return list(csv.DictReader(io.StringIO(text)))
+        except csv.Error as e:
+            raise ValueError(str(e))
+    return [loads(line) for line in text.splitlines() if line.strip()]
+
+
+def validate_rows(rows, batch_size=10000, max_errors=100):
+    """Validate rows in batches; returns (patients, errors) with errors indexed by row."""
+    patients, errors = [], []
+    for start in range(0, len(rows), batch_size):
+        try:
+            patients.extend(patient_list_adapter.validate_python(rows[start:start + batch_size]))
+        except ValidationError as e:
+            for error in e.errors(include_url=False, include_context=False):
+                row, *loc = error['loc']
+                errors.append({'row': start + row, 'loc': loc, 'msg': error['msg']})
+                if len(errors) >= max_errors:
+                    return patients, errors
+    return patients, errors
+
+
+def build_records(patients):
+    #store records for validated patients, with bmi and verdict computed column-wise
+    height = np.fromiter((patient.height for patient in patients), dtype=float, count=len(patients))
+    weight = np.fromiter((patient.weight for patient in patients), dtype=float, count=len(patients))
+    bmi, verdict = derive_fields(height, weight)
+    return {
+        patient.id: {'name': patient.name, 'city': patient.city, 'age': patient.age, 'gender': patient.gender,
+                     'height': patient.height, 'weight': patient.weight, 'bmi': b, 'verdict': v}
+        for patient, b, v in zip(patients, bmi.tolist(), verdict.tolist())
+    }
+
+
+def import_patients(store, rows, overwrite=False):
+    """Validate and write ``rows`` in one transaction.
+
+    Raises ValueError with the row errors if any row is invalid, and
+    KeyError with the clashing ids if ``overwrite`` is off and some
+    patients already exist. Returns the number of patients written.
+    """
+    patients, errors = validate_rows(rows)
+    if errors:
+        raise ValueError(errors)
+    records = build_records(patients)
+    if len(records) != len(patients):
+        raise ValueError([{'row': None, 'loc': ['id'], 'msg': 'Duplicate patient ids in the import'}])
+    return store.bulk_put(records, overwrite=overwrite)
+
+
+def recompute_derived(store):
+    """Recompute bmi and verdict for every stored patient; returns how many records changed."""
+    data = store.all()
+    ids = [patient_id for patient_id, record in data.items() if 'height' in record and 'weight' in record]
+    if not ids:
+        return 0
+    height = np.array([data[patient_id]['height'] for patient_id in ids], dtype=float)
+    weight = np.array([data[patient_id]['weight'] for patient_id in ids], dtype=float)
+    bmi, verdict = derive_fields(height, weight)
+    changed = {}
+    for patient_id, b, v in zip(ids, bmi.tolist(), verdict.tolist()):
+        record = data[patient_id]
+        if record.get('bmi') != b or record.get('verdict') != v:
+            changed[patient_id] = {**record, 'bmi': b, 'verdict': v}
+    #patients edited while we were computing keep their own (fresh) values
+    return store.bulk_put(changed, expected={patient_id: data[patient_id] for patient_id in changed})
+
+
+if __name__ == '__main__':
+    #stop the API first, the store expects to be the only writer of patients.json (StoreInUse otherwise)
+    from patient_store import PatientStore
+
+    parser = argparse.ArgumentParser(description='Bulk import patients or recompute derived fields')
+    parser.add_argument('file', nargs='?', help='CSV or NDJSON file to import')
+    parser.add_argument('--store', default='patients.json', help='Patient store to write to')
+    parser.add_argument('--overwrite', action='store_true', help='Replace patients that already exist')
+    parser.add_argument('--recompute', action='store_true', help='Recompute bmi and verdict for every patient')
+    args = parser.parse_args()
+
+    store = PatientStore(args.store)
+    try:
+        if args.file:
+            with open(args.file) as f:
+                content_type = 'text/csv' if args.file.endswith('.csv') else 'application/x-ndjson'
+                rows = parse_rows(f.read(), content_type)
+            try:
+                print(f'imported {import_patients(store, rows, overwrite=args.overwrite)} patients')
+            except ValueError as e:
+                raise SystemExit(f'invalid rows: {e.args[0]}')
+            except KeyError as e:
+                raise SystemExit(f'patients already exist: {e.args[0][:20]}')
+        if args.recompute:
+            print(f'recomputed {recompute_derived(store)} patients')
+    finally:
+        store.close()
@@ -0,0 +1,132 @@
+import base64
+import json
+import math
+from bisect import bisect_left, bisect_right, insort
+
+
+class SortedIndex:
+    """Patients kept sorted by one field as a list of ``(value, patient_id)`` keys.
+
+    Inserts and removals use bisect, so they cost one binary search plus a
+    list shift. A read is a slice of the list, which costs O(log N + k) for a
+    page of k patients instead of sorting everyone. Ties on value are broken
+    by patient id.
+    """
+
+    def __init__(self, field, default=0):
+        self.field = field
+        self.default = default
+        self._keys = []
+
+    def key(self, patient_id, record):
+        return (record.get(self.field, self.default), patient_id)
+
+    def rebuild(self, data):
+        self._keys = sorted(self.key(patient_id, record) for patient_id, record in data.items())
+
+    def add(self, patient_id, record):
+        insort(self._keys, self.key(patient_id, record))
+
+    def remove(self, patient_id, record):
+        key = self.key(patient_id, record)
+        i = bisect_left(self._keys, key)
+        if i < len(self._keys) and self._keys[i] == key:
+            del self._keys[i]
+
+    def __len__(self):
+        return len(self._keys)
+
+    def between(self, low=None, high=None):
+        """Positions ``(start, stop)`` of the keys whose value lies in ``[low, high]``; either bound may be None."""
+        start = bisect_left(self._keys, (low,)) if low is not None else 0
+        #(v,) sorts before every (v, patient_id), so stop at the first value above high
+        stop = bisect_left(self._keys, (math.nextafter(high, math.inf),)) if high is not None else len(self._keys)
+        return start, max(start, stop)
+
+    def keys(self, start=0, stop=None):
+        return self._keys[start:stop]
+
+    def walk(self, descending=False, after=None):
+        """Iterate keys in order, starting just past the ``after`` key."""
+        keys = self._keys
+        if not descending:
+            start = bisect_right(keys, after) if after is not None else 0
+            return (keys[i] for i in range(start, len(keys)))
+        end = bisect_left(keys, after) if after is not None else len(keys)
+        return (keys[i] for i in range(end - 1, -1, -1))
+
+    def page(self, descending=False, offset=0, limit=None, after=None):
+        """Return up to ``limit`` keys, skipping ``offset`` keys after the ``after`` key."""
+        keys = self._keys
+        if not descending:
+            start = (bisect_right(keys, after) if after is not None else 0) + offset
+            stop = len(keys) if limit is None else start + limit
+            return keys[start:stop]
+        end = (bisect_left(keys, after) if after is not None else len(keys)) - offset
+        if end <= 0:
+            return []
+        start = 0 if limit is None else max(end - limit, 0)
+        return keys[start:end][::-1]
+
+
+class IdIndex(SortedIndex):
+    """Patient ids in sorted order, used to page through the whole store."""
+
+    def __init__(self):
+        super().__init__(field=None)
+
+    def key(self, patient_id, record):
+        return patient_id
+
+
+class HashIndex:
+    """Patient ids grouped by the exact value of one field, for equality filters.
+
+    Adding or removing a patient is one dict lookup plus a set operation, and
+    ``get`` hands back the matching ids without looking at anyone else.
+    """
+
+    def __init__(self, field):
+        self.field = field
+        self._ids = {}
+
+    def key(self, patient_id, record):
+        return record.get(self.field)
+
+    def rebuild(self, data):
+        self._ids = {}
+        for patient_id, record in data.items():
+            self.add(patient_id, record)
+
+    def add(self, patient_id, record):
+        self._ids.setdefault(self.key(patient_id, record), set()).add(patient_id)
+
+    def remove(self, patient_id, record):
+        value = self.key(patient_id, record)
+        ids = self._ids.get(value)
+        if ids is not None:
+            ids.discard(patient_id)
+            if not ids:
+                del self._ids[value]
+
+    def get(self, value):
+        return self._ids.get(value, frozenset())
+
+    def values(self):
+        return list(self._ids)
+
+
+#cursors are the last key of a page, made opaque for clients
+def encode_cursor(key):
+    return base64.urlsafe_b64encode(json.dumps(list(key)).encode()).decode()
+
+
+def decode_cursor(cursor, length=2):
+    #(value, patient_id) keys for sorted pages, (patient_id,) keys for pages in id order
+    try:
+        key = tuple(json.loads(base64.urlsafe_b64decode(cursor.encode())))
+    except (ValueError, TypeError):
+        raise ValueError(f'Invalid cursor: {cursor!r}')
+    if len(key) != length or not isinstance(key[-1], str) or (length == 2 and not isinstance(key[0], (int, float))):
+        raise ValueError(f'Invalid cursor: {cursor!r}')
+    return key
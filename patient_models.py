@@ -0,0 +1,53 @@
+from pydantic import BaseModel, Field, computed_field
+from typing import  Annotated, Literal, Optional
+
+#upper BMI bound of each verdict, anything above the last one is Obese
+VERDICTS = [(18.5, 'Underweight'), (25, 'Normal'), (30, 'Overweight')]
+
+def patient_bmi(height, weight):
+    return round(weight/(height**2),2)
+
+def bmi_verdict(bmi):
+    for upper, verdict in VERDICTS:
+        if bmi < upper:
+            return verdict
+    return 'Obese'
+
+
+class Patient(BaseModel):
+    id: Annotated[str, Field(..., description= 'ID of the patient',  examples=['P001'])]
+    name : Annotated[str, Field(..., description="name of the patient")]
+    city : Annotated[str, Field(..., description="city of the patient")]
+    age : Annotated[int, Field(..., gt=0,lt=120, description='Age of the patient')]
+    gender : Annotated[Literal['male','female','others'],Field(...,description="Gender of the patient")]
+    height : Annotated[float,Field(...,gt=0, description="Height of the patient mtrs")]
+    weight : Annotated[float, Field(...,gt=0, description="Weight of the patient in kg")]
+
+    @computed_field
+    @property
+    def bmi(self) ->float:
+        return patient_bmi(self.height, self.weight)
+    
+    @computed_field
+    @property
+    def verdict(self) -> str:
+        return bmi_verdict(self.bmi)
+
+
+#same constraints as Patient, so a validated update can be merged without re-validating the whole patient
+class PatientUpdate(BaseModel):
+    name: Annotated[Optional[str], Field(default=None)]
+    city: Annotated[Optional[str], Field(default=None)]
+    age: Annotated[Optional[int], Field(default=None, gt=0, lt=120)]
+    gender: Annotated[Optional[Literal['male', 'female', 'others']], Field(default=None)]
+    height: Annotated[Optional[float], Field(default=None, gt=0)]
+    weight: Annotated[Optional[float], Field(default=None, gt=0)]
+
+
+#merge a validated update into a stored record, only re-deriving bmi/verdict when height or weight changed
+def apply_patient_update(record, changes):
+    record = {**record, **changes}
+    if 'height' in changes or 'weight' in changes:
+        record['bmi'] = patient_bmi(record['height'], record['weight'])
+        record['verdict'] = bmi_verdict(record['bmi'])
+    return record
@@ -0,0 +1,275 @@
+import math
+from collections import Counter
+import numpy as np
+
+#numeric fields that get moments and histograms, categorical fields that get running group-bys
+NUMERIC_FIELDS = ('age', 'height', 'weight', 'bmi')
+INTEGER_FIELDS = ('age',)
+GROUP_FIELDS = ('city', 'gender', 'verdict')
+#histogram bucket width per numeric field, also used when grouping by a numeric field
+BUCKETS = {'age': 10, 'height': 0.1, 'weight': 10, 'bmi': 5}
+
+
+#bucket number of a value; the epsilon keeps 1.7 / 0.1 = 16.999... in bucket 17
+def bucket(field, value):
+    return math.floor(value / BUCKETS[field] + 1e-9)
+
+#lower bound of a bucket, as it is reported
+def bucket_label(field, number):
+    return round(number * BUCKETS[field], 6)
+
+#order group values with missing (None) values last
+def group_order(value):
+    return (value is None, value if value is not None else 0)
+
+#count/mean/std/min/max from running sums
+def summarize(count, total, squares, low, high):
+    if not count:
+        return {'count': 0, 'mean': None, 'std': None, 'min': None, 'max': None}
+    mean = total / count
+    #sums are updated by adding and subtracting, so allow for a tiny negative rounding error
+    variance = max(squares / count - mean * mean, 0.0)
+    return {'count': count, 'mean': mean, 'std': math.sqrt(variance), 'min': low, 'max': high}
+
+
+class Moments:
+    """Running count, sum and sum of squares of one numeric field.
+
+    ``add`` and ``remove`` are O(1). Min and max come from a count of each
+    distinct value; when the current min or max is removed it is recomputed
+    from those counts the next time it is read.
+    """
+
+    def __init__(self, values=None):
+        self.values = Counter(values or {})
+        self.count = sum(self.values.values())
+        self.total = sum(value * n for value, n in self.values.items())
+        self.squares = sum(value * value * n for value, n in self.values.items())
+        self._low = self._high = None
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.squares += value * value
+        self.values[value] += 1
+        if self._low is not None and value < self._low:
+            self._low = value
+        if self._high is not None and value > self._high:
+            self._high = value
+
+    def remove(self, value):
+        self.count -= 1
+        self.total -= value
+        self.squares -= value * value
+        self.values[value] -= 1
+        if not self.values[value]:
+            del self.values[value]
+            if value == self._low:
+                self._low = None
+            if value == self._high:
+                self._high = None
+        if not self.count:
+            #start from exact zeros again instead of carrying rounding error
+            self.total = self.squares = 0.0
+
+    def summary(self):
+        if self.count and self._low is None:
+            self._low = min(self.values)
+        if self.count and self._high is None:
+            self._high = max(self.values)
+        return summarize(self.count, self.total, self.squares, self._low, self._high)
+
+
+class GroupStats:
+    """Patient count plus Moments for every numeric field, for one group of patients."""
+
+    def __init__(self, count=0, values=None):
+        self.count = count
+        self.moments = {field: Moments(values[field] if values else None) for field in NUMERIC_FIELDS}
+
+    def add(self, record, sign=1):
+        self.count += sign
+        for field, moments in self.moments.items():
+            value = record.get(field)
+            if value is not None:
+                (moments.add if sign > 0 else moments.remove)(value)
+
+    def summary(self):
+        return {'count': self.count, **{field: moments.summary() for field, moments in self.moments.items()}}
+
+
+class PatientStats:
+    """Population statistics kept up to date as patients are written.
+
+    Holds the overall moments and histograms of every numeric field plus a
+    GroupStats per city, gender and verdict. It plugs into the store next to
+    its indexes (``key``/``rebuild``/``add``/``remove``), so a create, edit or
+    delete costs a constant number of counter updates and reading the stats
+    costs nothing relative to the number of patients.
+
+    Group-bys the running aggregates do not cover (several fields, or a
+    bucketed numeric field) are answered by ``scan`` over a columnar copy of
+    the store, which is built once and reused until the next write.
+    """
+
+    def __init__(self):
+        self.rebuild({})
+
+    def key(self, patient_id, record):
+        return tuple(record.get(field) for field in GROUP_FIELDS + NUMERIC_FIELDS)
+
+    def rebuild(self, data):
+        #one columnar pass instead of adding patients one by one
+        self.rebuild_columns(build_columns(data))
+
+    def rebuild_columns(self, columns):
+        #the same from columns shaped like build_columns' (e.g. a columnar snapshot's)
+        count = len(columns[NUMERIC_FIELDS[0]])
+        everyone = np.zeros(count, dtype=np.int64)
+        values = {field: value_counts(everyone, columns[field], 1, field)[0] for field in NUMERIC_FIELDS}
+        self.total = GroupStats(count, values)
+        self.histograms = {}
+        for field in NUMERIC_FIELDS:
+            histogram = self.histograms[field] = Counter()
+            for value, n in values[field].items():
+                histogram[bucket(field, value)] += n
+        self.groups = {}
+        for field in GROUP_FIELDS:
+            codes, categories = columns[field]
+            counts = np.bincount(codes, minlength=len(categories)).tolist()
+            values = {numeric: value_counts(codes, columns[numeric], len(categories), numeric) for numeric in NUMERIC_FIELDS}
+            self.groups[field] = {category: GroupStats(counts[code], {numeric: values[numeric][code] for numeric in NUMERIC_FIELDS})
+                                  for code, category in enumerate(categories)}
+        self._columns = columns
+
+    def add(self, patient_id, record, sign=1):
+        self._columns = None
+        self.total.add(record, sign)
+        for field, histogram in self.histograms.items():
+            value = record.get(field)
+            if value is not None:
+                number = bucket(field, value)
+                histogram[number] += sign
+                if not histogram[number]:
+                    del histogram[number]
+        for field, groups in self.groups.items():
+            value = record.get(field)
+            group = groups.get(value)
+            if group is None:
+                group = groups[value] = GroupStats()
+            group.add(record, sign)
+            if not group.count:
+                del groups[value]
+
+    def remove(self, patient_id, record):
+        self.add(patient_id, record, sign=-1)
+
+    def summary(self):
+        totals = self.total.summary()
+        return {
+            'count': totals.pop('count'),
+            'fields': {field: {**summary, 'histogram': {bucket_label(field, number): count for number, count
+                                                        in sorted(self.histograms[field].items())}}
+                       for field, summary in totals.items()},
+            'counts': {field: {value: group.count for value, group in sorted(groups.items(), key=lambda item: group_order(item[0]))}
+                       for field, groups in self.groups.items()}
+        }
+
+    def group_summary(self, field):
+        return [{'group': {field: value}, **group.summary()} for value, group in sorted(self.groups[field].items(), key=lambda item: group_order(item[0]))]
+
+    def columns(self, data):
+        if self._columns is None:
+            self._columns = build_columns(data)
+        return self._columns
+
+
+def build_columns(data):
+    """Columnar copy of the store: a float array per numeric field (NaN if missing)
+    and ``(codes, categories)`` per categorical field."""
+    records = list(data.values())
+    columns = {}
+    for field in NUMERIC_FIELDS:
+        values = (record.get(field) for record in records)
+        columns[field] = np.fromiter((math.nan if value is None else value for value in values), dtype=np.float64, count=len(records))
+    for field in GROUP_FIELDS:
+        categories = {}
+        codes = np.fromiter((categories.setdefault(record.get(field), len(categories)) for record in records),
+                            dtype=np.int64, count=len(records))
+        columns[field] = (codes, list(categories))
+    return columns
+
+
+def value_counts(codes, values, n_groups, field):
+    """Counter of every distinct value of a numeric column, per group code."""
+    present = ~np.isnan(values)
+    codes, values = codes[present], values[present]
+    order = np.lexsort((values, codes))
+    codes, values = codes[order], values[order]
+    result = [Counter() for _ in range(n_groups)]
+    if not len(codes):
+        return result
+    starts = np.flatnonzero(np.concatenate(([True], (codes[1:] != codes[:-1]) | (values[1:] != values[:-1]))))
+    counts = np.diff(np.append(starts, len(codes)))
+    if field in INTEGER_FIELDS:
+        values = values.astype(np.int64)
+    for code, value, n in zip(codes[starts].tolist(), values[starts].tolist(), counts.tolist()):
+        result[code][value] = n
+    return result
+
+
+def scan(columns, group_by):
+    """Group-by over the columns with NumPy: one row per non-empty group, shaped like ``group_summary``."""
+    #per-field group codes, then one combined code per patient
+    codes, labels = [], []
+    for field in group_by:
+        if field in NUMERIC_FIELDS:
+            values = columns[field]
+            present = ~np.isnan(values)
+            numbers = np.floor(np.where(present, values, 0) / BUCKETS[field] + 1e-9).astype(np.int64)
+            uniques, inverse = np.unique(numbers, return_inverse=True)
+            names = [bucket_label(field, int(number)) for number in uniques]
+            #patients without the field get their own group
+            inverse = np.where(present, inverse, len(names))
+            names.append(None)
+        else:
+            inverse, names = columns[field]
+        codes.append(inverse)
+        labels.append(names)
+    combined = np.zeros(len(codes[0]) if codes else 0, dtype=np.int64)
+    for inverse, names in zip(codes, labels):
+        combined = combined * (len(names) + 1) + inverse
+    groups, inverse = np.unique(combined, return_inverse=True)
+    counts = np.bincount(inverse, minlength=len(groups))
+
+    #count, sum, sum of squares, min and max of every numeric field per group
+    order = np.argsort(inverse, kind='stable')
+    starts = np.searchsorted(inverse[order], np.arange(len(groups)))
+    fields = {}
+    for field in NUMERIC_FIELDS:
+        values = columns[field]
+        present = ~np.isnan(values)
+        clean = np.where(present, values, 0.0)
+        n = np.bincount(inverse, weights=present, minlength=len(groups)).astype(np.int64)
+        total = np.bincount(inverse, weights=clean, minlength=len(groups))
+        squares = np.bincount(inverse, weights=clean * clean, minlength=len(groups))
+        ordered = values[order]
+        low = np.fmin.reduceat(ordered, starts) if len(groups) else ordered
+        high = np.fmax.reduceat(ordered, starts) if len(groups) else ordered
+        fields[field] = (n, total, squares, low, high)
+
+    rows = []
+    for g, code in enumerate(groups.tolist()):
+        key = {}
+        for field, names in reversed(list(zip(group_by, labels))):
+            code, index = divmod(code, len(names) + 1)
+            key[field] = names[index]
+        row = {'group': {field: key[field] for field in group_by}, 'count': int(counts[g])}
+        for field, (n, total, squares, low, high) in fields.items():
+            cast = int if field in INTEGER_FIELDS else float
+            row[field] = summarize(int(n[g]), float(total[g]), float(squares[g]),
+                                   cast(low[g]) if n[g] else None, cast(high[g]) if n[g] else None)
+        rows.append(row)
+    rows.sort(key=lambda row: tuple(group_order(row['group'][field]) for field in group_by))
+    return rows
+
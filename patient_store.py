@@ -0,0 +1,781 @@
+import hashlib
+import os
+import threading
+import time
+from contextlib import ExitStack, contextmanager, nullcontext
+from json_codec import dumps, loads
+from patient_index import HashIndex, IdIndex, SortedIndex, encode_cursor
+from patient_stats import GROUP_FIELDS, PatientStats, scan
+from store_sync import StoreInUse, StoreSync, claim
+
+#fields /sort can order by
+SORT_FIELDS = ('height', 'weight', 'bmi')
+#fields search can filter on by range (sorted indexes) and by exact value (hash indexes)
+RANGE_FIELDS = ('age', 'height', 'weight', 'bmi')
+FILTER_FIELDS = ('city', 'gender', 'verdict')
+
+
+class PreconditionFailed(Exception):
+    """Raised when a write carries an ETag that no longer matches the stored patient."""
+
+
+class ReadOnlyStore(Exception):
+    """Raised on writes to a backend that only serves reads, such as a columnar snapshot."""
+
+
+#strong ETag of a stored record
+def record_etag(record):
+    return '"' + hashlib.sha1(dumps(record, sort_keys=True)).hexdigest() + '"'
+
+#does a record pass every search filter? ranges are inclusive (low, high) pairs, None means unbounded
+def matches(record, equals, ranges):
+    for field, value in equals.items():
+        if record.get(field) != value:
+            return False
+    for field, (low, high) in ranges.items():
+        value = record.get(field)
+        if value is None or (low is not None and value < low) or (high is not None and value > high):
+            return False
+    return True
+
+#does an If-Match list (None = no precondition) allow writing over this ETag?
+def etag_matches(if_match, etag):
+    return if_match is None or '*' in if_match or etag in if_match
+
+
+class BasePatientStore:
+    """What the patient API needs from a storage backend.
+
+    Backends implement ``version``, ``get``, ``all``, ``__len__``, ``page``,
+    ``sorted_page``, ``search``, ``stats``, ``create``, ``update``, ``delete`` and ``bulk_put``;
+    the rest is shared. Missing patients raise KeyError, stale If-Match
+    ETags raise PreconditionFailed, and read-only backends raise
+    ReadOnlyStore on every write.
+    """
+
+    def __init__(self, lock_stripes=64):
+        self._patient_locks = [threading.Lock() for _ in range(lock_stripes)]
+
+    def __contains__(self, patient_id):
+        return self.get(patient_id) is not None
+
+    def etag(self, patient_id):
+        record = self.get(patient_id)
+        return record_etag(record) if record is not None else None
+
+    def encoded(self, patient_id):
+        """The patient's record as JSON bytes, or None."""
+        record = self.get(patient_id)
+        return dumps(record) if record is not None else None
+
+    def encoded_page(self, limit, after=None):
+        """Like ``page``, but as a list of ``(patient_id, JSON bytes)`` pairs."""
+        records, next_cursor = self.page(limit, after)
+        return [(patient_id, dumps(record)) for patient_id, record in records.items()], next_cursor
+
+    def iter_pages(self, chunk_size=500, encoded=False):
+        """Yield the store as ``{patient_id: record}`` pages in id order, one page in memory at a time.
+
+        With ``encoded=True`` pages are ``encoded_page`` lists of JSON bytes instead.
+        """
+        read = self.encoded_page if encoded else self.page
+        after = None
+        while True:
+            records, after = read(chunk_size, after)
+            yield records
+            if after is None:
+                return
+
+    #per-patient locking; several patients lock their stripes in index order, so writers cannot deadlock
+    @contextmanager
+    def locked(self, *patient_ids):
+        stripes = sorted({hash(patient_id) % len(self._patient_locks) for patient_id in patient_ids})
+        with ExitStack() as stack:
+            for stripe in stripes:
+                stack.enter_context(self._patient_locks[stripe])
+            yield
+
+    def modify(self, patient_id, change, if_match=None):
+        """Read-modify-write one patient while holding only that patient's lock.
+
+        ``change`` gets a copy of the stored record and returns the new one.
+        Raises KeyError if the patient does not exist and PreconditionFailed
+        if ``if_match`` (a list of ETags, or ``['*']``) does not match.
+        """
+        with self.locked(patient_id):
+            current = self.get(patient_id)
+            if current is None:
+                raise KeyError(patient_id)
+            if not etag_matches(if_match, self.etag(patient_id)):
+                raise PreconditionFailed(patient_id)
+            return self.update(patient_id, change(dict(current)))
+
+    def close(self):
+        pass
+
+
+class PatientStore(BasePatientStore):
+    """In-memory patient store backed by a JSON snapshot and a write-ahead log.
+
+    patients.json is the snapshot. Every create/edit/delete is appended as one
+    line to ``patients.json.log`` and fsync'd with group commit, so concurrent
+    writers share a single fsync. Once the log grows past ``compact_every``
+    records it is rotated and folded into a fresh snapshot on a background
+    thread. At startup the snapshot is loaded and the log is replayed on top.
+
+    Log records always carry the full record (or a delete), so replaying a log
+    more than once gives the same result. Stored records are never mutated in
+    place, only replaced.
+
+    Writers lock only the patient they touch (lock striping over ``lock_stripes``
+    locks), so edits to different patients run in parallel. Every patient has a
+    strong ETag derived from its stored content, which ``modify`` checks for
+    optimistic ``If-Match`` updates.
+
+    Sorted indexes on ``sort_fields`` and hash indexes on ``filter_fields``
+    are kept up to date on every write, so sorted reads walk an index instead
+    of sorting the whole population and searches only look at the patients
+    their most selective filter allows. Population statistics are running
+    aggregates maintained the same way.
+
+    With ``shared=True`` several processes (e.g. uvicorn or gunicorn workers)
+    can serve the same files. A StoreSync lock file (``patients.json.lock``)
+    serializes their writes. Each process tails the shared log to apply
+    the others' writes to its own copy before every read and write, so they
+    all see the same patients, versions and ETags. Reads only touch the lock
+    when something changed. Without ``shared`` one process owns the files:
+    a second writer fails with StoreInUse instead of compacting away logs
+    the first one still appends to (``patients.json.owner`` holds the
+    claim).
+
+    With ``read_only=True`` the store never writes, compacts or deletes
+    anything, so it can sit next to the process that owns the files (main.py
+    next to PutDelete.py, the converters and the SQLite migration). Writes
+    raise ReadOnlyStore. Without ``shared`` it follows the owner's log and
+    snapshot, within ``check_interval`` seconds.
+    """
+
+    def __init__(self, path='patients.json', check_interval=1.0, compact_every=10000,
+                 fsync=True, commit_delay=0.0, lock_stripes=64, sort_fields=RANGE_FIELDS,
+                 filter_fields=FILTER_FIELDS, shared=False, read_only=False):
+        self.path = path
+        self.log_path = path + '.log'
+        self.old_log_path = path + '.log.1'
+        self.check_interval = check_interval
+        self.compact_every = compact_every
+        self.fsync = fsync
+        self.commit_delay = commit_delay
+        self.read_only = read_only
+
+        super().__init__(lock_stripes)
+        self._lock = threading.RLock()
+        self._data = {}
+        self._etags = {}
+        self._encoded = {}
+        self._ids = IdIndex()
+        self._sorted = {field: SortedIndex(field) for field in sort_fields}
+        self._hashed = {field: HashIndex(field) for field in filter_fields}
+        self._stats = PatientStats()
+        self._mtime = None
+        self._last_check = 0.0
+        #bumped on every change; the epoch tells versions of different runs apart
+        self._epoch = os.urandom(4).hex()
+        self._version = 0
+
+        #group commit state
+        self._sync_cond = threading.Condition()
+        self._written = 0
+        self._synced = 0
+        self._syncing = False
+
+        #compaction state
+        self._log_records = 0
+        self._compacting = False
+
+        #multi-process state: the log generation we follow and how far we have read it
+        self._sync = StoreSync(path + '.lock') if shared else None
+        self._log = None
+        self._tail = None
+        self._log_offset = 0
+        self._generation = 0
+        self._token = None
+        #writers claim the files, exclusively unless shared; readers leave them to their owner
+        self._owner = None if read_only else claim(path + '.owner', exclusive=not shared)
+
+        with self._exclusive():
+            self._load()
+            if self.read_only:
+                if self._sync is not None:
+                    self._follow_log(self._log_offset)
+                return
+            if self._log_records and not (self._sync is not None and self._sync.compactor_alive()):
+                #fold whatever the last run left in the log into the snapshot
+                self._compact(dict(self._data), (self.old_log_path, self.log_path))
+                self._log_records = 0
+                self._log_offset = 0
+                if self._sync is not None:
+                    #processes still following the old log move on to the new one
+                    _, generation, entries, _ = self._sync.state()
+                    self._sync.publish(generation + 1, entries)
+            self._log = open(self.log_path, 'ab')
+            if self._sync is not None:
+                self._follow_log(self._log_offset)
+
+    #the lock file's exclusive lock in shared mode, nothing otherwise
+    def _exclusive(self):
+        return self._sync.locked() if self._sync is not None else nullcontext()
+
+    #snapshot + log replay
+    def _load(self):
+        try:
+            with open(self.path, 'rb') as f:
+                #the mtime of the snapshot actually read, even if it is replaced right after
+                self._mtime = os.fstat(f.fileno()).st_mtime_ns
+                self._data = loads(f.read())
+        except FileNotFoundError:
+            self._data = {}
+            self._mtime = None
+        self._etags = {}
+        self._encoded = {}
+        self._version += 1
+        for index in self._indexes():
+            index.rebuild(self._data)
+        self._log_records, _ = self._replay(self.old_log_path)
+        if self.read_only and self._sync is None:
+            #keep the log open, _refresh follows it from where this stops
+            self._open_tail()
+            self._read_tail()
+        else:
+            count, self._log_offset = self._replay(self.log_path)
+            self._log_records += count
+
+    def _replay(self, log_path):
+        #returns the number of records applied and how many bytes of the log they took
+        try:
+            f = open(log_path, 'rb')
+        except FileNotFoundError:
+            return 0, 0
+        count = 0
+        offset = 0
+        with f:
+            for line in f:
+                try:
+                    entry = loads(line)
+                except ValueError:
+                    #torn write at the tail of the log, everything after it is lost anyway
+                    break
+                self._apply(entry)
+                count += 1
+                offset += len(line)
+        return count, offset
+
+    def _apply(self, entry, index=True):
+        self._version += 1
+        if entry['op'] == 'batch':
+            #for big batches one rebuild beats many incremental index updates
+            if len(entry['ops']) <= max(1000, len(self._data) // 10):
+                for op in entry['ops']:
+                    self._apply(op)
+                return
+            stale = set()
+            for op in entry['ops']:
+                old = self._data.get(op['id'])
+                for field_index in self._indexes():
+                    if field_index not in stale and (old is None or op['op'] == 'del' or
+                            field_index.key(op['id'], old) != field_index.key(op['id'], op['data'])):
+                        stale.add(field_index)
+                self._apply(op, index=False)
+            for field_index in stale:
+                field_index.rebuild(self._data)
+            return
+
+        patient_id = entry['id']
+        self._etags.pop(patient_id, None)
+        self._encoded.pop(patient_id, None)
+        old = self._data.get(patient_id)
+        if entry['op'] == 'put':
+            record = entry['data']
+            self._data[patient_id] = record
+            if index:
+                #only indexes whose key changed need touching
+                for field_index in self._indexes():
+                    if old is None:
+                        field_index.add(patient_id, record)
+                    elif field_index.key(patient_id, old) != field_index.key(patient_id, record):
+                        field_index.remove(patient_id, old)
+                        field_index.add(patient_id, record)
+        elif entry['op'] == 'del':
+            self._data.pop(patient_id, None)
+            if index and old is not None:
+                for field_index in self._indexes():
+                    field_index.remove(patient_id, old)
+
+    def _indexes(self):
+        yield self._ids
+        yield from self._sorted.values()
+        yield from self._hashed.values()
+        yield self._stats
+
+    #reload if someone else changed the snapshot since we last read/wrote it
+    #in shared mode: apply what other processes wrote since we last looked
+    def _refresh(self):
+        if self._sync is not None:
+            if self._sync.token() != self._token:
+                with self._lock, self._sync.locked(exclusive=False):
+                    self._catch_up()
+            return
+        now = time.monotonic()
+        if now - self._last_check < self.check_interval:
+            return
+        self._last_check = now
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            mtime = self._mtime
+        if mtime != self._mtime:
+            with self._lock:
+                if os.stat(self.path).st_mtime_ns != self._mtime:
+                    self._load()
+        elif self.read_only:
+            with self._lock:
+                self._follow_owner()
+
+    #read-only without shared: following the process that owns the files
+    def _open_tail(self):
+        if self._tail is not None:
+            self._tail.close()
+        try:
+            self._tail = open(self.log_path, 'rb')
+        except FileNotFoundError:
+            self._tail = None
+        self._log_offset = 0
+
+    def _follow_owner(self):
+        #apply what the owner appended since we last looked; after a rotation finish the sealed log, then the new one
+        try:
+            inode = os.stat(self.log_path).st_ino
+        except FileNotFoundError:
+            inode = None
+        if self._tail is not None:
+            self._read_tail()
+            if os.fstat(self._tail.fileno()).st_ino == inode:
+                return
+        if inode is not None:
+            self._open_tail()
+            if self._tail is not None:
+                self._read_tail()
+
+    #shared mode: following the other processes
+    def _follow_log(self, offset):
+        #(re)open the current log for tailing, and for appending if it was replaced under us
+        _, self._generation, _, _ = self._sync.state()
+        if self._tail is not None:
+            self._tail.close()
+            if self._log is not None:
+                self._log.close()
+                self._log = open(self.log_path, 'ab')
+        #created if missing, for a read-only process that got here before any writer
+        self._tail = open(os.open(self.log_path, os.O_RDONLY | os.O_CREAT, 0o644), 'rb')
+        self._log_offset = offset
+        self._synced_to_header()
+
+    def _synced_to_header(self):
+        #our copy now matches everything the header announces
+        self._token = self._sync.token()
+        self._epoch, _, self._version, _ = self._sync.state()
+
+    def _read_tail(self):
+        #apply the complete lines other processes appended to the log we follow
+        self._tail.seek(self._log_offset)
+        data = self._tail.read()
+        end = data.rfind(b'\n') + 1
+        for line in data[:end].splitlines():
+            try:
+                entry = loads(line)
+            except ValueError:
+                #a line torn by a crashed writer, the entries after it are intact
+                continue
+            self._apply(entry)
+            self._log_records += len(entry['ops']) if entry['op'] == 'batch' else 1
+        self._log_offset += end
+
+    def _catch_up(self):
+        #called holding self._lock and the lock file
+        if self._sync.token() == self._token:
+            return
+        _, generation, _, _ = self._sync.state()
+        if generation == self._generation + 1:
+            #the log we followed was sealed (its file lives on as long as we hold it open): finish it, then the new one
+            self._read_tail()
+            self._log_records = 0
+            self._follow_log(0)
+        elif generation != self._generation:
+            #more than one rotation behind, the logs in between may already be folded away
+            self._load()
+            self._follow_log(self._log_offset)
+        self._read_tail()
+        self._synced_to_header()
+
+    #writes: under self._lock and, in shared mode, the lock file with the other processes caught up
+    @contextmanager
+    def _writing(self):
+        if self.read_only:
+            raise ReadOnlyStore(self.path)
+        with self._lock:
+            if self._sync is None:
+                self._refresh()
+                yield
+                return
+            with self._sync.locked():
+                self._catch_up()
+                yield
+
+    #write-ahead log
+    def _append(self, entry):
+        #must be called inside _writing(), returns the sequence number to wait for
+        self._apply(entry)
+        line = dumps(entry) + b'\n'
+        self._log.write(line)
+        self._written += 1
+        self._log_records += len(entry['ops']) if entry['op'] == 'batch' else 1
+        if self._sync is not None:
+            #other processes must see the whole line before the header tells them to look
+            self._log.flush()
+            self._log_offset += len(line)
+            _, generation, entries, _ = self._sync.state()
+            self._sync.publish(generation, entries + 1)
+            self._synced_to_header()
+        if self._log_records >= self.compact_every and not self._compacting:
+            self._rotate_log()
+        return self._written
+
+    def _wait_durable(self, seq):
+        #group commit: one writer becomes the leader and syncs for everyone queued behind it
+        with self._sync_cond:
+            while self._synced < seq:
+                if not self._syncing:
+                    self._syncing = True
+                    break
+                self._sync_cond.wait()
+            else:
+                return
+        target = self._synced
+        try:
+            if self.commit_delay:
+                time.sleep(self.commit_delay)
+            with self._lock:
+                target = self._written
+                self._log.flush()
+                fd = os.dup(self._log.fileno())
+            try:
+                if self.fsync:
+                    os.fsync(fd)
+            finally:
+                os.close(fd)
+        finally:
+            with self._sync_cond:
+                self._synced = max(self._synced, target)
+                self._syncing = False
+                self._sync_cond.notify_all()
+
+    #compaction
+    def _rotate_log(self):
+        #called inside _writing(): seal the current log and start a new one
+        if os.path.exists(self.old_log_path):
+            if self._sync is not None and self._sync.compactor_alive():
+                #another process is still compacting, the log can grow until it is done
+                return
+            #left behind by a compaction that failed or a process that died while compacting:
+            #a sealed log is never replaced before it is in the snapshot, so fold both logs now
+            try:
+                self._compact(dict(self._data), (self.old_log_path, self.log_path))
+            except OSError:
+                #both logs stay, try again after another compact_every records
+                self._log_records = 0
+                return
+            if self._sync is not None:
+                self._advance_generation()
+            else:
+                self._log.close()
+                self._log = open(self.log_path, 'ab')
+                self._log_records = 0
+            return
+        self._compacting = True
+        self._log.flush()
+        if self.fsync:
+            os.fsync(self._log.fileno())
+        self._log.close()
+        with self._sync_cond:
+            self._synced = max(self._synced, self._written)
+            self._sync_cond.notify_all()
+        os.replace(self.log_path, self.old_log_path)
+        self._log = open(self.log_path, 'ab')
+        self._log_records = 0
+        if self._sync is not None:
+            self._sync.set_compactor(os.getpid())
+            self._advance_generation()
+        snapshot = dict(self._data)
+        threading.Thread(target=self._compact, args=(snapshot, (self.old_log_path,)), daemon=True).start()
+
+    def _advance_generation(self):
+        #shared mode, after the log was replaced: tell the other processes and follow the new log ourselves
+        _, generation, entries, _ = self._sync.state()
+        self._sync.publish(generation + 1, entries)
+        self._log_records = 0
+        self._follow_log(0)
+
+    def _compact(self, snapshot, log_paths):
+        #write the snapshot next to the old one, swap it in and drop the logs it covers
+        try:
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(dumps(snapshot))
+                f.flush()
+                if self.fsync:
+                    os.fsync(f.fileno())
+            with self._lock, self._exclusive():
+                os.replace(tmp_path, self.path)
+                self._mtime = os.stat(self.path).st_mtime_ns
+                for log_path in log_paths:
+                    if os.path.exists(log_path):
+                        os.remove(log_path)
+                if self._sync is not None:
+                    self._sync.set_compactor(0)
+        finally:
+            self._compacting = False
+
+    #read API
+    @property
+    def version(self):
+        """Opaque token that changes whenever any patient changes."""
+        self._refresh()
+        return f'{self._epoch}-{self._version}'
+
+    def all(self):
+        self._refresh()
+        with self._lock:
+            return dict(self._data)
+
+    def get(self, patient_id):
+        self._refresh()
+        return self._data.get(patient_id)
+
+    def __contains__(self, patient_id):
+        self._refresh()
+        return patient_id in self._data
+
+    def __len__(self):
+        self._refresh()
+        return len(self._data)
+
+    def page(self, limit, after=None):
+        """Up to ``limit`` patients in id order after ``after``, plus the next cursor (or None)."""
+        self._refresh()
+        with self._lock:
+            ids = self._ids.page(offset=0, limit=limit, after=after)
+            records = {patient_id: self._data[patient_id] for patient_id in ids}
+        next_cursor = ids[-1] if len(ids) == limit else None
+        return records, next_cursor
+
+    def sorted_page(self, field, descending=False, offset=0, limit=None, after=None):
+        """Patients ordered by ``field``, plus a cursor for the next page (or None)."""
+        self._refresh()
+        with self._lock:
+            keys = self._sorted[field].page(descending, offset, limit, after)
+            records = [self._data[patient_id] for _, patient_id in keys]
+        next_cursor = encode_cursor(keys[-1]) if limit is not None and len(keys) == limit else None
+        return records, next_cursor
+
+    def search(self, equals=None, ranges=None, sort_by='id', descending=False, offset=0, limit=100, after=None):
+        """Patients matching every filter as ``(patient_id, record)`` pairs, plus the next page's cursor (or None).
+
+        ``equals`` maps fields to the value they must have and ``ranges`` maps
+        fields to inclusive ``(low, high)`` bounds, either of which may be
+        None. Results are ordered by ``sort_by`` (``'id'`` or a range field)
+        and then id; ``after`` is the decoded cursor of the previous page.
+        """
+        equals = equals or {}
+        ranges = ranges or {}
+        self._refresh()
+        with self._lock:
+            #the most selective indexed filter picks the candidates, the others are checked record by record
+            candidates, size = None, len(self._data)
+            for field, value in equals.items():
+                if field in self._hashed and len(self._hashed[field].get(value)) < size:
+                    candidates = self._hashed[field].get(value)
+                    size = len(candidates)
+            for field, (low, high) in ranges.items():
+                if field in self._sorted:
+                    start, stop = self._sorted[field].between(low, high)
+                    if stop - start < size:
+                        candidates = [patient_id for _, patient_id in self._sorted[field].keys(start, stop)]
+                        size = stop - start
+
+            index = self._ids if sort_by == 'id' else self._sorted[sort_by]
+            after_key = after[0] if after is not None and sort_by == 'id' else after
+            wanted = offset + limit if limit is not None else None
+            found = []
+            if wanted is not None and wanted * len(self._data) < size * size:
+                #walking the sort index until the page is full reads about wanted * N / size patients,
+                #which beats sorting all the candidates when the filters are not selective
+                for key in index.walk(descending, after_key):
+                    patient_id = key if sort_by == 'id' else key[1]
+                    record = self._data[patient_id]
+                    if matches(record, equals, ranges):
+                        found.append((key, patient_id, record))
+                        if len(found) == wanted:
+                            break
+            else:
+                for patient_id in (candidates if candidates is not None else self._data):
+                    record = self._data[patient_id]
+                    if matches(record, equals, ranges):
+                        key = index.key(patient_id, record)
+                        if after_key is None or (key < after_key if descending else key > after_key):
+                            found.append((key, patient_id, record))
+                found.sort(key=lambda item: item[0], reverse=descending)
+
+        found = found[offset:wanted]
+        next_cursor = None
+        if limit is not None and len(found) == limit:
+            last = found[-1][0]
+            next_cursor = encode_cursor([last] if sort_by == 'id' else last)
+        return [(patient_id, record) for _, patient_id, record in found], next_cursor
+
+    def stats(self, group_by=None):
+        """Population statistics, or per-group statistics for the ``group_by`` fields.
+
+        A single categorical field is read straight from the running
+        aggregates; any other grouping scans a cached columnar copy.
+        """
+        self._refresh()
+        with self._lock:
+            if not group_by:
+                return self._stats.summary()
+            if len(group_by) == 1 and group_by[0] in GROUP_FIELDS:
+                groups = self._stats.group_summary(group_by[0])
+            else:
+                groups = scan(self._stats.columns(self._data), group_by)
+        return {'group_by': list(group_by), 'groups': groups}
+
+    def encoded(self, patient_id):
+        #encoded once and reused until the record changes
+        self._refresh()
+        data = self._encoded.get(patient_id)
+        if data is None:
+            #under the lock, so a concurrent write cannot leave bytes of the old record behind
+            with self._lock:
+                record = self._data.get(patient_id)
+                if record is None:
+                    return None
+                data = self._encoded[patient_id] = dumps(record)
+        return data
+
+    def encoded_page(self, limit, after=None):
+        records, next_cursor = self.page(limit, after)
+        return [(patient_id, self.encoded(patient_id)) for patient_id in records], next_cursor
+
+    def etag(self, patient_id):
+        #strong ETag of the stored record, computed lazily and cached until the record changes
+        self._refresh()
+        tag = self._etags.get(patient_id)
+        if tag is None:
+            with self._lock:
+                record = self._data.get(patient_id)
+                if record is None:
+                    return None
+                tag = record_etag(record)
+                self._etags[patient_id] = tag
+        return tag
+
+    #write API: every write takes the patients' locks before _writing(), so nothing lands inside a modify()
+    def create(self, patient_id, record):
+        with self.locked(patient_id), self._writing():
+            if patient_id in self._data:
+                raise KeyError(patient_id)
+            seq = self._append({'op': 'put', 'id': patient_id, 'data': record})
+        self._wait_durable(seq)
+        return record
+
+    def bulk_put(self, records, overwrite=True, expected=None):
+        """Write many patients as a single log record, so either all of them land or none do.
+
+        With ``overwrite=False`` a KeyError listing the existing ids is raised
+        and nothing is written. ``expected`` maps ids to the record object the
+        caller based its change on; patients changed since then are skipped.
+        Returns the number of patients written.
+        """
+        with self.locked(*records), self._writing():
+            if not overwrite:
+                existing = [patient_id for patient_id in records if patient_id in self._data]
+                if existing:
+                    raise KeyError(existing)
+            if expected is not None:
+                records = {patient_id: record for patient_id, record in records.items()
+                           if self._data.get(patient_id) == expected.get(patient_id)}
+            if not records:
+                return 0
+            seq = self._append({'op': 'batch', 'ops': [{'op': 'put', 'id': patient_id, 'data': record}
+                                                      for patient_id, record in records.items()]})
+        self._wait_durable(seq)
+        return len(records)
+
+    def update(self, patient_id, record):
+        with self._writing():
+            if patient_id not in self._data:
+                raise KeyError(patient_id)
+            seq = self._append({'op': 'put', 'id': patient_id, 'data': record})
+        self._wait_durable(seq)
+        return record
+
+    def delete(self, patient_id, if_match=None):
+        with self.locked(patient_id), self._writing():
+            if patient_id not in self._data:
+                raise KeyError(patient_id)
+            if not etag_matches(if_match, self.etag(patient_id)):
+                raise PreconditionFailed(patient_id)
+            seq = self._append({'op': 'del', 'id': patient_id})
+        self._wait_durable(seq)
+
+    def modify(self, patient_id, change, if_match=None):
+        if self._sync is None:
+            return super().modify(patient_id, change, if_match)
+        #the patient lock only keeps out this process, so read and write under the lock file
+        with self.locked(patient_id), self._writing():
+            current = self._data.get(patient_id)
+            if current is None:
+                raise KeyError(patient_id)
+            if not etag_matches(if_match, self.etag(patient_id)):
+                raise PreconditionFailed(patient_id)
+            record = change(dict(current))
+            seq = self._append({'op': 'put', 'id': patient_id, 'data': record})
+        self._wait_durable(seq)
+        return record
+
+    def close(self):
+        #flush and sync the log, e.g. on application shutdown
+        with self._lock:
+            if self._log is not None:
+                self._log.flush()
+                if self.fsync:
+                    os.fsync(self._log.fileno())
+                self._log.close()
+            if self._tail is not None:
+                self._tail.close()
+            if self._sync is not None:
+                self._sync.close()
+            if self._owner is not None:
+                os.close(self._owner)
+
+
+#`sqlite:///patients.db` opens the SQLite backend, `columns:///patients.cols` a read-only columnar snapshot,
+#anything else is a JSON snapshot path
+#shared=True lets several processes serve one JSON store; SQLite and columnar snapshots are always safe to share
+#read_only=True opens a JSON store that only reads, next to the process writing it (columnar snapshots always are)
+def open_store(uri, shared=False, read_only=False):
+    if uri.startswith('sqlite:///'):
+        from sqlite_store import SQLitePatientStore
+        return SQLitePatientStore(uri[len('sqlite:///'):])
+    if uri.startswith('columns:///'):
+        from columnar_store import ColumnarPatientStore
+        return ColumnarPatientStore(uri[len('columns:///'):])
+    return PatientStore(uri, shared=shared, read_only=read_only)
@@ -0,0 +1,155 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from fastapi import Response
+from json_codec import dumps
+
+
+#is `etag` one of the tags in an If-None-Match header? (weak comparison, as RFC 9110 asks for GETs)
+def etag_listed(header, etag):
+    if not header:
+        return False
+    if header.strip() == '*':
+        return True
+    strip = lambda tag: tag.strip().removeprefix('W/')
+    return strip(etag) in {strip(tag) for tag in header.split(',')}
+
+
+class ResponseCache:
+    """LRU cache of encoded response bodies, bounded by total size.
+
+    Every entry is stored under the ETag its body was built for. ``get``
+    only returns it while the caller still computes the same ETag, so a
+    write invalidates exactly the responses whose ETag it changes: everything
+    derived from the store version for collection reads, but only that
+    patient's entry for single-patient reads. Bodies bigger than a quarter of
+    ``max_bytes`` are never cached.
+    """
+
+    def __init__(self, max_bytes=64 * 2**20):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, etag):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == etag:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1], entry[2]
+            if entry is not None:
+                #built for an older ETag, it can never be served again
+                self._drop(key)
+            self.misses += 1
+            return None
+
+    def put(self, key, etag, value):
+        body, headers = value
+        if len(body) * 4 > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (etag, body, headers)
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+
+    def _drop(self, key):
+        _, body, _ = self._entries.pop(key)
+        self.size -= len(body)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self.size,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0
+            }
+
+
+#a patient's encoded record with its id spliced in as the first key
+def with_id(patient_id, data):
+    return b'{"id":' + dumps(patient_id) + (b',' + data[1:] if len(data) > 2 else b'}')
+
+#patients as one JSON object, joined from their encoded records
+def encode_object(pairs):
+    return b'{' + b','.join(dumps(patient_id) + b':' + data for patient_id, data in pairs) + b'}'
+
+#stream pages of encoded patients as NDJSON lines, one chunk per page
+async def stream_ndjson(pages):
+    async for page in pages:
+        yield b''.join(with_id(patient_id, data) + b'\n' for patient_id, data in page)
+
+#stream pages of encoded patients as one JSON object without building it in memory
+async def stream_json_object(pages):
+    yield b'{'
+    separator = b''
+    async for page in pages:
+        if page:
+            yield separator + encode_object(page)[1:-1]
+            separator = b','
+    yield b'}'
+
+
+class CachedReads:
+    """Read endpoints of a patient app served from a ResponseCache.
+
+    Shared by main.py and PutDelete.py, each binding it to its own store,
+    StoreExecutor, cache and Telemetry. ``cached_read`` runs the ETag
+    check and, on a miss, the body builder on the executor.
+    """
+
+    def __init__(self, store, executor, cache, telemetry):
+        self.store = store
+        self.executor = executor
+        self.cache = cache
+        self.telemetry = telemetry
+
+    #JSON body and headers of a read response, plus X-Next-Cursor for pages
+    def encode_json(self, content, next_cursor=None):
+        headers = {'X-Next-Cursor': next_cursor} if next_cursor is not None else {}
+        with self.telemetry.stage('serialize'):
+            return dumps(content), headers
+
+    #collection reads change with any write, so their ETag is the store version plus the URL
+    def version_etag(self, key):
+        return f'"{self.store.version}-{hashlib.sha1(key.encode()).hexdigest()[:12]}"'
+
+    #serve a read from the response cache, answering If-None-Match with 304
+    #on a miss `build` encodes the body; `etag` computes the ETag the response has right now
+    #returns None (for a 404) when either finds nothing, e.g. a patient deleted between the two
+    async def cached_read(self, request, build, etag=None):
+        etag = etag or self.version_etag
+        key = f'{request.url.path}?{request.url.query}'
+        if_none_match = request.headers.get('if-none-match')
+
+        def lookup():
+            tag = etag(key)
+            if tag is None or etag_listed(if_none_match, tag):
+                return tag, None
+            entry = self.cache.get(key, tag)
+            if entry is None:
+                entry = build()
+                if entry is None:
+                    return None, None
+                self.cache.put(key, tag, entry)
+            return tag, entry
+
+        tag, entry = await self.executor.run(lookup)
+        if tag is None:
+            return None
+        #clients may keep the response but must revalidate, which costs them a 304 while nothing changed
+        headers = {'ETag': tag, 'Cache-Control': 'no-cache'}
+        if entry is None:
+            return Response(status_code=304, headers=headers)
+        body, extra = entry
+        return Response(body, media_type='application/json', headers={**extra, **headers})
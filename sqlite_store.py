@@ -0,0 +1,345 @@
+import argparse
+import queue
+import sqlite3
+from contextlib import contextmanager
+from json_codec import dumps, loads
+from patient_index import encode_cursor
+from patient_stats import BUCKETS, GROUP_FIELDS, NUMERIC_FIELDS, bucket_label, group_order, summarize
+from patient_store import (BasePatientStore, PatientStore, PreconditionFailed, FILTER_FIELDS, RANGE_FIELDS, SORT_FIELDS,
+                           etag_matches, record_etag)
+
+#the full record is kept as JSON in `data`, the other columns are copies of its fields for indexed queries
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS patients (
+    id TEXT PRIMARY KEY,
+    data TEXT NOT NULL,
+    city TEXT,
+    age INTEGER,
+    gender TEXT,
+    height REAL NOT NULL DEFAULT 0,
+    weight REAL NOT NULL DEFAULT 0,
+    bmi REAL NOT NULL DEFAULT 0,
+    verdict TEXT
+);
+CREATE INDEX IF NOT EXISTS patients_city ON patients (city);
+CREATE INDEX IF NOT EXISTS patients_age ON patients (age, id);
+CREATE INDEX IF NOT EXISTS patients_gender ON patients (gender);
+CREATE INDEX IF NOT EXISTS patients_verdict ON patients (verdict);
+CREATE INDEX IF NOT EXISTS patients_height ON patients (height, id);
+CREATE INDEX IF NOT EXISTS patients_weight ON patients (weight, id);
+CREATE INDEX IF NOT EXISTS patients_bmi ON patients (bmi, id);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value);
+INSERT OR IGNORE INTO meta VALUES ('epoch', lower(hex(randomblob(4)))), ('version', 0);
+'''
+
+#statements are fixed strings, so sqlite3's per-connection statement cache prepares each one once
+SELECT_ONE = 'SELECT data FROM patients WHERE id = ?'
+SELECT_ALL = 'SELECT id, data FROM patients ORDER BY rowid'
+SELECT_COUNT = 'SELECT COUNT(*) FROM patients'
+SELECT_PAGE = 'SELECT id, data FROM patients WHERE id > ? ORDER BY id LIMIT ?'
+INSERT = 'INSERT INTO patients (id, data, city, age, gender, height, weight, bmi, verdict) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)'
+UPSERT = 'INSERT OR REPLACE INTO patients (id, data, city, age, gender, height, weight, bmi, verdict) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)'
+UPDATE = 'UPDATE patients SET data = ?, city = ?, age = ?, gender = ?, height = ?, weight = ?, bmi = ?, verdict = ? WHERE id = ?'
+DELETE = 'DELETE FROM patients WHERE id = ?'
+SELECT_META = 'SELECT value FROM meta WHERE key = ?'
+BUMP_VERSION = "UPDATE meta SET value = value + 1 WHERE key = 'version'"
+
+#one statement per sort field and direction; the (field, id) index serves both the order and the cursor
+SORTED_PAGE = {}
+for _field in SORT_FIELDS:
+    for _descending, _direction, _compare in ((False, 'ASC', '>'), (True, 'DESC', '<')):
+        SORTED_PAGE[_field, _descending, False] = (
+            f'SELECT {_field}, id, data FROM patients ORDER BY {_field} {_direction}, id {_direction} LIMIT ? OFFSET ?')
+        SORTED_PAGE[_field, _descending, True] = (
+            f'SELECT {_field}, id, data FROM patients WHERE ({_field}, id) {_compare} (?, ?) '
+            f'ORDER BY {_field} {_direction}, id {_direction} LIMIT ? OFFSET ?')
+
+
+#count, sum, sum of squares, min and max of every numeric field, in NUMERIC_FIELDS order
+MOMENTS = ', '.join(f'COUNT({field}), TOTAL({field}), TOTAL({field} * {field}), MIN({field}), MAX({field})'
+                    for field in NUMERIC_FIELDS)
+
+
+#stats of one group from a row of MOMENTS columns
+def moments_summary(count, values):
+    summary = {'count': count}
+    for i, field in enumerate(NUMERIC_FIELDS):
+        summary[field] = summarize(*values[i * 5:i * 5 + 5])
+    return summary
+
+#SQL for the bucket number of a numeric field, same as patient_stats.bucket
+#(the fields are validated as positive, so truncating is flooring)
+def bucket_sql(field):
+    return f'CAST({field} / {BUCKETS[field]} + 1e-9 AS INTEGER)'
+
+
+#column values for one patient, in table order after the id
+def row_values(record):
+    return (dumps(record).decode(), record.get('city'), record.get('age'), record.get('gender'),
+            record.get('height', 0), record.get('weight', 0), record.get('bmi', 0), record.get('verdict'))
+
+
+class SQLitePatientStore(BasePatientStore):
+    """Patient store backed by an SQLite database in WAL mode.
+
+    Reads come from a small pool of connections, so they run in parallel with
+    each other and with the single writer WAL allows. Lookups by id, sorted
+    pages and filters on city/age/gender/verdict are answered from indexes
+    instead of loading every patient. Writes that must check the stored
+    record first (``modify``, ``delete``, ``create``) run in a
+    ``BEGIN IMMEDIATE`` transaction, so they are atomic across processes too.
+    """
+
+    def __init__(self, path='patients.db', pool_size=4, timeout=30.0, lock_stripes=64):
+        super().__init__(lock_stripes)
+        self.path = path
+        self._pool = queue.Queue()
+        for _ in range(pool_size):
+            self._pool.put(self._connect(timeout))
+        with self._connection() as conn:
+            conn.executescript(SCHEMA)
+            self._epoch = conn.execute(SELECT_META, ('epoch',)).fetchone()[0]
+
+    def _connect(self, timeout):
+        conn = sqlite3.connect(self.path, timeout=timeout, isolation_level=None, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        #with WAL, NORMAL only syncs at checkpoints and still never corrupts the database
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    @contextmanager
+    def _connection(self):
+        conn = self._pool.get()
+        try:
+            yield conn
+        finally:
+            self._pool.put(conn)
+
+    @contextmanager
+    def _transaction(self):
+        with self._connection() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield conn
+                #every write transaction moves the version on, whichever process made it
+                conn.execute(BUMP_VERSION)
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+
+    #read API
+    @property
+    def version(self):
+        """Opaque token that changes whenever any patient changes, shared by every process using the database."""
+        with self._connection() as conn:
+            return f'{self._epoch}-{conn.execute(SELECT_META, ("version",)).fetchone()[0]}'
+
+    def all(self):
+        with self._connection() as conn:
+            return {patient_id: loads(data) for patient_id, data in conn.execute(SELECT_ALL)}
+
+    def get(self, patient_id):
+        with self._connection() as conn:
+            row = conn.execute(SELECT_ONE, (patient_id,)).fetchone()
+        return loads(row[0]) if row is not None else None
+
+    def __len__(self):
+        with self._connection() as conn:
+            return conn.execute(SELECT_COUNT).fetchone()[0]
+
+    def page(self, limit, after=None):
+        """Up to ``limit`` patients in id order after ``after``, plus the next cursor (or None)."""
+        with self._connection() as conn:
+            rows = conn.execute(SELECT_PAGE, (after if after is not None else '', limit)).fetchall()
+        records = {patient_id: loads(data) for patient_id, data in rows}
+        next_cursor = rows[-1][0] if len(rows) == limit else None
+        return records, next_cursor
+
+    #the data column already holds each record's JSON, so it is served without decoding
+    def encoded(self, patient_id):
+        with self._connection() as conn:
+            row = conn.execute(SELECT_ONE, (patient_id,)).fetchone()
+        return row[0].encode() if row is not None else None
+
+    def encoded_page(self, limit, after=None):
+        with self._connection() as conn:
+            rows = conn.execute(SELECT_PAGE, (after if after is not None else '', limit)).fetchall()
+        next_cursor = rows[-1][0] if len(rows) == limit else None
+        return [(patient_id, data.encode()) for patient_id, data in rows], next_cursor
+
+    def sorted_page(self, field, descending=False, offset=0, limit=None, after=None):
+        """Patients ordered by ``field``, plus a cursor for the next page (or None)."""
+        #LIMIT -1 means no limit in SQLite
+        params = (limit if limit is not None else -1, offset)
+        if after is not None:
+            params = (*after, *params)
+        with self._connection() as conn:
+            rows = conn.execute(SORTED_PAGE[field, descending, after is not None], params).fetchall()
+        records = [loads(data) for _, _, data in rows]
+        next_cursor = encode_cursor(rows[-1][:2]) if limit is not None and len(rows) == limit else None
+        return records, next_cursor
+
+    def search(self, equals=None, ranges=None, sort_by='id', descending=False, offset=0, limit=100, after=None):
+        """Patients matching every filter as ``(patient_id, record)`` pairs, plus the next page's cursor (or None).
+
+        Same arguments as ``PatientStore.search``; the filters become one
+        indexed WHERE clause and SQLite picks the index to drive it.
+        """
+        where, params = [], []
+        for field, value in (equals or {}).items():
+            if field not in FILTER_FIELDS:
+                raise ValueError(f'Cannot filter on {field!r}')
+            where.append(f'{field} = ?')
+            params.append(value)
+        for field, (low, high) in (ranges or {}).items():
+            if field not in RANGE_FIELDS:
+                raise ValueError(f'Cannot filter on {field!r}')
+            if low is not None:
+                where.append(f'{field} >= ?')
+                params.append(low)
+            if high is not None:
+                where.append(f'{field} <= ?')
+                params.append(high)
+        if sort_by != 'id' and sort_by not in RANGE_FIELDS:
+            raise ValueError(f'Cannot sort on {sort_by!r}')
+
+        columns = 'id' if sort_by == 'id' else f'{sort_by}, id'
+        direction = 'DESC' if descending else 'ASC'
+        if after is not None:
+            where.append(f'({columns}) {"<" if descending else ">"} ({", ".join("?" * len(after))})')
+            params.extend(after)
+        query = f'SELECT {columns}, data FROM patients'
+        if where:
+            query += ' WHERE ' + ' AND '.join(where)
+        query += f' ORDER BY {columns.replace(",", f" {direction},")} {direction} LIMIT ? OFFSET ?'
+        params.extend((limit if limit is not None else -1, offset))
+
+        with self._connection() as conn:
+            rows = conn.execute(query, params).fetchall()
+        next_cursor = encode_cursor(rows[-1][:-1]) if limit is not None and len(rows) == limit else None
+        return [(row[-2], loads(row[-1])) for row in rows], next_cursor
+
+    def stats(self, group_by=None):
+        """Population statistics, or per-group statistics for the ``group_by`` fields, as aggregate queries."""
+        with self._connection() as conn:
+            if not group_by:
+                row = conn.execute(f'SELECT COUNT(*), {MOMENTS} FROM patients').fetchone()
+                totals = moments_summary(row[0], row[1:])
+                fields = {}
+                for field in NUMERIC_FIELDS:
+                    rows = conn.execute(f'SELECT {bucket_sql(field)} AS b, COUNT(*) FROM patients '
+                                        f'WHERE {field} IS NOT NULL GROUP BY b ORDER BY b').fetchall()
+                    fields[field] = {**totals[field], 'histogram': {bucket_label(field, number): count for number, count in rows}}
+                counts = {}
+                for field in GROUP_FIELDS:
+                    rows = conn.execute(f'SELECT {field}, COUNT(*) FROM patients GROUP BY {field}').fetchall()
+                    counts[field] = dict(sorted(rows, key=lambda row: group_order(row[0])))
+                return {'count': totals['count'], 'fields': fields, 'counts': counts}
+
+            keys = []
+            for field in group_by:
+                if field in NUMERIC_FIELDS:
+                    keys.append(bucket_sql(field))
+                elif field in GROUP_FIELDS:
+                    keys.append(field)
+                else:
+                    raise ValueError(f'Cannot group by {field!r}')
+            rows = conn.execute(f'SELECT {", ".join(keys)}, COUNT(*), {MOMENTS} FROM patients '
+                                f'GROUP BY {", ".join(keys)}').fetchall()
+        groups = []
+        for row in rows:
+            key = {field: bucket_label(field, value) if field in NUMERIC_FIELDS and value is not None else value
+                   for field, value in zip(group_by, row)}
+            groups.append({'group': key, **moments_summary(row[len(keys)], row[len(keys) + 1:])})
+        groups.sort(key=lambda group: tuple(group_order(group['group'][field]) for field in group_by))
+        return {'group_by': list(group_by), 'groups': groups}
+
+    #write API
+    def create(self, patient_id, record):
+        try:
+            with self._transaction() as conn:
+                conn.execute(INSERT, (patient_id, *row_values(record)))
+        except sqlite3.IntegrityError:
+            raise KeyError(patient_id)
+        return record
+
+    def bulk_put(self, records, overwrite=True, expected=None):
+        """Write many patients in one transaction, so either all of them land or none do.
+
+        With ``overwrite=False`` a KeyError listing the existing ids is raised
+        and nothing is written. ``expected`` maps ids to the record the caller
+        based its change on; patients changed since then are skipped.
+        Returns the number of patients written.
+        """
+        with self._transaction() as conn:
+            if not overwrite or expected is not None:
+                stored = {}
+                ids = list(records)
+                #look the ids up in chunks that stay under SQLite's bound-parameter limit
+                for i in range(0, len(ids), 500):
+                    chunk = ids[i:i + 500]
+                    query = f'SELECT id, data FROM patients WHERE id IN ({",".join("?" * len(chunk))})'
+                    stored.update(conn.execute(query, chunk).fetchall())
+                if not overwrite and stored:
+                    raise KeyError([patient_id for patient_id in records if patient_id in stored])
+                if expected is not None:
+                    records = {patient_id: record for patient_id, record in records.items()
+                               if patient_id in stored and loads(stored[patient_id]) == expected.get(patient_id)}
+            conn.executemany(UPSERT, ((patient_id, *row_values(record)) for patient_id, record in records.items()))
+        return len(records)
+
+    def update(self, patient_id, record):
+        with self._transaction() as conn:
+            if conn.execute(UPDATE, (*row_values(record), patient_id)).rowcount == 0:
+                raise KeyError(patient_id)
+        return record
+
+    def modify(self, patient_id, change, if_match=None):
+        #read, check and write inside one write transaction
+        with self.locked(patient_id), self._transaction() as conn:
+            row = conn.execute(SELECT_ONE, (patient_id,)).fetchone()
+            if row is None:
+                raise KeyError(patient_id)
+            current = loads(row[0])
+            if not etag_matches(if_match, record_etag(current)):
+                raise PreconditionFailed(patient_id)
+            record = change(current)
+            conn.execute(UPDATE, (*row_values(record), patient_id))
+        return record
+
+    def delete(self, patient_id, if_match=None):
+        with self._transaction() as conn:
+            row = conn.execute(SELECT_ONE, (patient_id,)).fetchone()
+            if row is None:
+                raise KeyError(patient_id)
+            if not etag_matches(if_match, record_etag(loads(row[0]))):
+                raise PreconditionFailed(patient_id)
+            conn.execute(DELETE, (patient_id,))
+
+    def close(self):
+        while not self._pool.empty():
+            self._pool.get_nowait().close()
+
+
+def migrate(json_path, db_path):
+    """Copy every patient from a JSON store (snapshot plus its log) into an SQLite database."""
+    source = PatientStore(json_path, read_only=True)
+    target = SQLitePatientStore(db_path)
+    try:
+        written = 0
+        for page in source.iter_pages(chunk_size=10000):
+            written += target.bulk_put(page)
+        return written
+    finally:
+        source.close()
+        target.close()
+
+
+if __name__ == '__main__':
+    #python sqlite_store.py patients.json patients.db
+    parser = argparse.ArgumentParser(description='Migrate patients from a JSON store into SQLite')
+    parser.add_argument('source', nargs='?', default='patients.json', help='JSON snapshot to read')
+    parser.add_argument('target', nargs='?', default='patients.db', help='SQLite database to write')
+    args = parser.parse_args()
+    print(f'Migrated {migrate(args.source, args.target)} patients into {args.target}')
@@ -0,0 +1,71 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+
+class StoreOverloaded(Exception):
+    """Raised instead of queueing a store call when the executor is already full."""
+
+
+class StoreExecutor:
+    """Bounded thread pool for the blocking store calls made by async handlers.
+
+    ``max_workers`` threads run store calls; at most ``max_pending`` calls may
+    be running or waiting at once. Past that ``run`` raises StoreOverloaded
+    straight away, so under overload requests are turned away early instead
+    of piling up and making every request slow, including the ones that never
+    touch the store. Streams (``iterate``) are checked once, when they start.
+    """
+
+    def __init__(self, max_workers=8, max_pending=64):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='store')
+        #only touched from the event loop, so no lock is needed
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+
+    def _admit(self):
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise StoreOverloaded()
+
+    async def run(self, fn, *args, **kwargs):
+        self._admit()
+        return await self._run(fn, *args, **kwargs)
+
+    async def _run(self, fn, *args, **kwargs):
+        self.pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._pool, functools.partial(fn, *args, **kwargs))
+        finally:
+            self.pending -= 1
+            self.completed += 1
+
+    def iterate(self, iterator):
+        #pull each item of a blocking iterator (e.g. store.iter_pages()) through the pool
+        #a stream is admitted once, here, so an overloaded server turns it away before any of it is sent;
+        #after that its items are fetched without the check, so a response never breaks off halfway
+        self._admit()
+        return self._items(iter(iterator))
+
+    async def _items(self, iterator):
+        done = object()
+        while True:
+            item = await self._run(next, iterator, done)
+            if item is done:
+                return
+            yield item
+
+    def stats(self):
+        return {
+            'max_workers': self.max_workers,
+            'max_pending': self.max_pending,
+            'pending': self.pending,
+            'completed': self.completed,
+            'rejected': self.rejected
+        }
+
+    def shutdown(self):
+        self._pool.shutdown(wait=True)
@@ -0,0 +1,122 @@
+import mmap
+import os
+import struct
+from contextlib import contextmanager
+
+#POSIX only; without it a JSON store can only be served by one process
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+#epoch, log generation, log entries written so far, pid of the process compacting (0 = none)
+HEADER = struct.Struct('<8sQQQ')
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class StoreInUse(Exception):
+    """Raised when a JSON store is opened for writing while another process owns its files."""
+
+
+def claim(path, exclusive):
+    """Hold a flock on ``path`` until the returned file descriptor is closed.
+
+    Writers without ``shared`` claim it exclusively and shared writers claim
+    it shared, so a second owner, or owners of both kinds, fail with
+    StoreInUse instead of removing each other's logs. Returns None without
+    flock.
+    """
+    if fcntl is None:
+        return None
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, (fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH) | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        raise StoreInUse(f'{path} is held by another process writing the store; stop it or open the store read-only')
+    return fd
+
+
+class StoreSync:
+    """Lock file shared by every process serving the same JSON patient store.
+
+    Writers hold the file's exclusive lock (flock) while they catch up with
+    the log, append and publish. Readers take the shared lock only while
+    catching up. The lock file also holds a small header, mapped into
+    memory. The header carries a generation that moves on every log rotation
+    and a count of the log entries written so far. Comparing ``token()``
+    with the last one seen tells a process whether anyone else wrote, which
+    costs a memory read rather than a system call.
+
+    Callers must serialize their own calls (the store's lock), which is what
+    makes ``locked`` re-entrant within one process.
+    """
+
+    def __init__(self, path):
+        if fcntl is None:
+            raise RuntimeError('sharing a patient store between processes needs fcntl (POSIX)')
+        self.path = path
+        self._open()
+
+    def _open(self):
+        self._pid = os.getpid()
+        self._depth = 0
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(self._fd).st_size < HEADER.size:
+                os.pwrite(self._fd, HEADER.pack(os.urandom(4).hex().encode(), 0, 0, 0), 0)
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._map = mmap.mmap(self._fd, HEADER.size)
+
+    def token(self):
+        return self._map[:HEADER.size]
+
+    def state(self):
+        #(epoch, generation, entries, compacting pid)
+        epoch, generation, entries, compactor = HEADER.unpack(self.token())
+        return epoch.decode(), generation, entries, compactor
+
+    def publish(self, generation, entries):
+        struct.pack_into('<QQ', self._map, 8, generation, entries)
+
+    def set_compactor(self, pid):
+        struct.pack_into('<Q', self._map, 24, pid)
+
+    def compactor_alive(self):
+        pid = self.state()[3]
+        return pid != 0 and process_alive(pid)
+
+    @contextmanager
+    def locked(self, exclusive=True):
+        if os.getpid() != self._pid:
+            #forked since the lock file was opened: flock would be shared with the parent
+            self._open()
+        if self._depth:
+            self._depth += 1
+            try:
+                yield
+            finally:
+                self._depth -= 1
+            return
+        fcntl.flock(self._fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        self._depth = 1
+        try:
+            yield
+        finally:
+            self._depth = 0
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def close(self):
+        self._map.close()
+        os.close(self._fd)
@@ -0,0 +1,308 @@
+import os
+import sys
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter
+
+from fastapi import APIRouter, Query
+from fastapi.responses import PlainTextResponse
+
+#upper bounds in seconds, from 0.1 ms (a cached read) up to 10 s (a full export)
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Histogram:
+    """Prometheus histogram: a count per bucket plus the sum and count of all observations."""
+
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        #one extra slot for observations above the last bucket (+Inf)
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self, name, labels):
+        cumulative = 0
+        for bound, count in zip((*self.buckets, '+Inf'), self.counts):
+            cumulative += count
+            yield f'{name}_bucket{format_labels({**labels, "le": bound})} {cumulative}'
+        yield f'{name}_sum{format_labels(labels)} {self.sum}'
+        yield f'{name}_count{format_labels(labels)} {self.count}'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escape = lambda value: str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+    return '{' + ','.join(f'{key}="{escape(value)}"' for key, value in labels.items()) + '}'
+
+
+class _Stage:
+    __slots__ = ('telemetry', 'name', 'start')
+
+    def __init__(self, telemetry, name):
+        self.telemetry = telemetry
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.telemetry.observe_stage(self.name, time.perf_counter() - self.start)
+
+
+class Telemetry:
+    """Request and stage metrics of one app, rendered in the Prometheus text format.
+
+    TelemetryMiddleware records every request under its route template (so
+    ``/patient/{patient_id}`` is one series, not one per patient), and
+    handlers time named stages with ``with telemetry.stage('storage_read'):``
+    or ``telemetry.timed('inference', fn)``. Stage timings work from any
+    thread, including the store executor's. Recording is a perf_counter
+    pair, a bisect and a few increments under one lock.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self.requests = Counter()
+        self.errors = Counter()
+        self.latency = {}
+        self.stages = {}
+        #only changed by the middleware, on the event loop
+        self.in_flight = 0
+        self._gauges = []
+        self.profiler = SamplingProfiler()
+
+    def observe_request(self, method, route, status, seconds):
+        with self._lock:
+            self.requests[(method, route, status)] += 1
+            if status >= 500:
+                self.errors[(method, route)] += 1
+            histogram = self.latency.get((method, route))
+            if histogram is None:
+                histogram = self.latency[(method, route)] = Histogram(self.buckets)
+            histogram.observe(seconds)
+
+    def observe_stage(self, name, seconds):
+        with self._lock:
+            histogram = self.stages.get(name)
+            if histogram is None:
+                histogram = self.stages[name] = Histogram(self.buckets)
+            histogram.observe(seconds)
+
+    def stage(self, name):
+        return _Stage(self, name)
+
+    def timed(self, name, fn):
+        #fn wrapped so each call is timed as stage `name`, e.g. for executor.run(telemetry.timed(...), ...)
+        def timed_fn(*args, **kwargs):
+            with _Stage(self, name):
+                return fn(*args, **kwargs)
+        return timed_fn
+
+    def gauges(self, prefix, stats):
+        #export the numeric values of stats() (e.g. executor.stats) as prefix_<key> gauges
+        self._gauges.append((prefix, stats))
+
+    def render(self):
+        lines = []
+
+        def family(name, kind, help_text):
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+
+        with self._lock:
+            requests = sorted(self.requests.items())
+            errors = sorted(self.errors.items())
+            latency = sorted(self.latency.items())
+            stages = sorted(self.stages.items())
+            #histograms keep changing while we render, so render copies
+            latency = [(key, self._copy(histogram)) for key, histogram in latency]
+            stages = [(key, self._copy(histogram)) for key, histogram in stages]
+
+        family('http_requests_total', 'counter', 'Requests handled, by route template and status code.')
+        for (method, route, status), count in requests:
+            lines.append(f'http_requests_total{format_labels({"method": method, "route": route, "status": status})} {count}')
+        family('http_request_errors_total', 'counter', 'Requests that ended in a 5xx or an unhandled exception.')
+        for (method, route), count in errors:
+            lines.append(f'http_request_errors_total{format_labels({"method": method, "route": route})} {count}')
+        family('http_requests_in_flight', 'gauge', 'Requests currently being handled.')
+        lines.append(f'http_requests_in_flight {self.in_flight}')
+        family('http_request_duration_seconds', 'histogram', 'Time from receiving a request to sending the last byte.')
+        for (method, route), histogram in latency:
+            lines.extend(histogram.samples('http_request_duration_seconds', {'method': method, 'route': route}))
+        family('stage_duration_seconds', 'histogram', 'Time spent in named stages inside handlers.')
+        for name, histogram in stages:
+            lines.extend(histogram.samples('stage_duration_seconds', {'stage': name}))
+
+        for prefix, stats in self._gauges:
+            for key, value in stats().items():
+                if isinstance(value, (int, float)):
+                    family(f'{prefix}_{key}', 'gauge', f'{key} from {prefix} stats.')
+                    lines.append(f'{prefix}_{key} {float(value)}')
+        rss = resident_memory_bytes()
+        if rss is not None:
+            family('process_resident_memory_bytes', 'gauge', 'Resident memory size in bytes.')
+            lines.append(f'process_resident_memory_bytes {rss}')
+        family('profiler_running', 'gauge', '1 while the sampling profiler is collecting stacks.')
+        lines.append(f'profiler_running {int(self.profiler.running)}')
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def _copy(histogram):
+        copy = Histogram(histogram.buckets)
+        copy.counts, copy.sum, copy.count = list(histogram.counts), histogram.sum, histogram.count
+        return copy
+
+
+def resident_memory_bytes():
+    #Linux only, None elsewhere
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+
+class TelemetryMiddleware:
+    """ASGI middleware timing every HTTP request into a Telemetry.
+
+    The duration runs until the last body chunk is sent, so streamed
+    responses are timed in full. Unhandled exceptions count as 500s.
+    """
+
+    def __init__(self, app, telemetry):
+        self.app = app
+        self.telemetry = telemetry
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        status = 500
+
+        async def send_status(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        telemetry = self.telemetry
+        telemetry.in_flight += 1
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_status)
+        except Exception:
+            status = 500
+            raise
+        finally:
+            telemetry.in_flight -= 1
+            #the route template, set by the router; requests that matched no route share one series
+            route = scope.get('route')
+            telemetry.observe_request(scope['method'], getattr(route, 'path', '<unmatched>'), status,
+                                      time.perf_counter() - start)
+
+
+class SamplingProfiler:
+    """Wall-clock sampling profiler that can be switched on and off while the app runs.
+
+    While running, a background thread snapshots every other thread's stack
+    each ``interval`` seconds and counts them in the folded format flame graph
+    tools read (``thread;outer;...;inner count``). Nothing runs on the request
+    path, and when it is stopped it costs nothing at all.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+        self.stacks = Counter()
+        self.samples = 0
+        self.interval = None
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self, interval=0.01):
+        with self._lock:
+            if self._thread is not None:
+                return False
+            self.interval = interval
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, args=(interval,), name='sampling-profiler', daemon=True)
+            self._thread.start()
+            return True
+
+    def stop(self):
+        with self._lock:
+            thread, self._thread = self._thread, None
+            if thread is None:
+                return False
+            self._stop.set()
+        thread.join()
+        return True
+
+    def clear(self):
+        with self._lock:
+            self.stacks = Counter()
+            self.samples = 0
+
+    def folded(self):
+        with self._lock:
+            return ''.join(f'{stack} {count}\n' for stack, count in self.stacks.most_common())
+
+    def _run(self, interval):
+        own = threading.get_ident()
+        while not self._stop.wait(interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            sampled = []
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                sampled.append(';'.join(reversed(stack)))
+            with self._lock:
+                self.stacks.update(sampled)
+                self.samples += 1
+
+
+#GET /metrics plus the profiler switches, for app.include_router
+def telemetry_router(telemetry):
+    router = APIRouter()
+
+    @router.get('/metrics', response_class=PlainTextResponse)
+    def metrics():
+        return PlainTextResponse(telemetry.render(), media_type='text/plain; version=0.0.4; charset=utf-8')
+
+    @router.post('/debug/profiler/start')
+    def start_profiler(interval_ms: float = Query(10, gt=0, description="Milliseconds between stack samples")):
+        started = telemetry.profiler.start(interval_ms / 1000)
+        return {'running': True, 'started': started, 'interval_ms': telemetry.profiler.interval * 1000}
+
+    @router.post('/debug/profiler/stop')
+    def stop_profiler():
+        return {'running': False, 'stopped': telemetry.profiler.stop(), 'samples': telemetry.profiler.samples}
+
+    @router.get('/debug/profiler', response_class=PlainTextResponse)
+    def profiler_stacks(clear: bool = Query(False, description="Drop the collected stacks after returning them")):
+        #folded stacks, e.g. for flamegraph.pl or speedscope
+        stacks = telemetry.profiler.folded()
+        if clear:
+            telemetry.profiler.clear()
+        return PlainTextResponse(stacks)
+
+    return router
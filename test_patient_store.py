@@ -0,0 +1,79 @@
+#write-ahead log and compaction of the JSON patient store
+#python -m pytest test_patient_store.py
+import pytest
+from patient_store import PatientStore, ReadOnlyStore, StoreInUse
+
+
+def patient(name):
+    return {'name': name, 'city': 'Pune', 'age': 30, 'gender': 'male', 'height': 1.75, 'weight': 70.0}
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / 'patients.json')
+
+
+def test_reader_leaves_the_owners_log_alone(path):
+    owner = PatientStore(path, check_interval=0)
+    owner.create('A1', patient('a1'))
+    reader = PatientStore(path, check_interval=0, read_only=True)
+    owner.create('A2', patient('a2'))
+    #the owner reloads nothing and loses nothing, the reader follows its log
+    assert owner.get('A2') is not None
+    assert reader.get('A2') is not None
+    with pytest.raises(ReadOnlyStore):
+        reader.create('B1', patient('b1'))
+    reader.close()
+    owner.close()
+
+    restarted = PatientStore(path)
+    assert sorted(restarted.all()) == ['A1', 'A2']
+    restarted.close()
+
+
+def test_reader_follows_rotation_and_compaction(path):
+    owner = PatientStore(path, check_interval=0, compact_every=3)
+    reader = PatientStore(path, check_interval=0, read_only=True)
+    for i in range(10):
+        owner.create(f'P{i}', patient(str(i)))
+        assert reader.get(f'P{i}') is not None
+    owner.delete('P0')
+    assert reader.get('P0') is None
+    assert len(reader) == 9
+    reader.close()
+    owner.close()
+
+
+def test_second_writer_is_refused(path):
+    owner = PatientStore(path)
+    with pytest.raises(StoreInUse):
+        PatientStore(path)
+    with pytest.raises(StoreInUse):
+        PatientStore(path, shared=True)
+    owner.close()
+    PatientStore(path).close()
+
+
+#a failed background compaction leaves patients.json.log.1 behind; the next rotation must fold it, not overwrite it
+#(whether that fold fails too or succeeds)
+@pytest.mark.filterwarnings('ignore::pytest.PytestUnhandledThreadExceptionWarning')
+@pytest.mark.parametrize('fold_fails', [True, False])
+def test_failed_compaction_keeps_the_sealed_log(path, tmp_path, fold_fails):
+    blocker = tmp_path / 'patients.json.tmp'
+    blocker.mkdir()
+    store = PatientStore(path, compact_every=3)
+    for i in range(3):
+        store.create(f'X{i}', patient(str(i)))
+    while store._compacting:
+        pass
+    if not fold_fails:
+        blocker.rmdir()
+    for i in range(4):
+        store.create(f'Y{i}', patient(str(i)))
+    store.close()
+    if fold_fails:
+        blocker.rmdir()
+
+    restarted = PatientStore(path)
+    assert sorted(restarted.all()) == ['X0', 'X1', 'X2', 'Y0', 'Y1', 'Y2', 'Y3']
+    restarted.close()